@@ -0,0 +1,28 @@
+#!/usr/bin/env bash
+
+# Inspect a guest using a guestconv daemon. Start the daemon with:
+#
+#   python -m guestconv.daemon --socket /tmp/guestconv.sock \
+#                              --db conf/guestconv.db
+#
+# Requests and responses are single lines of JSON, so any tool which can
+# talk to a Unix socket can be a client. This example uses socat and
+# python's json module.
+
+SOCKET=${GUESTCONV_SOCKET:-/tmp/guestconv.sock}
+IMAGE_TO_CONVERT=${IMAGE_TO_CONVERT:-$HOME/tmp/Fedora18-Cloud-x86_64-20130115.raw}
+
+request() {
+    socat - UNIX-CONNECT:$SOCKET
+}
+
+field() {
+    python -c "import json, sys; print json.loads(sys.stdin.readline())['$1']"
+}
+
+GUEST="<guestconv><controller type='ide'><disk format='raw'>file://$IMAGE_TO_CONVERT</disk></controller></guestconv>"
+
+JOB=$(python -c 'import json, sys; print json.dumps({"op": "inspect", "guest": sys.argv[1]})' "$GUEST" | request | field job)
+
+# Print log records as they are written, followed by the result
+echo "{\"op\": \"logs\", \"job\": \"$JOB\", \"follow\": true}" | request
@@ -14,8 +14,8 @@
 #   ./autogen.sh
 #   make install
 
-if ! rpm --quiet -q python-libguestfs python-lxml; then
-    sudo yum install -y curl python-libguestfs python-lxml
+if ! rpm --quiet -q python-libguestfs python-lxml python-futures; then
+    sudo yum install -y curl python-libguestfs python-lxml python-futures
 fi
 
 if [ ! -f $HOME/tmp/Fedora18-Cloud-x86_64-20130115.raw ]; then
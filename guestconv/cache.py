@@ -0,0 +1,149 @@
+# coding: utf-8
+# guestconv
+#
+# Copyright (C) 2013 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import errno
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+# 64 MiB
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+class DiskCache(object):
+
+    """A size-bounded cache of derived data stored on the host.
+
+    Values are stored as JSON, one file per entry, in a directory which may be
+    shared by any number of guestconv processes. Entries are grouped by
+    namespace, and are addressed by an arbitrary string key. When the total
+    size of all entries exceeds max_size, the least recently used entries are
+    evicted.
+
+    The total size is counted by scanning the directory once, and afterwards
+    kept up to date with the size of each entry stored. The directory is only
+    scanned again when the total exceeds max_size, so entries stored by other
+    processes are only counted then.
+
+    :path: The directory containing the cache.
+    :max_size: The maximum total size of all entries, in bytes.
+
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self._path = path
+        self._max_size = max_size
+        self._total = None
+
+    def _entry(self, namespace, key):
+        digest = hashlib.sha256(key.encode(u'utf-8')).hexdigest()
+        return os.path.join(self._path, namespace, digest)
+
+    def get(self, namespace, key):
+        """Return the value stored for key in namespace, or None."""
+        path = self._entry(namespace, key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+        except IOError as ex:
+            if ex.errno == errno.ENOENT:
+                return None
+            raise
+        except ValueError:
+            # A corrupt entry is treated as a miss
+            self._remove(path)
+            return None
+
+        # The modification time of an entry records when it was last used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return value
+
+    def put(self, namespace, key, value):
+        """Store value for key in namespace, evicting old entries if
+        necessary."""
+        path = self._entry(namespace, key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+        # Write the entry atomically, so concurrent readers never see a
+        # partial entry
+        (fd, tmp) = tempfile.mkstemp(prefix=u'.tmp.', dir=directory)
+        try:
+            with os.fdopen(fd, u'w') as f:
+                json.dump(value, f)
+            size = os.path.getsize(tmp)
+            os.rename(tmp, path)
+        except:
+            self._remove(tmp)
+            raise
+
+        if self._total is None:
+            self._total = self._scan()[1]
+        else:
+            self._total += size
+        if self._total > self._max_size:
+            self._evict()
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def _scan(self):
+        # Return a list of (mtime, size, path) of every entry, and their
+        # total size
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self._path):
+            for name in filenames:
+                if name.startswith(u'.tmp.'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # Removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return (entries, total)
+
+    def _evict(self):
+        (entries, total) = self._scan()
+
+        # Remove least recently used entries first
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._max_size:
+                break
+            self._remove(path)
+            total -= size
+        self._total = total
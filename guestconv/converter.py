@@ -19,12 +19,41 @@
 
 import guestfs
 import lxml.etree as ET
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from urlparse import urlparse
 
+import guestconv.cache
 import guestconv.converters
 import guestconv.exception
 import guestconv.db
 import guestconv.log
+import guestconv.scheduler
+import guestconv.template
+from guestconv.converters.devices import disk_name
+from guestconv.converters.util import CONFIG_SNAPSHOT, FileCache, \
+                                      UndoJournal, selinux_relabel
+from guestconv.lang import _
+from guestconv.log import BraceMessage, span
+
+DISK_ROLES = [u'os', u'data', u'unknown']
+DISK_CACHEMODES = [u'writeback', u'unsafe']
+DISK_DISCARDS = [u'disable', u'enable', u'besteffort']
+
+# Mountpoints which hold the operating system. If one of these is on a
+# disk which hasn't been attached, the guest's data disks are needed.
+_SYSTEM_MOUNTPOINTS = frozenset([
+    u'/', u'/bin', u'/boot', u'/boot/efi', u'/etc', u'/lib', u'/lib64',
+    u'/opt', u'/sbin', u'/usr', u'/usr/local', u'/var', u'/var/lib'
+])
 
 class RootMounted(object):
 
@@ -35,12 +64,17 @@ class RootMounted(object):
 
     :h: The libguestfs handle.
     :root: The libguestfs root to mount.
+    :readonly: Mount the root's filesystems read-only.
+    :devices: If given, the set of devices which are attached. Filesystems
+              on other devices are not mounted.
 
     """
 
-    def __init__(self, h, root):
+    def __init__(self, h, root, readonly=False, devices=None):
         self._h = h
         self._root = root
+        self._readonly = readonly
+        self._devices = devices
 
     def __enter__(self):
         h = self._h
@@ -48,7 +82,12 @@ class RootMounted(object):
         mounts = sorted(h.inspect_get_mountpoints(root).iteritems(),
                         key=lambda entry: len(entry[0]))
         for mountpoint, device in mounts:
-            h.mount_options('', device, mountpoint)
+            if not _attached(device, self._devices):
+                continue
+            if self._readonly:
+                h.mount_ro(device, mountpoint)
+            else:
+                h.mount_options('', device, mountpoint)
 
         h.aug_init('/', 1)
 
@@ -60,6 +99,219 @@ class RootMounted(object):
         return False
 
 
+def _disk_tuning(d):
+    # Parse the tuning attributes of a <disk> element
+    def _invalid(name, value, expected):
+        return ValueError(_(u'Invalid guest XML: {name} of disk {disk} '
+                            u'({value}) is not {expected}').
+                          format(name=name, disk=d.text, value=value,
+                                 expected=expected))
+
+    tuning = {}
+    for name, values in ((u'cachemode', DISK_CACHEMODES),
+                         (u'discard', DISK_DISCARDS)):
+        value = d.get(name)
+        if value is not None and value not in values:
+            raise _invalid(name, value,
+                           _(u'one of {values}').
+                           format(values=u', '.join(values)))
+        tuning[name] = value
+
+    tuning[u'cache'] = d.get(u'cache')
+
+    readahead = d.get(u'readahead')
+    if readahead is not None:
+        try:
+            readahead = int(readahead)
+        except ValueError:
+            readahead = -1
+        if readahead < 0:
+            raise _invalid(u'readahead', d.get(u'readahead'),
+                           _(u'a number of KiB'))
+    tuning[u'readahead'] = readahead
+
+    return tuning
+
+
+def _allocated(path):
+    # The space allocated to a file on the host, in bytes
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return None
+
+
+def _attached(device, devices):
+    # Whether a device named by inspection is attached. Devices which aren't
+    # named by a path, such as btrfs subvolumes, are assumed to be.
+    return devices is None or not device.startswith(u'/dev/') or \
+        device in devices
+
+
+def _attached_devices(h):
+    # All the block devices of the attached disks
+    return frozenset(h.list_devices() + h.list_partitions() + h.lvs() +
+                     h.list_md_devices())
+
+
+def _needs_data_disks(h, roots, devices):
+    # Whether inspection, without the data disks, found no operating system,
+    # or an operating system which is partly on the data disks
+    if len(roots) == 0:
+        return True
+    for root in roots:
+        for mountpoint, device in h.inspect_get_mountpoints(root).iteritems():
+            if mountpoint in _SYSTEM_MOUNTPOINTS and \
+               not _attached(device, devices):
+                return True
+    return False
+
+
+def _inspection_xml(inspection):
+    # Serialise the output of Converter.inspect(structured=True) as XML
+    builder = ET.TreeBuilder()
+    builder.start(u'guestconv', {})
+
+    for root in inspection[u'roots']:
+        builder.start(u'root', {u'name': root[u'name']})
+
+        builder.start(u'info', {})
+        def build_info(i):
+            for name, data in i.iteritems():
+                builder.start(name, {})
+                if isinstance(data, dict):
+                    build_info(data)
+                else:
+                    builder.data(str(data))
+                builder.end(name)
+        build_info(root[u'info'])
+        builder.end(u'info')
+
+        builder.start(u'options', {})
+        for option in root[u'options']:
+            attrs = {
+                u'name': option[u'name'],
+                u'description': option[u'description'],
+            }
+            builder.start(u'option', attrs)
+            for value in option[u'values']:
+                builder.start(u'value',
+                              {u'description': value[u'description']})
+                builder.data(value[u'name'])
+                builder.end(u'value')
+            builder.end(u'option')
+        builder.end(u'options')
+
+        builder.end(u'root')
+
+    builder.start(u'boot', {})
+    for loader in inspection[u'boot']:
+        attrs = {
+            u'disk': loader[u'disk'],
+            u'type': loader[u'type'],
+        }
+        name = loader[u'name']
+        if name is not None:
+            attrs[u'name'] = name
+
+        builder.start(u'loader', attrs)
+
+        if u'replacement' in loader:
+            builder.start(u'replacement', loader[u'replacement'])
+            builder.end(u'replacement')
+
+        for option in loader.get(u'options', []):
+            builder.start(u'loader', option)
+            builder.end(u'loader')
+
+        builder.end(u'loader')
+    builder.end(u'boot')
+
+    builder.end(u'guestconv')
+
+    xml = builder.close()
+    return ET.tostring(xml, encoding='utf8')
+
+
+def _invalid_option(optname, rootname):
+    return guestconv.exception.InvalidConversion(
+        _(u'option {option} in root {root} does not have a value').
+        format(option=optname, root=rootname))
+
+
+def _parse_desc_xml(desc):
+    # Return the bootloader replacements and the options of each root from
+    # an XML conversion description
+    try:
+        dom = ET.fromstring(desc)
+    except ET.ParseError as ex:
+        raise ValueError(_(u'Invalid conversion description: {message}').
+                         format(message=ex.message))
+
+    bootloaders = {}
+    for loader in dom.xpath(u'/guestconv/boot/loader'):
+        disk = loader.get(u'disk')
+        replacement = None
+        for replacement_e in loader.iterchildren():
+            replacement = replacement_e.text
+            break
+        bootloaders[disk] = replacement
+
+    roots = []
+    for root in dom.xpath(u'/guestconv/root'):
+        rootname = root.get(u'name')
+
+        options = {}
+        for option in root.xpath(u'options/option'):
+            optname = option.get(u'name')
+
+            value = None
+            for value_e in option.iterchildren():
+                value = value_e.text
+                break
+
+            if value is None:
+                raise _invalid_option(optname, rootname)
+
+            options[optname] = value
+        roots.append((rootname, options))
+
+    return (bootloaders, roots)
+
+
+def _parse_desc_dict(desc):
+    # As _parse_desc_xml, from the structured form returned by inspect()
+    try:
+        bootloaders = {}
+        for loader in desc.get(u'boot', []):
+            replacement = loader.get(u'replacement')
+            if isinstance(replacement, dict):
+                replacement = None
+            bootloaders[loader[u'disk']] = replacement
+
+        roots = []
+        for root in desc.get(u'roots', []):
+            rootname = root[u'name']
+
+            options = {}
+            for option in root.get(u'options', []):
+                optname = option[u'name']
+                value = option.get(u'value')
+                if value is None and len(option.get(u'values', [])) > 0:
+                    value = option[u'values'][0][u'name']
+
+                if value is None:
+                    raise _invalid_option(optname, rootname)
+
+                options[optname] = value
+            roots.append((rootname, options))
+    except (KeyError, TypeError, AttributeError) as ex:
+        raise ValueError(_(u'Invalid conversion description: {message}').
+                         format(message=repr(ex)))
+
+    return (bootloaders, roots)
+
+
 class Converter(object):
 
     """Convert a guest's disk images(s) to run on a new hypervisor.
@@ -75,30 +327,140 @@ class Converter(object):
     caller does not need to worry about that (see guestconv/log.py for
     the implementation).
 
+    Building, formatting and delivering messages which the function will
+    discard has a cost. If log_level is given, messages below that level are
+    not passed to the function, and are not built at all.
+
     If no logger object is provided, log messages are written to
     stderr and the threshold of log messages logged is WARNING unless
     the environment variable GUESTCONV_LOG_LEVEL is defined (one of
     NOTSET,DEBUG,INFO,WARNING,ERROR,CRITICAL).
 
-    :param db_paths: list of filenames (xml databases describing capabilities)
+    Derived data which is expensive to compute but identical between guests,
+    for example the drivers supported by a distribution kernel, can be cached
+    on the host in cache_dir and shared between many conversions. If cache_dir
+    is not given, the environment variable GUESTCONV_CACHE_DIR is used if it
+    is defined. Otherwise no on-host cache is used.
+
+    The cache also holds the inspections of guests whose disks are overlays
+    of template images. A guest with the same fingerprint as one already
+    inspected, as computed by guestconv.template.fingerprint(), reuses its
+    inspection. Only the information read by libguestfs inspection, such as
+    the hostname, is read from the guest itself.
+
+    Progress of long-running operations can be monitored by registering a
+    function with set_progress_callback().
+
+    If snapshot is True, inspection fetches the guest configuration it needs
+    in a single compressed transfer per directory, rather than reading each
+    file individually.
+
+    If overlay is True, the guest's disks are not modified by convert().
+    Instead, each disk is attached through a temporary qcow2 overlay backed by
+    the original disk, created in overlay_dir or the default temporary
+    directory. After conversion, commit() writes the changes to the original
+    disks, and discard() abandons them.
+
+    If readonly is True, the Converter can only inspect. The guest's disks
+    are attached read-only, so they may be in use elsewhere, and the
+    appliance is launched without networking and with minimal resources.
+    Its inspection can still be passed to convert() on a Converter for the
+    same guest which is not read-only.
+
+    Each disk in the guest XML may have a role attribute: os, data or unknown
+    (the default). A data disk holds no part of the operating system, and is
+    attached read-only, without an overlay. Unless every disk is a data disk,
+    data disks are not attached at all, so they are not scanned by
+    inspection. They are attached only if inspection finds no operating
+    system without them, or finds one whose system filesystems, such as /usr,
+    are on them. Filesystems on data disks which are not attached are not
+    mounted. As the operating system may then be converted, data disks which
+    are attached are writable, or attached through overlays, unless the
+    Converter is read-only.
+
+    A disk may also have the following attributes, which tune how it is
+    accessed. They are most useful for remote disks.
+
+    * cachemode: writeback (the default) or unsafe, which ignores flushes
+    * discard: disable (the default), enable or besteffort
+    * cache: the path of a local cache file. Data read from the disk is
+      kept in the cache file, so it is only read once, even by later
+      Converters. The cache file is a qcow2 overlay of the disk, which is
+      created if it doesn't exist. It must be deleted if the disk is
+      modified. The cache file is attached read-only, so nothing but reads
+      of the disk reaches it, and only a read-only Converter may use cache
+      files.
+    * readahead: the readahead of the disk in the appliance, in KiB
+
+    remote_reads() reports how much of each remote disk has been read, which
+    is only known for disks with a cache file.
+
+    :param guest: XML description of the guest
+    :param db_paths: list of filenames (xml databases describing capabilities),
+                     or a guestconv.db.DB which has already parsed them
     :param logger: optional logging.Logger object or just a function
+    :param cache_dir: optional directory for the on-host cache
+    :param snapshot: optional boolean, snapshot configuration for inspection
+    :param log_level: optional threshold for messages passed to a function
+    :param log_json: optional boolean, unless logger is a logging.Logger,
+                     format messages as JSON lines with JSONFormatter
+    :param overlay: optional boolean, convert in temporary overlays
+    :param overlay_dir: optional directory for the overlays
+    :param readonly: optional boolean, inspect only
 
     """
 
-    def __init__(self, guest, db_paths, logger=None):
-        self._h = guestfs.GuestFS(python_return_dict=True)
-        self._h.set_network(True)
+    def __init__(self, guest, db_paths, logger=None, cache_dir=None,
+                 snapshot=False, log_level=None, overlay=False,
+                 overlay_dir=None, readonly=False, log_json=False):
+        if readonly and overlay:
+            raise ValueError(u'A read-only Converter can not use overlays')
+
+        self._logger = guestconv.log.get_logger_object(logger,
+                                                       level=log_level,
+                                                       jsonFormat=log_json)
+        self._readonly = readonly
+        self._files = None
+        self._size = (None, None)
+        self._h = self._create_handle()
+        self._snapshot = snapshot
+        self._progress = None
+        self._event_handle = None
+        self._phases = []
+        self._pid = None
+        self._killed = False
+        self._kill_lock = threading.Lock()
         self._inspection = None
-        self._db = guestconv.db.DB(db_paths)
+        self._inspection_xml = None
+        self._backing = None
+        self._uninspected = set()
+        self._overlays = None
+        self._devices = None
+        self._attached = 0
+        if isinstance(db_paths, guestconv.db.DB):
+            self._db = db_paths
+        else:
+            self._db = guestconv.db.DB(db_paths)
         self._converters = {}
-        self._logger = guestconv.log.get_logger_object(logger)
+
+        if cache_dir is None:
+            cache_dir = os.environ.get(u'GUESTCONV_CACHE_DIR')
+        if cache_dir is None:
+            self._cache = None
+        else:
+            self._cache = guestconv.cache.DiskCache(cache_dir)
 
         try:
             desc = ET.fromstring(guest)
-        except lxml.etree.ParseError as ex:
+        except ET.ParseError as ex:
             raise ValueError(_(u'Invalid guest XML: {message}').
                              format(message=ex.message))
 
+        if overlay:
+            self._overlays = []
+            self._overlay_dir = tempfile.mkdtemp(prefix=u'guestconv-overlay.',
+                                                 dir=overlay_dir)
+
         def _get_single_value(name):
             for v in desc.xpath(u'/guestconv/{name}[1]'.format(name=name)):
                 return v.text
@@ -115,32 +477,19 @@ class Converter(object):
                                    u'({value}) is not a valid integer').
                                  format(name=name, value=v))
 
+        # (disk, path, add_drive_opts arguments) of each disk
+        drives = []
+
         controllers = []
         self._guest = {
+            u'name': _get_single_value(u'name'),
             u'cpus': _get_single_int(u'cpus'),
             u'memory': _get_single_int(u'memory'),
             u'arch': _get_single_value(u'arch'),
             u'controllers': controllers
         }
 
-        # a = 1
-        # z = 26
-        # aa = 27
-        # zz = 702
-        # aaa = 703
-        def _index_to_disk_name(i, name=u''):
-            if i == 0:
-                return name
-
-            mod = i % 26
-            if mod == 0:
-                mod = 26
-
-            # ord(u'a') - 1 = 96
-            return _index_to_disk_name((i-mod)/26, chr(96+mod)+name)
-
         # Disk and controller index counters
-        guestfs_d = 0
         ide_c = 0
         ide_d = 0
         scsi_d = 0
@@ -160,13 +509,22 @@ class Converter(object):
                 format = d.get(u'format')
                 url = urlparse(d.text)
 
+                role = d.get(u'role', u'unknown')
+                if role not in DISK_ROLES:
+                    raise ValueError(_(u'Invalid guest XML: role of disk '
+                                       u'{disk} ({role}) is not one of '
+                                       u'{roles}').
+                                     format(disk=d.text, role=role,
+                                            roles=u', '.join(DISK_ROLES)))
+                tuning = _disk_tuning(d)
+
                 hint = None
                 if typ == u'ide':
                     ide_d += 1
-                    hint = u'ide' + _index_to_disk_name(ide_c*4 + ide_d)
+                    hint = u'hd' + disk_name(ide_c*4 + ide_d)
                 elif typ == u'scsi':
                     scsi_d += 1
-                    hint = u'scsi' + _index_to_disk_name(scsi_d)
+                    hint = u'sd' + disk_name(scsi_d)
                 elif typ == u'cciss':
                     hint = u'cciss/c{c}d{d}'.format(c=cciss_c, d=cciss_d)
                     cciss_d += 1
@@ -183,18 +541,55 @@ class Converter(object):
                 if path == u'':
                     path = None
 
-                guestfs_d += 1
-                disks.append({
-                    u'guestfs': u'sd' + _index_to_disk_name(guestfs_d),
+                disk = {
                     u'format': format,
                     u'protocol': protocol,
                     u'server': server,
                     u'path': path,
-                    u'hint': hint
-                })
-
-                self._h.add_drive_opts(path, protocol=protocol, server=server,
-                                       format=format, name=hint)
+                    u'hint': hint,
+                    u'role': role
+                }
+                disk.update(tuning)
+                disks.append(disk)
+
+                # qemu can open a remote backing file from its URL
+                backing = d.text
+                if protocol == u'file':
+                    backing = os.path.abspath(path)
+                disk[u'backing'] = backing
+
+                opts = {u'name': hint}
+                for name in (u'cachemode', u'discard'):
+                    if tuning[name] is not None:
+                        opts[name] = tuning[name]
+
+                # A data disk is attached read-only, without an overlay,
+                # unless the operating system turns out to need it
+                disk_readonly = readonly or role == u'data'
+                if tuning[u'cache'] is not None:
+                    if not readonly:
+                        raise ValueError(_(u'Invalid guest XML: disk {disk} '
+                                           u'has a cache file, but the '
+                                           u'Converter is not read-only').
+                                         format(disk=d.text))
+
+                    # Reads are still copied into the cache file, but
+                    # writes, e.g. a journal replayed by a read-only mount,
+                    # can't reach it
+                    drives.append((disk,
+                                   self._create_cache(tuning[u'cache'],
+                                                      backing, format),
+                                   dict(opts, format=u'qcow2',
+                                        copyonread=True, readonly=True)))
+                elif self._overlays is None or role == u'data':
+                    drives.append((disk, path,
+                                   dict(opts, protocol=protocol,
+                                        server=server, format=format,
+                                        readonly=disk_readonly)))
+                else:
+                    drives.append((disk,
+                                   self._create_overlay(backing, format),
+                                   dict(opts, format=u'qcow2')))
 
             if typ == u'ide':
                 ide_c += 1
@@ -203,118 +598,586 @@ class Converter(object):
                 cciss_c += 1
                 cciss_d = 0
 
+        # Data disks are deferred, unless there is nothing else to inspect.
+        # They are attached after the other disks, so the other disks have
+        # the same names in the appliance either way.
+        attached = [i for i in drives if i[0][u'role'] != u'data']
+        deferred = [i for i in drives if i[0][u'role'] == u'data']
+        if len(attached) == 0:
+            attached = [self._writable_drive(i) for i in deferred]
+            deferred = []
+        self._drives = attached + deferred
+        self._deferred = len(deferred) > 0
+        for i, (disk, path, opts) in enumerate(self._drives):
+            disk[u'guestfs'] = u'sd' + disk_name(i + 1)
+        self._add_drives(len(attached))
+
+        # Identifies this guest in structured logs
+        self._id = self._guest[u'name']
+        if self._id is None:
+            self._id = uuid.uuid4().hex
+
+        if readonly:
+            # Inspection doesn't need more than the smallest appliance
+            self.size_appliance()
+
         # a less-than DEBUG logging message (since 10 == DEBUG)
         self._logger.log( 5 , u'Converter __init_() completed' )
 
-    def inspect(self):
+    def _create_handle(self):
+        files = FileCache(guestfs.GuestFS(python_return_dict=True),
+                          self._logger)
+        if self._files is not None:
+            # File cache statistics span the lifetime of the Converter
+            files.hits = self._files.hits
+            files.misses = self._files.misses
+        self._files = files
+
+        h = UndoJournal(files)
+        if self._readonly:
+            # Inspection doesn't need a recovery process
+            h.set_recovery_proc(False)
+        else:
+            h.set_network(True)
+        return h
+
+    def _add_drives(self, count):
+        for disk, path, opts in self._drives[self._attached:count]:
+            self._h.add_drive_opts(path, **opts)
+            if disk[u'cache'] is not None:
+                disk[u'cached'] = _allocated(disk[u'cache'])
+        self._attached = count
+
+    def _attach_data_disks(self):
+        # Relaunch the appliance with the deferred data disks attached. Disks
+        # can't be added to a running appliance.
+        h = self._h
+        (memsize, smp) = (h.get_memsize(), h.get_smp())
+        with self._kill_lock:
+            self._pid = None
+        h.close()
+
+        self._h = self._create_handle()
+        self._attached = 0
+        self._h.set_memsize(memsize)
+        self._h.set_smp(smp)
+        self._event_handle = None
+        if self._progress is not None:
+            self.set_progress_callback(self._progress)
+
+        self._drives = [self._writable_drive(i) for i in self._drives]
+        self._add_drives(len(self._drives))
+        self._deferred = False
+        self._launch()
+
+    def _writable_drive(self, drive):
+        # Attach a data disk which the operating system needs so it can be
+        # converted: writable, or through an overlay
+        (disk, path, opts) = drive
+        if self._readonly or disk[u'role'] != u'data':
+            return drive
+
+        if self._overlays is None:
+            return (disk, path, dict(opts, readonly=False))
+
+        opts = dict(opts, format=u'qcow2')
+        for name in (u'protocol', u'server', u'readonly'):
+            del opts[name]
+        return (disk, self._create_overlay(disk[u'backing'], disk[u'format']),
+                opts)
+
+    def set_progress_callback(self, func):
+        """Register a function to receive progress events.
+
+        func is called with a single argument, a dict describing the event. It
+        always contains:
+
+        * event: one of
+          - start, end, error: a phase of the conversion started, completed,
+            or failed
+          - progress: a libguestfs operation reported progress
+          - appliance: the libguestfs appliance wrote a message
+        * phase: the phase in progress, e.g. launch, inspect or convert
+        * guest: the guest identifier used in logs
+        * time: the time of the event, in seconds since the epoch
+
+        and, depending on the event:
+
+        * root: the root being inspected or converted
+        * position, total: the progress of the current operation
+        * message: the message written by the appliance
+        * cache_hits, cache_misses, cache_hit_ratio: for end and error, the
+          guest file reads during the phase which were served from the file
+          cache, and which were not. cache_hit_ratio is omitted if there were
+          none.
+
+        Progress events are only sent by operations which take more than a
+        few seconds. Any event at all shows that the conversion has not
+        stalled.
+
+        An exception raised by func is logged, and does not interrupt the
+        conversion.
+
+        :param func: a function, or None to stop receiving events
+
+        """
+        self._progress = func
+        if func is None:
+            if self._event_handle is not None:
+                self._h.delete_event_callback(self._event_handle)
+                self._event_handle = None
+        elif self._event_handle is None:
+            self._event_handle = self._h.set_event_callback(
+                self._guestfs_event,
+                guestfs.EVENT_PROGRESS | guestfs.EVENT_APPLIANCE)
+
+    def _notify(self, event, **data):
+        if self._progress is None:
+            return
+
+        data[u'event'] = event
+        data[u'guest'] = self._id
+        data[u'time'] = time.time()
+        if u'phase' not in data:
+            if len(self._phases) > 0:
+                (data[u'phase'], root) = self._phases[-1]
+                if root is not None:
+                    data[u'root'] = root
+            else:
+                data[u'phase'] = None
+
+        try:
+            self._progress(data)
+        except Exception as ex:
+            self._logger.warn(_(u'Progress callback failed on {event} event: '
+                                u'{error}').format(event=event, error=ex))
+
+    def _guestfs_event(self, event, event_handle, buf, array):
+        if event == guestfs.EVENT_PROGRESS:
+            # array is (proc_nr, serial, position, total)
+            self._notify(u'progress', position=array[2], total=array[3])
+        elif event == guestfs.EVENT_APPLIANCE:
+            self._notify(u'appliance', message=buf)
+
+    def _create_overlay(self, backing, format):
+        overlay = os.path.join(self._overlay_dir,
+                               u'{}.qcow2'.format(len(self._overlays)))
+        if format is None:
+            self._h.disk_create(overlay, u'qcow2', -1, backingfile=backing)
+        else:
+            self._h.disk_create(overlay, u'qcow2', -1, backingfile=backing,
+                                backingformat=format)
+        self._overlays.append(overlay)
+        return overlay
+
+    def _create_cache(self, cache, backing, format):
+        if os.path.exists(cache):
+            return cache
+        if format is None:
+            self._h.disk_create(cache, u'qcow2', -1, backingfile=backing)
+        else:
+            self._h.disk_create(cache, u'qcow2', -1, backingfile=backing,
+                                backingformat=format)
+        return cache
+
+    def remote_reads(self):
+        """Return how much of each remote disk has been read.
+
+        Reads are measured by the growth of a disk's cache file, so they are
+        only known for disks with one. Data which was already in the cache
+        file is not counted.
+
+        :returns: A dict mapping the name of each attached remote disk in the
+                  appliance, e.g. sdb, to the number of bytes read from it,
+                  or None if it isn't known.
+
+        """
+        reads = {}
+        for disk, path, opts in self._drives[:self._attached]:
+            if disk[u'protocol'] == u'file':
+                continue
+
+            read = None
+            if disk[u'cache'] is not None:
+                allocated = _allocated(disk[u'cache'])
+                if allocated is not None and disk[u'cached'] is not None:
+                    read = allocated - disk[u'cached']
+            reads[disk[u'guestfs']] = read
+        return reads
+
+    def commit(self):
+        """Write the changes made to the overlays to the original disks.
+
+        This is only valid if the Converter was created with overlay=True.
+        The appliance is shut down, and the Converter can't be used
+        afterwards.
+
+        :raises: ConversionError if an overlay could not be committed. The
+                 overlays are kept, so commit() may be retried.
+
+        """
+        self._finish_overlays(commit=True)
+
+    def discard(self):
+        """Abandon the changes made to the overlays.
+
+        This is only valid if the Converter was created with overlay=True.
+        The original disks are unchanged. The appliance is shut down, and the
+        Converter can't be used afterwards.
+
+        """
+        self._finish_overlays(commit=False)
+
+    def _finish_overlays(self, commit):
+        if self._overlays is None:
+            raise guestconv.exception.GuestConvException(
+                u'Converter has no overlays to commit or discard')
+
+        # Ensure qemu has written everything and closed the overlays
+        self._h.shutdown()
+
+        if commit:
+            for overlay in self._overlays:
+                try:
+                    qemu_img = subprocess.Popen([u'qemu-img', u'commit',
+                                                 u'-q', overlay],
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.STDOUT)
+                except OSError as ex:
+                    raise guestconv.exception.ConversionError(
+                        _(u'Failed to commit {overlay}: {error}').
+                        format(overlay=overlay, error=ex.strerror))
+                output = qemu_img.communicate()[0]
+                if qemu_img.returncode != 0:
+                    raise guestconv.exception.ConversionError(
+                        _(u'Failed to commit {overlay}: {error}').
+                        format(overlay=overlay, error=output.strip()))
+
+        shutil.rmtree(self._overlay_dir)
+        self._overlays = None
+
+    def size_appliance(self, memsize=None, smp=None, cpus=None):
+        """Set the memory and number of vCPUs of the appliance.
+
+        Values which are not given, either here or by an earlier call, are
+        estimated from the guest description by
+        guestconv.scheduler.estimate_appliance(). cpus only limits an
+        estimated number of vCPUs. This has no effect once the appliance has
+        been launched.
+
+        :param memsize: optional appliance memory in MiB
+        :param smp: optional number of appliance vCPUs
+        :param cpus: optional limit on the estimated number of vCPUs
+        :returns: A tuple of (memsize, smp) describing the appliance
+
+        """
+        h = self._h
+        if self._pid is None:
+            # Values given explicitly are kept by later calls
+            if memsize is None:
+                memsize = self._size[0]
+            if smp is None:
+                smp = self._size[1]
+            self._size = (memsize, smp)
+
+            (estimate_memsize, estimate_smp) = \
+                guestconv.scheduler.estimate_appliance(
+                    self._guest, convert=not self._readonly)
+            if memsize is None:
+                memsize = estimate_memsize
+            if smp is None:
+                smp = estimate_smp
+                if cpus is not None:
+                    smp = min(smp, cpus)
+
+            h.set_memsize(memsize)
+            h.set_smp(smp)
+
+        return (h.get_memsize(), h.get_smp())
+
+    def appliance_pid(self):
+        """Return the pid of the appliance, or None if it isn't running.
+
+        Unlike other methods, appliance_pid() may be called from any thread.
+
+        """
+        return self._pid
+
+    def kill(self):
+        """Abandon the inspection or conversion in progress.
+
+        The libguestfs appliance is killed, causing the operation in progress
+        to fail. No further phases of work are started: they raise
+        ConversionCancelled instead. The guest's disks may be left partially
+        converted.
+
+        Unlike other methods, kill() may be called from any thread.
+
+        """
+        with self._kill_lock:
+            self._killed = True
+            if self._pid is not None:
+                try:
+                    os.kill(self._pid, signal.SIGKILL)
+                except OSError:
+                    # The appliance has already exited
+                    pass
+
+    def _launch(self):
+        h = self._h
+        h.launch()
+
+        # The appliance pid is recorded here because the handle can't be used
+        # by kill() while another thread is using it
+        with self._kill_lock:
+            self._pid = h.get_pid()
+        if self._killed:
+            self.kill()
+
+        for disk, path, opts in self._drives[:self._attached]:
+            if disk[u'readahead'] is not None:
+                # blockdev_setra takes 512 byte sectors
+                h.blockdev_setra(u'/dev/' + disk[u'guestfs'],
+                                 disk[u'readahead'] * 2)
+
+    @contextmanager
+    def _phase(self, phase, root=None):
+        # Execute a block of code as a named phase of work, which is logged
+        # and reported to the progress callback
+        if self._killed:
+            raise guestconv.exception.ConversionCancelled(
+                _(u'Conversion of {guest} was cancelled').
+                format(guest=self._id))
+
+        fields = {u'guest': self._id}
+        if root is not None:
+            fields[u'root'] = root
+
+        self._phases.append((phase, root))
+        self._notify(u'start')
+        (hits, misses) = (self._files.hits, self._files.misses)
+        stats = {}
+        try:
+            with span(self._logger, phase, **fields) as result:
+                try:
+                    yield
+                finally:
+                    stats = self._file_cache_stats(hits, misses)
+                    result.update(stats)
+        except:
+            self._notify(u'error', **stats)
+            raise
+        else:
+            self._notify(u'end', **stats)
+        finally:
+            self._phases.pop()
+
+    def _file_cache_stats(self, hits, misses):
+        # The use of the file cache since hits and misses were counted
+        hits = self._files.hits - hits
+        misses = self._files.misses - misses
+        stats = {u'cache_hits': hits, u'cache_misses': misses}
+        if hits + misses > 0:
+            stats[u'cache_hit_ratio'] = float(hits) / (hits + misses)
+        return stats
+
+    def _rollback(self, root):
+        # Undo the modifications made to root by a failed conversion. Errors
+        # are logged, so the caller can report the original failure.
+        if self._killed:
+            return
+
+        try:
+            with self._phase(u'rollback', root):
+                if not self._h.undo():
+                    self._logger.warn(_(u'Changes made to {root} by guest '
+                                        u'commands could not be undone').
+                                      format(root=root))
+
+                # Restored files keep their labels. Only those which
+                # couldn't are relabelled, and never on the next boot.
+                selinux_relabel(self._h, self._logger, autorelabel=False)
+        except Exception as ex:
+            self._logger.error(_(u'Failed to undo the conversion of {root}: '
+                                 u'{error}').format(root=root, error=ex))
+
+    def inspect(self, structured=False):
         """Inspect the guest image(s) and return conversion options.
 
         Inspect the drive, and return available transformations as an XML
         document.
 
-        :returns:  XML document (a string)
+        If structured is True, the same information is returned as a dict
+        instead, which can be serialised as JSON. It has the form:
+
+            {"roots": [{"name": <root>,
+                        "info": {<name>: <value or dict>, ...},
+                        "options": [{"name": <option>,
+                                     "description": <description>,
+                                     "values": [{"name": <value>,
+                                                 "description": <desc>},
+                                                ...]},
+                                    ...],
+                        "missing": {<capability>: [<package>, ...], ...},
+                        "hypervisors": {<hypervisor>: <status>, ...}},
+                       ...],
+             "boot": [{"disk": <disk>, "type": <type>, "name": <name>,
+                       "replacement": {"type": <type>, "name": <name>},
+                       "options": [{"type": <type>, "name": <name>}, ...]},
+                      ...]}
+
+        missing lists the packages a root needs to gain each capability which
+        it lacks. hypervisors gives the status of the guest tools of each
+        hypervisor the root can run on: installed or available. Neither is
+        included in the XML document. replacement and options are only
+        present for bootloaders which have them. The dict must not be
+        modified; convert() may be passed a copy.
+
+        :param structured: optional boolean, return a dict
+        :returns:  XML document (a string), or a dict
 
         """
-        if self._inspection:
+        if self._inspection is None:
+            self._inspection = self._inspect()
+
+        if structured:
             return self._inspection
 
+        if self._inspection_xml is None:
+            self._inspection_xml = _inspection_xml(self._inspection)
+        return self._inspection_xml
+
+    def _inspect_root(self, converter, root):
+        # Inspect a mounted root, reusing the cached inspection of a guest
+        # cloned from the same template if there is one
         h = self._h
 
-        h.launch()
-        guestfs_roots = h.inspect_os()
+        key = None
+        if self._backing is not None:
+            key = guestconv.template.fingerprint(
+                h, self._backing, converter.__class__.__name__,
+                self._db.digest)
+            cached = self._cache.get(u'template', key)
+            if cached is not None:
+                self._logger.debug(BraceMessage(u'Reusing inspection of '
+                                                u'template {} for root {}',
+                                                key, root))
+                converter._details = cached[u'details']
+                self._uninspected.add(root)
+
+                # Only libguestfs inspection differs between clones
+                return (cached[u'bootloaders'], converter.inspect_info(),
+                        cached[u'options'])
+
+        if self._snapshot:
+            h.snapshot(CONFIG_SNAPSHOT)
+        (root_bl, root_info, root_options) = converter.inspect()
+
+        if key is not None:
+            self._cache.put(u'template', key, {
+                u'bootloaders': root_bl,
+                u'options': root_options,
+                u'details': converter._details
+            })
+        return (root_bl, root_info, root_options)
+
+    def _inspect(self):
+        with self._phase(u'launch'):
+            self._launch()
+        with self._phase(u'inspect_os'):
+            guestfs_roots = self._h.inspect_os()
+
+            if self._deferred:
+                devices = _attached_devices(self._h)
+                if _needs_data_disks(self._h, guestfs_roots, devices):
+                    self._logger.info(_(u'Inspection of {guest} needs its '
+                                        u'data disks: attaching them').
+                                      format(guest=self._id))
+                    self._attach_data_disks()
+                    guestfs_roots = self._h.inspect_os()
+                else:
+                    self._devices = devices
+        h = self._h
+
+        for name, read in sorted(self.remote_reads().iteritems()):
+            if read is None:
+                self._logger.info(_(u'The number of bytes of {disk} read to '
+                                    u'inspect {guest} is unknown').
+                                  format(disk=name, guest=self._id))
+            else:
+                self._logger.info(_(u'Read {bytes} bytes of {disk} to inspect '
+                                    u'{guest}').
+                                  format(bytes=read, disk=name,
+                                         guest=self._id))
 
         bootloaders = {}
-        roots = {}
+        inspection = {u'roots': [], u'boot': []}
 
-        builder = ET.TreeBuilder()
-        builder.start(u'guestconv', {})
+        # Guests cloned from the same template can share an inspection
+        if self._cache is not None:
+            self._backing = guestconv.template.guest_backing_chains(
+                self._guest)
 
         for root in guestfs_roots:
             for klass in guestconv.converters.all:
                 converter = None
                 try:
                     converter = klass(h, root, self._guest,
-                                      self._db, self._logger)
+                                      self._db, self._logger, self._cache)
                 except guestconv.exception.UnsupportedConversion:
-                    self._logger.debug(
-                        u'Converter {} unsupported for root {}'
-                        .format(klass.__name__, root))
+                    self._logger.debug(BraceMessage(
+                        u'Converter {} unsupported for root {}',
+                        klass.__name__, root))
                     continue
 
-                with RootMounted(h, root):
-                    (root_bl, root_info, root_options) = converter.inspect()
+                with RootMounted(h, root, self._readonly, self._devices), \
+                     self._phase(u'inspect', root):
+                    (root_bl, root_info, root_options) = \
+                        self._inspect_root(converter, root)
 
                 self._converters[root] = converter
 
                 bootloaders.update(root_bl)
 
-                builder.start(u'root', {u'name': root})
-
-                builder.start(u'info', {})
-                def build_info(i):
-                    for name, data in i.iteritems():
-                        builder.start(name, {})
-                        if isinstance(data, dict):
-                            build_info(data)
-                        else:
-                            builder.data(str(data))
-                        builder.end(name)
-                build_info(root_info)
-                builder.end(u'info')
-
-                builder.start(u'options', {})
-                for option in root_options:
-                    attrs = {
-                        u'name': option[0],
-                        u'description': option[1],
-                    }
-                    builder.start(u'option', attrs)
-                    for val_name, val_desc in option[2]:
-                        builder.start(u'value', {u'description': val_desc})
-                        builder.data(val_name)
-                        builder.end(u'value')
-                    builder.end(u'option')
-                builder.end(u'options')
-
-                builder.end(u'root')
+                options = []
+                for name, description, values in root_options:
+                    options.append({
+                        u'name': name,
+                        u'description': description,
+                        u'values': [{u'name': val_name,
+                                     u'description': val_desc}
+                                    for val_name, val_desc in values]
+                    })
+
+                inspection[u'roots'].append({
+                    u'name': root,
+                    u'info': root_info,
+                    u'options': options,
+                    u'missing': converter._details[u'missing'],
+                    u'hypervisors': converter._details[u'hypervisors']
+                })
 
                 # We only want 1 converter to run
                 break
 
-        builder.start(u'boot', {})
         for disk, props in bootloaders.iteritems():
-            attrs = {
+            loader = {
                 u'disk': disk,
                 u'type': props[u'type'],
+                u'name': props[u'name']
             }
-            name = props[u'name']
-            if name is not None:
-                attrs[u'name'] = name
-
-            builder.start(u'loader', attrs)
 
             if u'replacement' in props:
-                builder.start(u'replacement', props[u'replacement'])
-                builder.end(u'replacement')
+                loader[u'replacement'] = props[u'replacement']
 
             if u'options' in props:
-                for option in props[u'options']:
-                    attrs = {
-                        u'type': option[u'type'],
-                        u'name': option[u'name']
-                    }
-                    builder.start(u'loader', attrs)
-                    builder.end(u'loader')
-
-            builder.end(u'loader')
-        builder.end(u'boot')
-
-        builder.end(u'guestconv')
+                loader[u'options'] = [{u'type': option[u'type'],
+                                       u'name': option[u'name']}
+                                      for option in props[u'options']]
 
-        xml = builder.close()
-        self._inspection = ET.tostring(xml, encoding='utf8')
+            inspection[u'boot'].append(loader)
 
-        return self._inspection
+        return inspection
 
     def convert(self, desc):
         """Convert the guest image(s).
@@ -323,31 +1186,37 @@ class Converter(object):
         will be modified in place. Note that desc may simply be the XML returned
         by inspect(), or a modified version of it.
 
-        :param desc:  XML document string
-        :returns:  TODO
+        desc may instead be a dict of the form returned by
+        inspect(structured=True). The value of each option is its first
+        value, unless the option has a "value" key naming it. A bootloader is
+        replaced if its "replacement" is the name of its replacement, rather
+        than the dict returned by inspect(), as in the XML document.
 
-        """
+        If inspect() has not been called, it is called first. desc may be the
+        result of inspecting the same guest with a different Converter.
 
-        try:
-            dom = ET.fromstring(desc)
-        except lxml.etree.ParseError as ex:
-            raise ValueError(_(u'Invalid conversion description: {message}').
-                             format(message=ex.message))
+        If the conversion of a root fails, the files and partition attributes
+        it modified are restored before the error is raised, except for
+        changes made by guest commands.
 
-        bootloaders = {}
-        roots = {}
+        :param desc:  XML document string, or a dict
+        :returns:  TODO
 
-        for loader in dom.xpath(u'/guestconv/boot/loader'):
-            disk = loader.get(u'disk')
-            replacement = None
-            for replacement_e in loader.iterchildren():
-                replacement = replacement_e.text
-                break
-            bootloaders[disk] = replacement
+        """
+        if self._readonly:
+            raise guestconv.exception.InvalidConversion(
+                _(u'A read-only Converter can not convert'))
+
+        if isinstance(desc, dict):
+            (bootloaders, roots) = _parse_desc_dict(desc)
+        else:
+            (bootloaders, roots) = _parse_desc_xml(desc)
 
-        for root in dom.xpath(u'/guestconv/root'):
-            rootname = root.get(u'name')
+        # The converters for each root are created by inspection
+        if self._inspection is None:
+            self.inspect()
 
+        for rootname, options in roots:
             try:
                 converter = self._converters[rootname]
             except KeyError:
@@ -355,21 +1224,28 @@ class Converter(object):
                     (_(u'root {root} specified in desc does not exist').
                      format(root=rootname))
 
-            options = {}
-            for option in root.xpath(u'options/option'):
-                optname = option.get(u'name')
-
-                value = None
-                for value_e in option.iterchildren():
-                    value = value_e.text
-                    break
-
-                if value is None:
-                    raise guestconv.exception.InvalidConversion \
-                        (_(u'option {option} in root {root} does not have a '
-                           u'value').format(option=optname, root=rootname))
-
-                options[optname] = value
-
-            with RootMounted(self._h, name):
-                converter.convert(bootloaders, options)
+            # All augeas modifications made by the converter are saved
+            # together when it completes
+            with RootMounted(self._h, rootname, devices=self._devices), \
+                 self._phase(u'convert', rootname):
+                if rootname in self._uninspected:
+                    # Its inspection was reused, but the converter needs the
+                    # state inspection leaves behind
+                    converter.inspect()
+                    self._uninspected.discard(rootname)
+
+                self._h.clear()
+                try:
+                    # On failure, the augeas transaction is discarded before
+                    # the modified files are restored
+                    with converter._aug.phase():
+                        converter.convert(bootloaders, options)
+                except:
+                    exc_info = sys.exc_info()
+                    self._rollback(rootname)
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                # Only the files modified by the conversion are relabelled
+                with self._phase(u'relabel', rootname):
+                    selinux_relabel(self._h, self._logger)
+                self._h.clear()
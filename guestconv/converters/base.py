@@ -18,19 +18,44 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import guestconv.exception
+from guestconv.converters.util import AugeasTransaction
 
 class BaseConverter(object):
-    def __init__(self, h, root, guest, db, logger):
+    def __init__(self, h, root, guest, db, logger, cache=None):
         self._h = h
         self._root = root
         self._guest = guest
         self._db = db
+        self._cache = cache
+        self._aug = AugeasTransaction(h)
         self._logger = guestconv.log.get_logger_object(logger)
 
+        # Findings of inspect() which are reported only in the structured
+        # form of the inspection: the missing dependencies of each
+        # capability, and the status of each hypervisor's guest tools
+        self._details = {u'missing': {}, u'hypervisors': {}}
+
     def inspect(self):
         # Child classes must implement this
         raise NotImplementedError("Implement me")
 
+    def inspect_info(self):
+        '''Return the info section of the root's inspection, which is read
+        from libguestfs inspection'''
+        h = self._h
+        root = self._root
+
+        return {
+            u'hostname': h.inspect_get_hostname(root),
+            u'os': h.inspect_get_type(root),
+            u'distribution': h.inspect_get_distro(root),
+            u'arch': h.inspect_get_arch(root),
+            u'version': {
+                u'major': h.inspect_get_major_version(root),
+                u'minor': h.inspect_get_minor_version(root)
+            }
+        }
+
     def convert(self, bootloaders, devices):
         # Child classes must implement this
         raise NotImplementedError("Implement me")
@@ -24,29 +24,20 @@ from guestconv.converters.exception import *
 from guestconv.lang import _
 
 class Debian(BaseConverter):
-    def __init__(self, h, root, guest, db, logger):
-        super(Debian,self).__init__(h, root, guest, db, logger)
+    def __init__(self, h, root, guest, db, logger, cache=None):
+        super(Debian,self).__init__(h, root, guest, db, logger, cache)
         distro = h.inspect_get_distro(root)
         if (h.inspect_get_type(root) != u'linux' or
             distro not in (u'debian', u'ubuntu')):
             raise UnsupportedConversion()
 
     def inspect(self):
-        info = {}
+        info = self.inspect_info()
         options = []
 
         h = self._h
         root = self._root
 
-        info[u'hostname'] = h.inspect_get_hostname(root)
-        info[u'os'] = h.inspect_get_type(root)
-        info[u'distribution'] = h.inspect_get_distro(root)
-        info[u'arch'] = h.inspect_get_arch(root)
-        info[u'version'] = {
-            u'major': h.inspect_get_major_version(root),
-            u'minor': h.inspect_get_minor_version(root)
-        }
-
         try:
             self._bootloader = guestconv.converters.grub.detect(
                 h, root, self, self._logger)
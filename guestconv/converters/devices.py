@@ -0,0 +1,156 @@
+# coding: utf-8
+# guestconv
+#
+# Copyright (C) 2013 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Rename guest block devices when their driver changes"""
+
+__all__ = [u'disk_name', u'device_table', u'remap_string', u'remap_devices',
+           u'REMAP_PATHS']
+
+import re
+
+from guestconv.log import BraceMessage
+
+# The device name prefix given to disks by each block driver
+_DRIVER_PREFIXES = {
+    u'virtio-blk': u'vd',
+    u'scsi-hd': u'sd',
+    u'ide-hd': u'hd'
+}
+
+# Guest configuration which refers to block devices, as augeas paths. Each
+# matching node is remapped.
+REMAP_PATHS = [
+    u'/files/etc/fstab/*/spec',
+    u'/files/etc/mtab/*/spec',
+    u'/files/boot/grub/device.map/*[label() != "#comment"]',
+    u'/files/boot/grub/grub.conf/title/kernel/*',
+    u'/files/boot/grub/menu.lst/title/kernel/*',
+    u'/files/boot/efi/EFI/*/device.map/*[label() != "#comment"]',
+    u'/files/boot/efi/EFI/*/grub.conf/title/kernel/*',
+    u'/files/etc/sysconfig/grub/boot',
+    u'/files/etc/default/grub/GRUB_CMDLINE_LINUX',
+    u'/files/etc/default/grub/GRUB_CMDLINE_LINUX_DEFAULT',
+    u'/files/etc/lvm/lvm.conf/devices/dict/filter/list/*/str'
+]
+
+
+# a = 1
+# z = 26
+# aa = 27
+# zz = 702
+# aaa = 703
+def disk_name(i, name=u''):
+    '''Return the letters which end the name of the i'th disk, from 1'''
+    if i == 0:
+        return name
+
+    mod = i % 26
+    if mod == 0:
+        mod = 26
+
+    # ord(u'a') - 1 = 96
+    return disk_name((i-mod)/26, chr(96+mod)+name)
+
+
+def device_table(guest, block):
+    '''Return the new name of each guest disk for a block driver
+
+    Disks are named by the new driver in the order they are described.
+
+    :param guest: The guest description parsed by Converter.
+    :param block: The block driver the guest will use, for example
+                  virtio-blk.
+    :returns: A dict mapping the name of each disk in the guest to its new
+              name, both without /dev/. Disks which keep their name, or whose
+              name in the guest isn't known, are not included.
+    '''
+    prefix = _DRIVER_PREFIXES.get(block)
+    if prefix is None:
+        return {}
+
+    table = {}
+    i = 0
+    for controller in guest[u'controllers']:
+        for disk in controller[u'disks']:
+            i += 1
+            new = prefix + disk_name(i)
+            if disk[u'hint'] is not None and disk[u'hint'] != new:
+                table[disk[u'hint']] = new
+    return table
+
+
+def _device_regexp(table):
+    # Match /dev/<disk> and an optional partition number. cciss partitions
+    # are separated from the disk by p.
+    names = sorted(table.iterkeys(), key=len, reverse=True)
+    return re.compile(u'/dev/(' + u'|'.join([re.escape(i) for i in names]) +
+                      u')(p?)([0-9]*)(?![a-z])')
+
+
+def remap_string(table, value, regexp=None):
+    '''Return value with every device in table renamed
+
+    All devices are renamed in a single pass, so a device renamed to the
+    former name of another is not renamed twice.
+
+    :param table: The output of device_table().
+    :param value: A string which may contain /dev/ paths.
+    '''
+    if len(table) == 0:
+        return value
+    if regexp is None:
+        regexp = _device_regexp(table)
+
+    def _remap(m):
+        (disk, separator, partition) = m.groups()
+        if separator != u'' and partition == u'':
+            # Not a cciss partition, so p begins something else
+            return u'/dev/' + table[disk] + separator
+        return u'/dev/' + table[disk] + partition
+
+    return regexp.sub(_remap, value)
+
+
+def remap_devices(h, aug, table, logger):
+    '''Rename the devices in table throughout the guest's configuration
+
+    Every node matching REMAP_PATHS is remapped with remap_string(). The
+    modifications are made through aug, so they are written to the guest
+    with its other modifications in a single aug_save.
+
+    :param h: The libguestfs handle, with augeas initialised.
+    :param aug: An AugeasTransaction.
+    :param table: The output of device_table().
+    :param logger: A logging.Logger.
+    '''
+    if len(table) == 0:
+        return
+
+    regexp = _device_regexp(table)
+    for path in REMAP_PATHS:
+        for node in h.aug_match(path):
+            value = h.aug_get(node)
+            if value is None:
+                continue
+
+            remapped = remap_string(table, value, regexp)
+            if remapped != value:
+                logger.debug(BraceMessage(u'Remapping {}: {} -> {}',
+                                          node, value, remapped))
+                aug.set(node, remapped)
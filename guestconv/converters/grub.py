@@ -25,6 +25,7 @@ from itertools import chain, ifilter, imap
 from guestconv.exception import *
 from guestconv.converters.exception import *
 from guestconv.lang import _
+from guestconv.log import BraceMessage
 from guestconv.converters.util import *
 
 def detect(h, root, converter, logger):
@@ -43,8 +44,8 @@ def detect(h, root, converter, logger):
             try:
                 mp = h.mountpoints()[device + '1']
             except KeyError:
-                logger.debug(u'Detected EFI bootloader with no mountpoint '
-                             u'on disk {}'.format(device))
+                logger.debug(BraceMessage(u'Detected EFI bootloader with no '
+                                          u'mountpoint on disk {}', device))
                 next
 
             for cfg in h.glob_expand(u'{}/EFI/*/grub.*'.format(mp)):
@@ -109,13 +110,14 @@ class GrubBase(object):
         self._cfg = cfg
 
     def installed_on(self, device):
-        if disk == self.device:
-            self._logger.debug(u'Bootloader {} can convert {}'.
-                               format(self.__class__, device))
+        if device == self.device:
+            self._logger.debug(BraceMessage(u'Bootloader {} can convert {}',
+                                            self.__class__, device))
             return True
 
-        self._logger.debug(u"Bootloader {} installed on {} can't convert {}".
-                           format(self.__class__, self.device, device))
+        self._logger.debug(BraceMessage(u"Bootloader {} installed on {} "
+                                        u"can't convert {}",
+                                        self.__class__, self.device, device))
         return False
 
     def get_initrd(self, path):
@@ -256,7 +258,7 @@ class GrubEFI(Grub):
         h.ln_sf(grub_conf, u'/etc/grub.conf')
 
         # Reload to push up grub.conf in its new location
-        h.aug_load()
+        self._converter._aug.load()
 
         h.command([u'grub-install', self.device])
 
@@ -494,14 +496,9 @@ class Grub2EFI(Grub2):
         h.part_set_gpt_type(self.device, 1,
                             u'21686148-6449-6E6F-744E-656564454649')
 
-        # Delete the fstab entry for the EFI boot partition
-        for node in h.aug_match(u"/files/etc/fstab/*[file = '/boot/efi']"):
-            h.aug_rm(node)
-
-        try:
-            h.aug_save()
-        except GuestfsException as ex:
-            augeas_error(h, ex)
+        # Delete the fstab entry for the EFI boot partition. This is saved
+        # with the rest of the conversion's augeas modifications.
+        self._converter._aug.rm(u"/files/etc/fstab/*[file = '/boot/efi']")
 
         GRUB2_BIOS_CFG = u'/boot/grub2/grub.cfg'
 
@@ -0,0 +1,224 @@
+# coding: utf-8
+# guestconv
+#
+# Copyright (C) 2013 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Determine which drivers are available to a guest kernel"""
+
+import os.path
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+from guestconv.log import BraceMessage
+
+# The kernel modules which must be present for a kernel to support a driver
+# option. Modules are listed in load order.
+DRIVERS = {
+    u'virtio-net': (u'virtio_pci', u'virtio_net'),
+    u'virtio-blk': (u'virtio_pci', u'virtio_blk'),
+    u'virtio-serial': (u'virtio_pci', u'virtio_console')
+}
+
+# Driver support which was recently determined in this process, keyed by the
+# same key as the on-host cache, least recently used first
+_drivers = OrderedDict()
+_drivers_lock = threading.Lock()
+MAX_DRIVERS = 64
+
+
+def kernel_version(path):
+    '''Return the version of the kernel at path, or None if path doesn't look
+    like an installed kernel'''
+    m = re.match(ur'vmlinu[xz]-(.+)$', os.path.basename(path))
+    if m is None:
+        return None
+    return m.group(1)
+
+
+def _module_name(path):
+    '''Return the name of the kernel module at path, as understood by
+    modprobe'''
+    name = os.path.basename(path)
+    name = re.sub(ur'\.ko(?:\.(?:gz|xz|zst))?$', u'', name)
+    return name.replace(u'-', u'_')
+
+
+def parse_modules_dep(lines):
+    '''Parse the contents of modules.dep
+
+    :param lines: An iterable of lines from modules.dep
+    :returns: A dict mapping module name to a list of the names of modules it
+              depends on
+
+    '''
+    deps = {}
+    for line in lines:
+        line = line.strip()
+        if line == u'' or line.startswith(u'#'):
+            continue
+
+        (path, sep, requires) = line.partition(u':')
+        if sep == u'':
+            continue
+
+        deps[_module_name(path)] = [_module_name(i) for i in requires.split()]
+    return deps
+
+
+def parse_modules_builtin(lines):
+    '''Parse the contents of modules.builtin
+
+    :param lines: An iterable of lines from modules.builtin
+    :returns: A set containing the names of all modules built in to the kernel
+
+    '''
+    return set([_module_name(i.strip()) for i in lines
+                if i.strip() != u'' and not i.startswith(u'#')])
+
+
+class ModuleIndex(object):
+
+    """A host-side lookup table of the modules available to a guest kernel.
+
+    :version: The kernel version string.
+    :deps: A dict as returned by parse_modules_dep.
+    :builtin: A set as returned by parse_modules_builtin.
+
+    """
+
+    def __init__(self, version, deps, builtin):
+        self.version = version
+        self._deps = deps
+        self._builtin = builtin
+
+    def has_module(self, name):
+        '''Return True if the module can be loaded or is built in'''
+        name = name.replace(u'-', u'_')
+        return name in self._deps or name in self._builtin
+
+    def supports(self, driver):
+        '''Return True if this kernel supports the given driver option'''
+        try:
+            modules = DRIVERS[driver]
+        except KeyError:
+            return False
+        return all(self.has_module(i) for i in modules)
+
+
+def _download_lines(h, path):
+    '''Download path from the guest and return its lines, or None if it
+    doesn't exist'''
+    if not h.is_file(path):
+        return None
+
+    with tempfile.NamedTemporaryFile(prefix=u'guestconv.') as f:
+        h.download(path, f.name)
+        return [unicode(line, u'utf-8', u'replace') for line in f]
+
+
+def get_module_index(h, kernel, logger):
+    '''Return a ModuleIndex for the given kernel path, or None if the kernel
+    has no module tree
+
+    :param h: A libguestfs handle with the guest root mounted.
+    :param kernel: The guest path of a kernel, as returned by iter_kernels().
+    :param logger: A logging.Logger.
+
+    '''
+    version = kernel_version(kernel)
+    if version is None:
+        logger.debug(BraceMessage(u"Can't determine kernel version from {}",
+                                  kernel))
+        return None
+
+    moddir = u'/lib/modules/' + version
+    deps = _download_lines(h, moddir + u'/modules.dep')
+    if deps is None:
+        logger.debug(BraceMessage(u'Kernel {} has no modules.dep', kernel))
+        return None
+
+    # modules.builtin only exists since 2.6.33
+    builtin = _download_lines(h, moddir + u'/modules.builtin') or []
+
+    return ModuleIndex(version, parse_modules_dep(deps),
+                       parse_modules_builtin(builtin))
+
+
+def get_drivers(h, kernel, nevra, logger, cache=None):
+    '''Return the driver options supported by the given kernel
+
+    The result is derived from the kernel's module index, and is cached both
+    in this process, for the MAX_DRIVERS most recently used kernels, and, if
+    given, in an on-host DiskCache. Cache entries are
+    keyed by the NEVRA of the kernel package and the checksum of its
+    modules.dep, so a kernel shared by many guests is only analysed once.
+
+    :param h: A libguestfs handle with the guest root mounted.
+    :param kernel: The guest path of a kernel, as returned by iter_kernels().
+    :param nevra: The NEVRA of the package which installed the kernel, or None
+                  if it is not known.
+    :param logger: A logging.Logger.
+    :param cache: An optional guestconv.cache.DiskCache.
+    :returns: A sorted list of the supported driver options, or None if the
+              kernel has no module tree.
+
+    '''
+    version = kernel_version(kernel)
+    if version is None:
+        logger.debug(BraceMessage(u"Can't determine kernel version from {}",
+                                  kernel))
+        return None
+
+    dep = u'/lib/modules/{}/modules.dep'.format(version)
+    if not h.is_file(dep):
+        logger.debug(BraceMessage(u'Kernel {} has no modules.dep', kernel))
+        return None
+
+    if nevra is None:
+        nevra = version
+    key = u'{} {}'.format(nevra, h.checksum(u'sha256', dep))
+
+    with _drivers_lock:
+        if key in _drivers:
+            drivers = _drivers.pop(key)
+            _drivers[key] = drivers
+            return drivers
+
+    drivers = None
+    if cache is not None:
+        drivers = cache.get(u'kernel-drivers', key)
+
+    if drivers is None:
+        index = get_module_index(h, kernel, logger)
+        if index is None:
+            return None
+
+        drivers = sorted([i for i in DRIVERS if index.supports(i)])
+
+        if cache is not None:
+            cache.put(u'kernel-drivers', key, drivers)
+    else:
+        logger.debug(BraceMessage(u'Using cached driver support for '
+                                  u'kernel {}', nevra))
+
+    with _drivers_lock:
+        _drivers[key] = drivers
+        while len(_drivers) > MAX_DRIVERS:
+            _drivers.popitem(last=False)
+    return drivers
@@ -30,8 +30,12 @@ from guestconv.exception import *
 from guestconv.converters.exception import *
 import guestconv.converters.grub
 from guestconv.converters.base import BaseConverter
+from guestconv.converters.devices import device_table, remap_devices
+from guestconv.converters.kernel import DRIVERS, get_drivers, \
+                                        kernel_version
 from guestconv.converters.util import *
 from guestconv.lang import _
+from guestconv.log import BraceMessage
 
 RHEL_BASED = (u'rhel', u'centos', u'scientificlinux', u'redhat-based')
 
@@ -40,7 +44,7 @@ class Package(object):
     class InvalidEVR(GuestConvException): pass
 
     @classmethod
-    def from_guestfs_app(app):
+    def from_guestfs_app(cls, app):
         return Package(app[u'app2_name'],
                        epoch=str(app[u'app2_epoch']),
                        version=str(app[u'app2_version']),
@@ -201,16 +205,37 @@ class Package(object):
         return self._cmp(other) < 0
 
 
-def _remove_applications(h, pkgs):
+def _remove_applications(h, logger, pkgs):
+    pkgs = list(pkgs)
     try:
-        h.command([u'rpm', u'-e'] + list(pkgs))
+        h.rpm_transaction([u'rpm', u'-e'] + pkgs)
     except GuestFSException as ex:
-        self._logger.warn(_u(u'Failed to remove packages: {pkgs}').
-                          format(u', '.join(pkg_names)))
+        logger.warn(_(u'Failed to remove packages {packages}: {error}').
+                    format(packages=u', '.join(pkgs), error=ex.message))
         return False
     return True
 
 
+def _kernel_nevra(apps, version):
+    '''Return the NEVRA of the package which installed the kernel with the
+    given version, or None if it can't be determined'''
+    if version is None:
+        return None
+
+    for app in apps:
+        name = app[u'app2_name']
+        if not name.startswith(u'kernel'):
+            continue
+
+        # Variant kernels, e.g. kernel-xen, append the variant to the version
+        evr = u'{}-{}'.format(app[u'app2_version'], app[u'app2_release'])
+        variant = name[len(u'kernel'):].lstrip(u'-')
+        if version in (evr, evr + u'.' + app[u'app2_arch'], evr + variant):
+            return str(Package.from_guestfs_app(app))
+
+    return None
+
+
 class Hypervisor(object):
     NONE = 0
     INSTALLED = 1
@@ -233,11 +258,11 @@ class Hypervisor(object):
         else:
             self.status = Hypervisor.NONE
 
-    def remove(self):
+    def remove(self, aug):
         if self.status != Hypervisor.INSTALLED:
             return
         else:
-            self._remove()
+            self._remove(aug)
 
     def install(self):
         if self.status == Hypervisor.INSTALLED:
@@ -254,7 +279,7 @@ class Hypervisor(object):
 
     def _is_installed(self, apps): return False
     def _is_available(self): return True
-    def _remove(self): pass
+    def _remove(self, aug): pass
     def _install(self): pass
 
 
@@ -299,32 +324,24 @@ class HVXenPV(Hypervisor):
     def _is_available(self):
         return _xenpv_is_available(self._h, self._root)
 
-    def _remove(self):
+    def _remove(self, aug):
         h = self._h
 
         if len(self._xen) == 0:
             return
 
-        _remove_applications(h, self._xen)
+        _remove_applications(h, self._logger, self._xen)
 
         # kmod-xenpv modules may have been manually copied to other kernels.
         # Hunt them down and destroy them
 
-        for xenpv in [i for i in h.find(u'/lib/modules')
-                      if i.endswith(u'/xenpv')]:
-            xenpv = u'/lib/modules' + xenpv
-
-            if not h.is_dir(xenpv):
-                continue
-
-            # Check it's not owned by an installed application
-            try:
-                h.command([u'rpm', u'-qf', xenpv])
-                continue
-            except GuestFSException:
-                pass
+        xenpvs = list(find_files(h, u'/lib/modules', u'xenpv', type=u'd'))
 
-            h.rm_rf(xenpv)
+        # Check they're not owned by an installed application
+        owners = h.command_batch([[u'rpm', u'-qf', i] for i in xenpvs])
+        for xenpv, (status, stdout, stderr) in zip(xenpvs, owners):
+            if status != 0:
+                h.rm_rf(xenpv)
 
         # rc.local may contain an insmod or modprobe of the xen-vbd driver
         if not h.is_file(u'/etc/rc.local'):
@@ -332,12 +349,10 @@ class HVXenPV(Hypervisor):
 
         rc_local = h.read_lines(u'/etc/rc.local')
         probe = re.compile(ur'\b(?:insmod|modprobe)\b.*\bxen-vbd\b')
-        rc_local_len = 0
         for i in range(len(rc_local)):
             if probe.search(rc_local[i]):
                 rc_local[i] = u'# ' + rc_local[i]
-            rc_local_len += len(rc_local) + 1
-        h.write_file(u'/etc/rc.local', '\n'.join(rc_local) + '\n', rc_local_len)
+        h.write_file(u'/etc/rc.local', '\n'.join(rc_local) + '\n', 0)
 
 
 class HVVBox(Hypervisor):
@@ -373,16 +388,17 @@ class HVVBox(Hypervisor):
 
         return len(self._vbox_apps) > 0 or self._vbox_uninstall is not None
 
-    def _remove(self):
+    def _remove(self, aug):
         h = self._h
 
         if len(self._vbox_apps) > 0:
-            _remove_applications(h, self._vbox_apps)
+            _remove_applications(h, self._logger, self._vbox_apps)
 
         if self._vbox_uninstall is not None:
             try:
+                aug.save()
                 h.command([self._vbox_uninstall])
-                h.aug_load()
+                aug.load()
             except GuestFSException as ex:
                 self._logger.warn(_(u'VirtualBox Guest Additions '
                                     u'were detected, but '
@@ -418,27 +434,27 @@ class HVVMware(Hypervisor):
                 len(self._vmw_remove) > 0 or
                 len(self._vmw_libs) > 0)
 
-    def _remove(self):
+    def _remove(self, aug):
         h = self._h
 
         for repo in self._vmw_repos:
-            h.aug_set(repo + u'/enabled', 0)
-            try:
-                h.aug_save()
-            except GuestFSException as ex:
-                augeas_error(h, ex)
+            aug.set(repo + u'/enabled', 0)
+
+        # It's important that we save the disabled repos before doing anything
+        # else, or resolvedep might return the same vmware packages we're
+        # trying to get rid of
+        aug.save()
 
         remove = False
 
         if len(self._vmw_libs) > 0:
-            # It's important that we did aug_save() above, or resolvedep might
-            # return the same vmware packages we're trying to get rid of
             libs = self._remove_libs()
         else:
             libs = []
 
         if len(self._vmw_remove) > 0 or len(libs) > 0:
-            _remove_applications(h, chain(self._vmw_remove, libs))
+            _remove_applications(h, self._logger,
+                                 chain(self._vmw_remove, libs))
 
         # VMwareTools may have been installed from tarball, in which case the
         # above won't detect it. Look for the uninstall tool, and run it if
@@ -451,11 +467,11 @@ class HVVMware(Hypervisor):
         if h.is_file(vmwaretools):
             try:
                 h.command([vmwaretools])
-            except GuestfsException as ex:
+            except GuestFSException as ex:
                 self._logger.warn(_(u'VMware Tools was detected, but '
                                     u'uninstallation failed: {error}').
                                   format(error = ex.message))
-            h.aug_load()
+            aug.load()
 
     def _remove_libs(self):
         h = self._h
@@ -476,7 +492,7 @@ class HVVMware(Hypervisor):
                                     # The packages explicitly provide
                                     # themselves.  Filter this out
                                     if name not in i])
-                except GuestfsException as ex:
+                except GuestFSException as ex:
                     self._logger.warn(_(u'Error getting rpm provides for '
                                         u'{package}: {error}').
                                       format(package = nevra,
@@ -492,7 +508,7 @@ class HVVMware(Hypervisor):
                                 h.command_lines(list(chain([u'yum', u'-q',
                                                             u'resolvedep'],
                                                            provides)))])
-                except GuestfsException as ex:
+                except GuestFSException as ex:
                     self._logger.warn(
                         _(u'Error resolving depencies for '
                           u'{packages}: {error}').
@@ -502,8 +518,9 @@ class HVVMware(Hypervisor):
 
                 if len(alts) > 0:
                     try:
-                        h.command(u'yum', u'install', u'-y', list(alts))
-                    except GuestfsException as ex:
+                        h.rpm_transaction([u'yum', u'install', u'-y'] +
+                                          list(alts))
+                    except GuestFSException as ex:
                         self._logger.warn(
                             _(u'Error installing replacement packages for '
                               u'{package} ({replacements}): {error}').
@@ -553,10 +570,10 @@ class HVCitrixPV(Hypervisor):
     def _is_available(self):
         return _xenpv_is_available(self._h, self._root)
 
-    def _remove(self):
+    def _remove(self, aug):
         h = self._h
 
-        _remove_applications(self._citrix_utils)
+        _remove_applications(h, self._logger, self._citrix_utils)
 
         # Installing these guest utilities automatically unconfigures ttys in
         # /etc/inittab if the system uses it. We need to put them back.
@@ -582,12 +599,12 @@ class HVCitrixPV(Hypervisor):
                 continue
 
             # Create a new entry immediately after the comment
-            h.aug_insert(path, name, 0)
+            aug.insert(path, name, 0)
             for field, value in [(u'runlevels', runlevels),
                                  (u'action', u'respawn'),
                                  (u'process', process)]:
-                h.aug_set(u'/files/etc/inittab/{name}/{field}'.
-                          format(name = name, field = field), value)
+                aug.set(u'/files/etc/inittab/{name}/{field}'.
+                        format(name = name, field = field), value)
 
             # Create a variable to point to the comment node so we can delete it
             # later. If we deleted it here it would invalidate subsequent
@@ -598,72 +615,75 @@ class HVCitrixPV(Hypervisor):
 
         # Delete all replaced comments
         for i in range(updated):
-            h.aug_rm(ur'$delete{i}'.format(i=i))
-
-        try:
-            h.aug_save()
-        except GuestfsException as ex:
-            augeas_error(h, ex)
+            aug.rm(ur'$delete{i}'.format(i=i))
 
 
 class RedHat(BaseConverter):
-    def __init__(self, h, root, guest, db, logger):
-        super(RedHat, self).__init__(h, root, guest, db, logger)
+    def __init__(self, h, root, guest, db, logger, cache=None):
+        super(RedHat, self).__init__(h, root, guest, db, logger, cache)
         distro = h.inspect_get_distro(root)
         if (h.inspect_get_type(root) != u'linux' or
             h.inspect_get_distro(root) not in chain([u'fedora'], RHEL_BASED)):
             raise UnsupportedConversion()
 
-    def _get_installed(self, name, arch=None):
-        if arch is None:
-            search = name
-        else:
-            search = u'{}.{}'.format(name, arch)
-
-        rpmcmd = [u'rpm', u'-q', u'--qf',
-                  ur'%{EPOCH} %{VERSION} %{RELEASE} %{ARCH}\n', search]
+    def _get_installed_many(self, searches):
+        '''Return the installed packages matching each of searches, a list of
+        (name, arch) tuples. arch may be None. All searches are made in a
+        single batch of guest commands.'''
+        rpmcmds = []
+        for name, arch in searches:
+            if arch is None:
+                search = name
+            else:
+                search = u'{}.{}'.format(name, arch)
+
+            rpmcmds.append([u'rpm', u'-q', u'--qf',
+                            ur'%{EPOCH} %{VERSION} %{RELEASE} %{ARCH}\n',
+                            search])
+
+        results = []
+        for (name, arch), rpmcmd, (status, stdout, stderr) in \
+                zip(searches, rpmcmds, self._h.command_batch(rpmcmds)):
+            if status != 0:
+                # RPM command returned non-zero. This might be because there
+                # was actually an error, or might just be because the
+                # package isn't installed, which rpm reports on stdout. If
+                # the output contains 'not installed', we'll assume it's not
+                # a real error.
+                if re.search(ur'not installed', stdout):
+                    results.append([])
+                    continue
 
-        try:
-            output = self._h.command_lines(rpmcmd)
-        except GuestFSException:
-            # RPM command returned non-zero. This might be because there was
-            # actually an error, or might just be because the package isn't
-            # installed.
-            # Unfortunately, rpm sent its error to stdout instead of stderr,
-            # and command_lines only gives us stderr in $@. To get round this
-            # we execute the command again, sending all output to stdout and
-            # ignoring failure. If the output contains 'not installed', we'll
-            # assume it's not a real error.
-
-            cmd = (u'LANG=C ' +
-                   u' '.join([u"'"+i+u"'" for i in rpmcmd]) + u' 2>&1 ||:')
-            error = self._h.sh(cmd)
-
-            if re.search(ur'not installed', error):
-                return
-
-            raise ConversionError(
-                _(u'Error running {command} in guest: {msg}').
-                format(command=cmd, msg=error))
-
-        for line in output:
-            m = re.match(ur'(\S+)\s+(\S+)\s+(\S+)\s+(\S+)$', line)
-            if m is None:
                 raise ConversionError(
-                    _(u'Unexpected output from rpm: {output}').
-                    format(output='\n'.join(output)))
-
-            epoch = m.group(1)
-            version = m.group(2)
-            release = m.group(3)
-            arch = m.group(4)
-
-            if epoch == '(none)':
-                epoch = None
-
-            yield Package(name, epoch, version, release, arch)
-
-    def _cap_missing_deps(self, name):
+                    _(u'Error running {command} in guest: {msg}').
+                    format(command=u' '.join(rpmcmd), msg=stdout + stderr))
+
+            installed = []
+            output = stdout.splitlines()
+            for line in output:
+                m = re.match(ur'(\S+)\s+(\S+)\s+(\S+)\s+(\S+)$', line)
+                if m is None:
+                    raise ConversionError(
+                        _(u'Unexpected output from rpm: {output}').
+                        format(output='\n'.join(output)))
+
+                epoch = m.group(1)
+                version = m.group(2)
+                release = m.group(3)
+                arch = m.group(4)
+
+                if epoch == '(none)':
+                    epoch = None
+
+                installed.append(Package(name, epoch, version, release, arch))
+            results.append(installed)
+
+        return results
+
+    def _cap_missing_deps(self, name, ignore=()):
+        '''Return the packages which must be installed or upgraded for this
+        root to have capability name. Packages named in ignore are not
+        checked.'''
         h = self._h
         root = self._root
         db = self._db
@@ -672,22 +692,20 @@ class RedHat(BaseConverter):
         missing = []
         cap = db.match_capability(name, arch, h, root)
         if cap is None:
-            self._logger.debug(u'No {} capability found for this root'.
-                               format(name))
+            self._logger.debug(BraceMessage(u'No {} capability found for '
+                                            u'this root', name))
             return []
 
-        for (pkg, params) in cap.iteritems():
-            try:
-                target = Package(pkg, evr=params[u'minversion'])
-            except Package.InvalidEVR:
-                self._logger.info(_(u'Ignoring invalid minversion for package '
-                                    u'{name} in virtio capability: {version}').
-                                  format(name=pkg,
-                                         version=params[u'minversion']))
-                target = Package(pkg)
+        # Query every package of the capability in one round trip
+        pkgs = [(pkg, params) for (pkg, params) in cap.iteritems()
+                if pkg not in ignore]
+        all_installed = self._get_installed_many([(pkg, None)
+                                                  for (pkg, params) in pkgs])
 
+        for (pkg, params), pkg_installed in zip(pkgs, all_installed):
+            target = self._cap_target(name, pkg, params)
             need = not params[u'ifinstalled']
-            for installed in self._get_installed(pkg):
+            for installed in pkg_installed:
                 if installed < target:
                     need = True
                 if installed >= target:
@@ -698,6 +716,53 @@ class RedHat(BaseConverter):
 
         return missing
 
+    def _cap_target(self, name, pkg, params):
+        # The version of pkg required by capability name
+        try:
+            return Package(pkg, evr=params[u'minversion'])
+        except Package.InvalidEVR:
+            self._logger.info(BraceMessage(
+                _(u'Ignoring invalid minversion for package {name} in '
+                  u'{capability} capability: {version}'),
+                name=pkg, capability=name, version=params[u'minversion']))
+            return Package(pkg)
+
+    def _virtio_support(self):
+        '''Return the virtio drivers this root supports, and the packages
+        which must be installed or upgraded for it to support them all.
+
+        Kernel support comes from the module indexes of the bootable kernels:
+        a driver is supported if any of them has its modules. If none of them
+        could be indexed, package versions are checked instead. Userspace
+        dependencies always come from the virtio capability.'''
+        indexed = [drivers for (kernel, drivers) in self._kernels
+                   if drivers is not None]
+        if len(indexed) == 0:
+            missing = self._cap_missing_deps(u'virtio')
+            if len(missing) > 0:
+                return (set(), missing)
+            return (set(DRIVERS), [])
+
+        missing = self._cap_missing_deps(u'virtio', ignore=(u'kernel',))
+        available = set(chain(*indexed))
+        supported = available if len(missing) == 0 else set()
+
+        unsupported = sorted(set(DRIVERS) - available)
+        if len(unsupported) > 0:
+            self._logger.debug(BraceMessage(u'No bootable kernel supports {}',
+                                            u', '.join(unsupported)))
+            h = self._h
+            cap = self._db.match_capability(u'virtio',
+                                            h.inspect_get_arch(self._root),
+                                            h, self._root)
+            if cap is not None and u'kernel' in cap:
+                missing.append(self._cap_target(u'virtio', u'kernel',
+                                                cap[u'kernel']))
+            else:
+                missing.append(Package(u'kernel'))
+
+        return (supported, missing)
+
     def inspect(self):
         h = self._h
         root = self._root
@@ -726,9 +791,14 @@ class RedHat(BaseConverter):
 
         def _missing_deps(name, missing):
             '''Utility function for reporting missing dependencies'''
-            l = u', '.join([str(i) for i in missing])
-            self._logger.info(_(u'Missing dependencies for {name}: {missing}')
-                              .format(name=name, missing=l))
+            missing = [str(i) for i in missing]
+            self._details[u'missing'][name] = missing
+            self._logger.info(BraceMessage(_(u'Missing dependencies for '
+                                             u'{name}: {missing}'),
+                                           name=name,
+                                           missing=u', '.join(missing)),
+                              extra={u'fields': {u'capability': name,
+                                                 u'missing': missing}})
 
         # Detect supported hypervisors
         self._hypervisors = {}
@@ -739,7 +809,16 @@ class RedHat(BaseConverter):
                       HVVMware,
                       HVCitrixFV, HVCitrixPV]:
             hv = klass(h, root, self._logger, apps)
-            if hv.is_available():
+            available = hv.is_available()
+            self._logger.debug(BraceMessage(u'Hypervisor {} available: {}',
+                                            hv.key, available),
+                               extra={u'fields': {u'hypervisor': hv.key,
+                                                  u'available': available}})
+            if hv.status == Hypervisor.INSTALLED:
+                self._details[u'hypervisors'][hv.key] = u'installed'
+            elif available:
+                self._details[u'hypervisors'][hv.key] = u'available'
+            if available:
                 self._hypervisors[hv.key] = klass
                 drivers[u'hypervisor'].append((hv.key, hv.description))
 
@@ -752,26 +831,8 @@ class RedHat(BaseConverter):
             else:
                 _missing_deps(driver, deps)
 
-        # Detect VirtIO
-        virtio_deps = self._cap_missing_deps(u'virtio')
-        if len(virtio_deps) == 0:
-            drivers[u'network'].append((u'virtio-net', u'VirtIO'))
-            drivers[u'block'].append((u'virtio-blk', u'VirtIO'))
-            drivers[u'console'].append((u'virtio-serial', _(u'VirtIO Serial')))
-        else:
-            _missing_deps(u'virtio', virtio_deps)
-
         # Info section of inspection
-        info = {
-            u'hostname': h.inspect_get_hostname(root),
-            u'os': h.inspect_get_type(root),
-            u'distribution': h.inspect_get_distro(root),
-            u'arch': h.inspect_get_arch(root),
-            u'version': {
-                u'major': h.inspect_get_major_version(root),
-                u'minor': h.inspect_get_minor_version(root)
-            }
-        }
+        info = self.inspect_info()
 
         try:
             self._bootloader = guestconv.converters.grub.detect(
@@ -780,6 +841,26 @@ class RedHat(BaseConverter):
             raise ConversionError(_(u"Didn't detect a bootloader for root "
                                     u'{root}').format(root=self._root))
 
+        # Determine the drivers available to every bootable kernel
+        self._kernels = []
+        for kernel in self._bootloader.iter_kernels():
+            nevra = _kernel_nevra(apps, kernel_version(kernel))
+            self._kernels.append((kernel, get_drivers(h, kernel, nevra,
+                                                      self._logger,
+                                                      self._cache)))
+
+        # Detect VirtIO
+        virtio = [(u'network', u'virtio-net', u'VirtIO'),
+                  (u'block', u'virtio-blk', u'VirtIO'),
+                  (u'console', u'virtio-serial', _(u'VirtIO Serial'))]
+
+        (supported, virtio_deps) = self._virtio_support()
+        for option, driver, desc in virtio:
+            if driver in supported:
+                drivers[option].append((driver, desc))
+        if len(virtio_deps) > 0:
+            _missing_deps(u'virtio', virtio_deps)
+
         # Persist detected driver support for later sanity checking
         self._drivers = {}
         for driver in drivers:
@@ -795,3 +876,9 @@ class RedHat(BaseConverter):
     def convert(self, bootloaders, options):
         self._logger.info(_(u'Converting root %(name)s') %
                           {u'name': self._root})
+
+        # Disks are renamed if their driver changes
+        block = options.get(u'block')
+        if block is not None:
+            remap_devices(self._h, self._aug,
+                          device_table(self._guest, block), self._logger)
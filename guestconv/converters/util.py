@@ -19,14 +19,36 @@
 
 """Internal functions useful to more than 1 converter"""
 
-__all__ = [u'augeas_error', u'Network']
+__all__ = [u'augeas_error', u'AugeasTransaction', u'FileCache',
+           u'ChangeJournal', u'UndoJournal', u'selinux_relabel',
+           u'find_files', u'CONFIG_SNAPSHOT', u'Network']
 
+import fnmatch
+import os.path
+import pipes
 import re
+import shutil
+import stat
+import sys
+import tarfile
+import tempfile
+from contextlib import contextmanager
 
 from guestconv.exception import *
 from guestconv.converters.exception import *
+from guestconv.lang import _
+from guestconv.log import BraceMessage
 
-def augeas_error(h, ex):
+def augeas_error(h, ex, ops=()):
+    """Raise a ConversionError describing the augeas error ex
+
+    :param h: The libguestfs handle.
+    :param ex: The exception raised by aug_save.
+    :param ops: A list of (nodes, description) tuples describing the
+                modifications which were being saved. Any modification of a
+                file which failed to save is included in the error.
+
+    """
     msg = [str(ex)]
     try:
         for error in h.aug_match(u'/augeas/files//error'):
@@ -53,19 +75,817 @@ def augeas_error(h, ex):
             if u'lens' in detail:
                 msg.append(_(u'augeas lens: {lens}').\
                            format(lens=detail[u'lens']))
+
+            node = u'/files' + file_path
+            for nodes, description in ops:
+                if any(i == node or i.startswith(node + u'/') for i in nodes):
+                    msg.append(_(u'caused by: {operation}').\
+                               format(operation=description))
     except GuestFSException as new:
         raise ConversionError(
             _(u'error generating augeas error: {error}').
                 format(error=new.message) + u'\n' +
             _(u'original error: {error}').format(error=ex.message))
 
-    msg = msg.strip()
-
     if len(msg) > 1:
         raise ConversionError(u'\n'.join(msg))
 
     raise ex
 
+
+class AugeasTransaction(object):
+    '''Batch augeas modifications so each modified file is written once
+
+    Modifications are made to the augeas tree immediately, so subsequent
+    aug_get and aug_match calls see them, but nothing is written to the guest
+    until save() is called. Every modification is recorded, so that if saving
+    fails the error can refer to the operation which caused it.
+
+    Code which needs the guest's files to be up to date, for example before
+    running a command in the guest, must call save() first.
+    '''
+
+    def __init__(self, h):
+        self._h = h
+        self._ops = []
+
+    def set(self, path, value):
+        self._h.aug_set(path, value)
+        self._ops.append(([path], u'aug_set {} = {}'.format(path, value)))
+
+    def rm(self, path):
+        # Resolve path now, as it may be a variable or an expression which
+        # won't match anything after it has been removed
+        nodes = self._h.aug_match(path)
+        self._h.aug_rm(path)
+        self._ops.append((nodes, u'aug_rm {}'.format(path)))
+
+    def insert(self, path, label, before):
+        self._h.aug_insert(path, label, before)
+        self._ops.append(([path], u'aug_insert {} {} {}'.
+                          format(label, u'before' if before else u'after',
+                                 path)))
+
+    def save(self):
+        '''Write all pending modifications to the guest'''
+        if len(self._ops) == 0:
+            return
+
+        ops = self._ops
+        self._ops = []
+        try:
+            self._h.aug_save()
+        except GuestFSException as ex:
+            augeas_error(self._h, ex, ops)
+
+    def load(self):
+        '''Save pending modifications, then reload the augeas tree from the
+        guest'''
+        self.save()
+        self._h.aug_load()
+
+    def discard(self):
+        '''Abandon pending modifications, and reload the augeas tree from
+        the guest'''
+        self._ops = []
+        self._h.aug_load()
+
+    @contextmanager
+    def phase(self):
+        '''Execute a block of code, saving its modifications if it
+        succeeds, and discarding them if it fails'''
+        try:
+            yield self
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self.discard()
+            except GuestFSException:
+                # The original error is more useful
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.save()
+
+
+class FileCache(object):
+    '''A libguestfs handle which caches the contents of guest files
+
+    FileCache wraps a libguestfs handle, and can be used in its place. The
+    results of read_file, read_lines, is_file and is_file_opts are cached
+    until the next call which might modify a guest filesystem, for example
+    write_file, mv, rm, command or aug_save, which invalidates the whole cache.
+    Mounting or unmounting filesystems also invalidates the cache, so it never
+    lives longer than a single mount session.
+
+    The number of cached calls served from the cache, and from the guest,
+    are counted in hits and misses.
+
+    The cache can optionally be pre-populated with snapshot(), which fetches
+    selected files from the guest in a single compressed transfer per
+    directory.
+
+    FileCache also provides command_batch(), which runs several guest
+    commands in a single round trip to the appliance.
+    '''
+
+    # Calls which can't modify a guest filesystem
+    _QUERY_PREFIXES = (u'inspect_', u'is_', u'get_', u'list_', u'part_get_',
+                       u'blockdev_get', u'read', u'stat', u'lstat', u'vfs_')
+    _QUERIES = frozenset([
+        u'aug_get', u'aug_match', u'aug_set', u'aug_rm', u'aug_insert',
+        u'aug_defvar', u'aug_defnode', u'aug_load', u'aug_init', u'aug_ls',
+        u'aug_label', u'aug_mv', u'aug_setm', u'aug_clear',
+        u'exists', u'glob_expand', u'find', u'find0', u'ls', u'll', u'cat',
+        u'checksum', u'download', u'filesize', u'file', u'mountpoints',
+        u'mounts', u'realpath', u'case_sensitive_path', u'tar_out',
+        u'copy_out'
+    ])
+
+    def __init__(self, h, logger):
+        self._h = h
+        self._logger = logger
+        self._cache = {}
+        self._snapshot = {}
+        self._snapshot_roots = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._h, name)
+        if not callable(attr) or self._is_query(name):
+            return attr
+
+        def _invalidating(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                if not self._is_query_command(name, args):
+                    self.invalidate()
+
+        return _invalidating
+
+    def _is_query(self, name):
+        return name in self._QUERIES or name.startswith(self._QUERY_PREFIXES)
+
+    @staticmethod
+    def _is_query_command(name, args):
+        # rpm queries are the only guest commands we know to be read-only
+        if len(args) == 0:
+            return False
+        if name == u'command_batch':
+            return all([FileCache._is_query_command(u'command', (argv,))
+                        for argv in args[0]])
+        if name not in (u'command', u'command_lines'):
+            return False
+        argv = args[0]
+        return (len(argv) > 1 and argv[0] == u'rpm' and
+                argv[1].startswith(u'-q'))
+
+    def command_batch(self, commands):
+        '''Run several guest commands in a single appliance round trip
+
+        The commands are run in order by one shell script in the guest, with
+        LC_ALL=C so their output can be parsed. Unlike command(), a command
+        which fails does not raise an error, and does not prevent the
+        following commands from running.
+
+        :param commands: A list of argv lists.
+        :returns: A list of (status, stdout, stderr) tuples, one for each
+                  command. status is the command's exit status.
+        '''
+        if len(commands) == 0:
+            return []
+
+        # Each command's output is captured, then written to stdout after a
+        # header giving its exit status and the lengths of its output
+        script = [u'LC_ALL=C; export LC_ALL',
+                  u'd=$(mktemp -d) || exit 1',
+                  u"trap 'rm -rf \"$d\"' EXIT"]
+        for argv in commands:
+            script.append(u' '.join([pipes.quote(i) for i in argv]) +
+                          u' </dev/null >"$d/out" 2>"$d/err"')
+            script.append(u'echo $? $(wc -c <"$d/out") $(wc -c <"$d/err")')
+            script.append(u'cat "$d/out" "$d/err"')
+        script.append(u'exit 0')
+
+        try:
+            output = self._h.sh(u'\n'.join(script))
+        finally:
+            if not self._is_query_command(u'command_batch', (commands,)):
+                self.invalidate()
+
+        return _parse_batch(output, len(commands))
+
+    def _cached(self, name, args, kwargs):
+        key = (name, args, tuple(sorted(kwargs.items())))
+        try:
+            value = self._cache[key]
+            self.hits += 1
+        except KeyError:
+            value = self._from_snapshot(name, args, kwargs)
+            if value is None:
+                self.misses += 1
+                value = getattr(self._h, name)(*args, **kwargs)
+            else:
+                self.hits += 1
+            self._cache[key] = value
+
+        # Callers may modify the returned list
+        if isinstance(value, list):
+            return list(value)
+        return value
+
+    def read_file(self, *args, **kwargs):
+        return self._cached(u'read_file', args, kwargs)
+
+    def read_lines(self, *args, **kwargs):
+        return self._cached(u'read_lines', args, kwargs)
+
+    def is_file(self, *args, **kwargs):
+        return self._cached(u'is_file', args, kwargs)
+
+    def is_file_opts(self, *args, **kwargs):
+        return self._cached(u'is_file_opts', args, kwargs)
+
+    def invalidate(self):
+        '''Discard all cached data'''
+        self._cache = {}
+        self._snapshot = {}
+        self._snapshot_roots = {}
+
+    def snapshot(self, trees, max_file_size=1024*1024):
+        '''Fetch selected files from the guest into the cache
+
+        The entries of each directory whose names match its patterns, with
+        everything below them, are fetched with a single compressed tar_out.
+        They are subsequently served from memory until the cache is
+        invalidated, as are negative results for matching paths which don't
+        exist. Other paths are read from the guest as normal.
+
+        :param trees: A list of (directory, patterns) tuples. patterns is a
+                      list of glob patterns matching names in directory.
+        :param max_file_size: The contents of files larger than this are not
+                              stored. They are read from the guest as normal.
+
+        '''
+        for directory, patterns in trees:
+            try:
+                names = self._h.ls(directory)
+            except GuestFSException:
+                # It doesn't exist, or isn't a directory
+                continue
+
+            included = [i for i in names
+                        if any(fnmatch.fnmatchcase(i, x) for x in patterns)]
+            self._snapshot[directory] = (u'dir', None)
+            self._snapshot_roots[directory] = patterns
+            if len(included) == 0:
+                continue
+
+            # Member names start with ./, which anchors the excludes
+            excludes = [u'./' + _glob_escape(i) for i in names
+                        if i not in included]
+            with tempfile.NamedTemporaryFile(prefix=u'guestconv.') as f:
+                self._h.tar_out(directory, f.name, compress=u'gzip',
+                                excludes=excludes)
+                tar = tarfile.open(f.name, u'r:gz')
+                try:
+                    for member in tar:
+                        path = os.path.normpath(os.path.join(directory,
+                                                             member.name))
+                        if member.issym():
+                            entry = (u'link', member.linkname)
+                        elif member.isfile() or member.islnk():
+                            data = None
+                            if member.size <= max_file_size:
+                                data = tar.extractfile(member).read()
+                            entry = (u'file', data)
+                        elif member.isdir():
+                            entry = (u'dir', None)
+                        else:
+                            entry = (u'other', None)
+                        self._snapshot[path] = entry
+                finally:
+                    tar.close()
+
+            self._logger.debug(BraceMessage(u'Snapshot of {} contains {}',
+                                            directory, u', '.join(included)))
+
+    def _snapshot_root(self, path):
+        # The snapshot directory which can say whether path exists
+        for root, patterns in self._snapshot_roots.iteritems():
+            if path == root:
+                return root
+            if not path.startswith(root + u'/'):
+                continue
+
+            name = path[len(root) + 1:].split(u'/')[0]
+            if any(fnmatch.fnmatchcase(name, x) for x in patterns):
+                return root
+        return None
+
+    def _snapshot_lookup(self, path, follow):
+        '''Return (found, entry) for path. found is False if the snapshot
+        can't say anything about path. entry is None if path doesn't exist.'''
+        for i in range(40):
+            root = self._snapshot_root(path)
+            if root is None:
+                return (False, None)
+
+            entry = self._snapshot.get(path)
+            if entry is None:
+                # If path traverses a symlink, we can't say it doesn't exist
+                parent = os.path.dirname(path)
+                while parent != root and len(parent) > len(root):
+                    if self._snapshot.get(parent, (None,))[0] == u'link':
+                        return (False, None)
+                    parent = os.path.dirname(parent)
+                return (True, None)
+
+            if entry[0] != u'link' or not follow:
+                return (True, entry)
+
+            path = os.path.normpath(os.path.join(os.path.dirname(path),
+                                                 entry[1]))
+
+        # Symlink loop
+        return (False, None)
+
+    def _from_snapshot(self, name, args, kwargs):
+        '''Return the result of a cached call from the snapshot, or None if
+        the snapshot can't answer it'''
+        if len(self._snapshot_roots) == 0 or len(args) != 1:
+            return None
+
+        path = os.path.normpath(args[0])
+        if name in (u'is_file', u'is_file_opts'):
+            follow = kwargs.get(u'followsymlinks', False)
+        else:
+            follow = True
+
+        (found, entry) = self._snapshot_lookup(path, follow)
+        if not found:
+            return None
+
+        if name in (u'is_file', u'is_file_opts'):
+            return entry is not None and entry[0] == u'file'
+
+        # Let the appliance generate errors and read large files
+        if entry is None or entry[0] != u'file' or entry[1] is None:
+            return None
+
+        data = entry[1]
+        if name == u'read_file':
+            return data
+
+        lines = data.split('\n')
+        if len(lines) > 0 and lines[-1] == '':
+            lines.pop()
+        return [i[:-1] if i.endswith('\r') else i for i in lines]
+
+    def hit_ratio(self):
+        '''Return the proportion of cached calls served from the cache, or
+        None if there have been none'''
+        total = self.hits + self.misses
+        if total == 0:
+            return None
+        return float(self.hits) / total
+
+
+def _parse_batch(output, count):
+    # Parse the output of a FileCache.command_batch() script
+    results = []
+    pos = 0
+    for i in range(count):
+        end = output.find('\n', pos)
+        header = output[pos:end].split() if end != -1 else []
+        if len(header) != 3:
+            raise ConversionError(_(u'Unexpected output from batched guest '
+                                    u'commands: {output}').
+                                  format(output=output[pos:]))
+        (status, out_len, err_len) = [int(i) for i in header]
+
+        pos = end + 1
+        stdout = output[pos:pos + out_len]
+        pos += out_len
+        stderr = output[pos:pos + err_len]
+        pos += err_len
+        results.append((status, stdout, stderr))
+    return results
+
+
+# Configuration read by inspection and conversion, for FileCache.snapshot()
+CONFIG_SNAPSHOT = [
+    (u'/etc', [u'fstab', u'grub.conf', u'inittab', u'modprobe.conf',
+               u'rc.local']),
+    (u'/etc/default', [u'grub']),
+    (u'/etc/sysconfig', [u'grub', u'kernel']),
+    (u'/etc/selinux', [u'config']),
+    (u'/etc/yum.repos.d', [u'*.repo']),
+    (u'/boot/grub', [u'grub.conf', u'menu.lst', u'device.map']),
+    (u'/boot/grub2', [u'grub.cfg', u'grubenv', u'device.map']),
+    (u'/var/lib/VBoxGuestAdditions', [u'config'])
+]
+
+class ChangeJournal(object):
+    '''A libguestfs handle which records the guest paths it modifies
+
+    ChangeJournal wraps a libguestfs handle, and can be used in its place.
+    Every path created or written through the handle, including files saved
+    by augeas, is added to paths. Removed paths are not recorded.
+
+    A guest command may modify any file. Unless it is an rpm query, running
+    one sets complete to False, meaning paths may not include every modified
+    file. Callers which know what a command modified can record it with
+    record(). Packages should be installed or removed with rpm_transaction(),
+    which records the files it installs.
+    '''
+
+    # Calls which modify a guest path, and the index of the path argument
+    _WRITES = {
+        u'write': 0, u'write_append': 0, u'write_file': 0, u'touch': 0,
+        u'mkdir': 0, u'mkdir_p': 0, u'mkdir_mode': 0, u'mknod': 3,
+        u'mkfifo': 1, u'upload': 1, u'upload_offset': 1, u'tar_in': 1,
+        u'tgz_in': 1, u'txz_in': 1, u'cp': 1, u'cp_a': 1, u'cp_r': 1,
+        u'mv': 1, u'rename': 1, u'ln': 1, u'ln_f': 1, u'ln_s': 1,
+        u'ln_sf': 1, u'copy_in': 1
+    }
+
+    # Calls which run guest commands
+    _COMMANDS = frozenset([u'command', u'command_lines', u'sh', u'sh_lines',
+                           u'command_batch'])
+
+    def __init__(self, h):
+        self._h = h
+        self.clear()
+
+    def __getattr__(self, name):
+        attr = getattr(self._h, name)
+        if name in self._WRITES:
+            index = self._WRITES[name]
+
+            def _recording(*args, **kwargs):
+                ret = attr(*args, **kwargs)
+                if len(args) > index:
+                    self.record(args[index])
+                return ret
+
+            return _recording
+
+        if name in self._COMMANDS:
+            def _command(*args, **kwargs):
+                if not FileCache._is_query_command(name, args):
+                    self.complete = False
+                return attr(*args, **kwargs)
+
+            return _command
+
+        return attr
+
+    def aug_save(self):
+        self._h.aug_save()
+        self.record(*self._aug_saved())
+
+    def _aug_saved(self):
+        # augeas lists the files written by the last save
+        h = self._h
+        paths = []
+        for event in h.aug_match(u'/augeas/events/saved'):
+            path = h.aug_get(event)
+            if path.startswith(u'/files/'):
+                paths.append(path[len(u'/files'):])
+        return paths
+
+    def rpm_transaction(self, argv):
+        '''Run a guest command which installs, upgrades or removes packages
+
+        The files of every package installed or upgraded by the command are
+        recorded, without setting complete to False. Files left behind by
+        removed packages were renamed, or not touched, by rpm, so keep their
+        labels. Changes made by package scriptlets are not recorded.
+
+        :param argv: The command, e.g. [u'rpm', u'-e', <package>].
+        :returns: The output of the command.
+        '''
+        h = self._h
+        query = [u'rpm', u'-qa',
+                 u'--qf', u'%{NAME}-%{VERSION}-%{RELEASE}.%{ARCH}\\n']
+        before = set(h.command_lines(query))
+        try:
+            return h.command(argv)
+        finally:
+            # A failed transaction may still have installed packages
+            installed = sorted(set(h.command_lines(query)) - before)
+            if len(installed) > 0:
+                self.record(*[path for path in
+                              h.command_lines([u'rpm', u'-ql'] + installed)
+                              if path.startswith(u'/')])
+
+    def record(self, *paths):
+        '''Record that paths were modified'''
+        self.paths.update(paths)
+
+    def clear(self):
+        '''Forget all recorded modifications'''
+        self.paths = set()
+        self.complete = True
+
+
+class UndoJournal(ChangeJournal):
+    '''A ChangeJournal which can restore the guest paths it modifies
+
+    Before a path is first modified or removed through the handle, its prior
+    contents, mode, ownership and SELinux label are saved on the host, or it
+    is noted that it didn't exist. The contents of a directory are only
+    saved if it is removed or moved. Files saved by augeas are saved before
+    they are written. Partition attributes are saved before they are first
+    changed.
+
+    undo() restores everything saved since the last clear(), most recent
+    first, without copying anything else. Changes made by guest commands,
+    including package transactions, can't be undone: if any were run,
+    undo() restores only the changes made directly through the handle.
+    '''
+
+    # Calls which remove a guest path, and the index of the path argument
+    _REMOVES = {
+        u'rm': 0, u'rm_f': 0, u'rm_rf': 0, u'rmdir': 0, u'mv': 0,
+        u'rename': 0
+    }
+
+    # Calls which change a partition attribute, and the call which reads it
+    _PARTITIONS = {
+        u'part_set_gpt_type': u'part_get_gpt_type',
+        u'part_set_name': u'part_get_name',
+        u'part_set_bootable': u'part_get_bootable',
+        u'part_set_mbr_id': u'part_get_mbr_id'
+    }
+
+    def __init__(self, h):
+        self._dir = None
+        self._xattrs = None
+        ChangeJournal.__init__(self, h)
+
+    def __getattr__(self, name):
+        attr = ChangeJournal.__getattr__(self, name)
+
+        if name in self._WRITES or name in self._REMOVES:
+            written = self._WRITES.get(name)
+            removed = self._REMOVES.get(name)
+
+            def _saving(*args, **kwargs):
+                if removed is not None and len(args) > removed:
+                    self._save(args[removed], True)
+                if written is not None and len(args) > written:
+                    self._save(args[written], False)
+                return attr(*args, **kwargs)
+
+            return _saving
+
+        if name in self._PARTITIONS:
+            getter = self._PARTITIONS[name]
+
+            def _saving_partition(device, partnum, *args, **kwargs):
+                key = (name, device, partnum)
+                if key not in self._saved:
+                    self._saved[key] = True
+                    old = getattr(self._h, getter)(device, partnum)
+                    self._entries.append((u'partition', key, old))
+                return attr(device, partnum, *args, **kwargs)
+
+            return _saving_partition
+
+        return attr
+
+    def rpm_transaction(self, argv):
+        self._transacted = True
+        return ChangeJournal.rpm_transaction(self, argv)
+
+    def aug_save(self):
+        h = self._h
+
+        # In noop mode augeas reports the files it would write
+        mode = h.aug_get(u'/augeas/save')
+        h.aug_set(u'/augeas/save', u'noop')
+        try:
+            h.aug_save()
+            paths = self._aug_saved()
+        finally:
+            h.aug_set(u'/augeas/save', mode)
+
+        for path in paths:
+            self._save(path, False)
+        ChangeJournal.aug_save(self)
+
+    def _host_path(self):
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix=u'guestconv.undo.')
+        return os.path.join(self._dir, unicode(len(self._entries)))
+
+    def _save(self, path, removing):
+        # _saved is True for a path if its contents have been saved
+        path = os.path.normpath(path)
+        if self._saved.get(path, False) or \
+           (path in self._saved and not removing):
+            return
+
+        h = self._h
+        if not h.is_symlink(path) and not h.exists(path):
+            self._saved[path] = True
+            self._entries.append((u'absent', path))
+            return
+
+        st = h.lstat(path)
+        meta = (st[u'mode'], st[u'uid'], st[u'gid'], self._label(path))
+        if stat.S_ISLNK(st[u'mode']):
+            entry = (u'link', path, meta, h.readlink(path))
+        elif stat.S_ISREG(st[u'mode']):
+            saved = self._host_path()
+            h.download(path, saved)
+            entry = (u'file', path, meta, saved)
+        elif stat.S_ISDIR(st[u'mode']) and removing:
+            saved = self._host_path()
+            h.tar_out(path, saved)
+            entry = (u'dir', path, meta, saved)
+        else:
+            entry = (u'meta', path, meta, None)
+        self._saved[path] = entry[0] != u'meta'
+        self._entries.append(entry)
+
+    def _label(self, path):
+        # The SELinux label of path, or None if it can't be read
+        h = self._h
+        if self._xattrs is None:
+            self._xattrs = h.feature_available([u'linuxxattrs'])
+        if not self._xattrs:
+            return None
+        try:
+            return h.lgetxattr(path, u'security.selinux')
+        except GuestFSException:
+            return None
+
+    def _restore_label(self, path, label):
+        if label is None:
+            self.record(path)
+        else:
+            self._h.lsetxattr(u'security.selinux', label, len(label), path)
+
+    def undo(self):
+        '''Restore everything saved since the last clear()
+
+        Restored paths keep their saved SELinux labels. Afterwards, paths
+        holds only the restored paths whose labels could not be restored,
+        including the contents of restored directories, which must be
+        relabelled.
+
+        :returns: False if the guest was modified by a guest command or
+                  package transaction, whose changes were not undone
+        '''
+        h = self._h
+        self.paths = set()
+        for entry in reversed(self._entries):
+            if entry[0] == u'partition':
+                ((setter, device, partnum), old) = entry[1:]
+                getattr(h, setter)(device, partnum, old)
+                continue
+
+            (kind, path) = entry[0:2]
+            if kind == u'absent':
+                h.rm_rf(path)
+                continue
+
+            ((mode, uid, gid, label), saved) = entry[2:]
+            if kind == u'link':
+                h.rm_rf(path)
+                h.ln_s(saved, path)
+                h.lchown(uid, gid, path)
+                self._restore_label(path, label)
+                continue
+
+            if kind == u'file':
+                h.rm_rf(path)
+                h.upload(saved, path)
+            elif kind == u'dir':
+                h.rm_rf(path)
+                h.mkdir(path)
+                h.tar_in(saved, path)
+            elif not h.exists(path):
+                # Only a directory's metadata was saved
+                h.mkdir_p(path)
+            h.chmod(stat.S_IMODE(mode), path)
+            h.chown(uid, gid, path)
+            if kind == u'dir':
+                # The directory's contents are unlabelled
+                self.record(path)
+            else:
+                self._restore_label(path, label)
+
+        undone = self.complete and not self._transacted
+        self._discard()
+        return undone
+
+    def clear(self):
+        ChangeJournal.clear(self)
+        self._discard()
+
+    def _discard(self):
+        self._entries = []
+        self._saved = {}
+        self._transacted = False
+        if self._dir is not None:
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+
+def selinux_relabel(h, logger, autorelabel=True):
+    '''Restore the SELinux labels of the paths modified in a guest
+
+    If the guest uses SELinux, each path recorded by h is relabelled according
+    to the guest's file contexts. If h may not have recorded every modified
+    path, or the guest's policy can't be applied from the appliance, the
+    whole guest is relabelled on its next boot instead.
+
+    If autorelabel is False, the guest is never relabelled on boot: only the
+    recorded paths are relabelled, and a warning is logged if they can't be.
+
+    :param h: A ChangeJournal, with the guest mounted.
+    :param logger: A logging.Logger.
+    :param autorelabel: Whether the whole guest may be relabelled on boot.
+    '''
+    config = u'/etc/selinux/config'
+    if not h.is_file(config):
+        return
+
+    settings = {}
+    for line in h.read_lines(config):
+        m = re.match(u'^\s*(SELINUX(?:TYPE)?)\s*=\s*(\S+)', line)
+        if m:
+            settings[m.group(1)] = m.group(2)
+
+    if settings.get(u'SELINUX', u'disabled') == u'disabled':
+        return
+
+    specfile = u'/etc/selinux/{}/contexts/files/file_contexts'.format(
+        settings.get(u'SELINUXTYPE', u'targeted'))
+    relabel = h.is_file(specfile) and \
+              h.feature_available([u'selinuxrelabel'])
+    if not autorelabel:
+        if not relabel and len(h.paths) > 0:
+            logger.warn(_(u'Failed to restore the SELinux labels of: '
+                          u'{paths}').
+                        format(paths=u', '.join(sorted(h.paths))))
+            return
+    elif not relabel or not h.complete:
+        logger.info(_(u'SELinux labels will be restored when the guest is '
+                      u'next booted'))
+        h.touch(u'/.autorelabel')
+        return
+
+    for path in sorted(h.paths):
+        if h.exists(path):
+            logger.debug(BraceMessage(u'Restoring SELinux label of {}', path))
+            h.selinux_relabel(specfile, path, force=True)
+
+
+def _glob_escape(path):
+    # Match path literally in a glob pattern
+    return re.sub(u'([][*?{}\\\\])', u'\\\\\\1', path)
+
+
+def find_files(h, directory, name, type=None, mindepth=1, maxdepth=4):
+    '''Search a guest directory tree for paths with a matching name
+
+    Unlike h.find(), the search is bounded by depth, and only matching paths
+    are returned by the appliance: each depth is searched by a single
+    h.glob_expand(). Matches are yielded as each depth is searched, so the
+    caller may stop early. Like a shell glob, wildcards in name don't match
+    a leading dot.
+
+    :param h: A libguestfs handle, with the guest mounted.
+    :param directory: The directory to search.
+    :param name: A glob pattern matching the base name of a path.
+    :param type: u'd' to match only directories, u'f' only regular files, or
+                 None to match anything.
+    :param mindepth: The shallowest depth to search. Entries of directory
+                     have depth 1.
+    :param maxdepth: The deepest depth to search.
+    '''
+    if type not in (None, u'd', u'f'):
+        raise ValueError(u'Invalid type: {}'.format(type))
+
+    prefix = _glob_escape(directory.rstrip(u'/'))
+    for depth in range(mindepth, maxdepth + 1):
+        pattern = u'/'.join([prefix] + [u'*'] * (depth - 1) + [name])
+
+        # glob_expand marks directories with a trailing /
+        if type == u'd':
+            pattern += u'/'
+        for path in h.glob_expand(pattern):
+            if type == u'f' and (path.endswith(u'/') or not h.is_file(path)):
+                continue
+            yield path.rstrip(u'/')
+
+
 resolv = u'/etc/resolv.conf'
 resolv_bak = u'/etc/resolv.conf.v2vtmp'
 class Network(object):
@@ -78,7 +898,7 @@ class Network(object):
         h = self._h
 
         # Backup: don't care if it's a file
-        self._resolv_bak = h.exists(resolv_bak)
+        self._resolv_bak = h.exists(resolv)
 
         if self._resolv_bak:
             h.mv(resolv, resolv_bak)
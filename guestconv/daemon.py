@@ -0,0 +1,433 @@
+# coding: utf-8
+# guestconv
+#
+# Copyright (C) 2013 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""A long-running conversion service listening on a local socket.
+
+The daemon keeps the python interpreter and the parsed conversion database
+resident, so a job starts without the cost of either. Run it with:
+
+    python -m guestconv.daemon --socket /run/guestconv.sock \\
+                               --db /etc/guestconv.db
+
+Clients connect to the Unix socket and send requests, each a single line
+containing a JSON object. Each request receives a single line of JSON in
+response, except logs, which receives one line per log record. Any number of
+requests may be sent over one connection. The requests are:
+
+* {"op": "inspect", "guest": <guest XML>, "readonly": <boolean>,
+   "structured": <boolean>}
+  Start inspecting a guest. Returns {"job": <id>}. If readonly is true, the
+  guest is inspected without modifying its disks, but it can't be converted
+  by the job. If structured is true, the result of the job is the JSON form
+  of the inspection described by guestconv.Converter.inspect(), rather than
+  XML.
+* {"op": "convert", "job": <inspect job id>, "desc": <conversion>}
+  Start converting a guest which has been inspected. desc is either XML or
+  the JSON form of the inspection. Returns {"job": <id>}.
+* {"op": "status", "job": <id>}
+  Returns {"job": <id>, "state": <state>}, where state is one of pending,
+  running, done or failed. Also contains result if the job is done, or error
+  if it failed.
+* {"op": "logs", "job": <id>, "follow": <boolean>}
+  Returns each log record of the job, formatted by guestconv.log
+  .JSONFormatter, as {"log": <record>}. If follow is true, records are sent
+  as they are logged until the job completes. The last line is the response
+  to status. Only the last MAX_RECORDS records of a job are kept.
+* {"op": "cancel", "job": <id>}
+  Cancel a job, killing its appliance. Returns the response to status.
+* {"op": "release", "job": <id>}
+  Forget a job, and the guest it inspected. Returns {}.
+
+A guest's appliance runs from the start of its inspect job until it is
+released or cancelled, and the guest counts against the limiter until then.
+Clients must release guests they no longer need.
+
+If a request fails, the response is {"error": <message>}.
+
+"""
+
+import SocketServer
+import argparse
+import collections
+import errno
+import json
+import os
+import socket
+import threading
+import uuid
+
+import guestconv.db
+import guestconv.log
+from guestconv.converter import Converter
+from guestconv.lang import _
+from guestconv.scheduler import Scheduler
+from guestconv.worker import AsyncConverter, Limiter
+
+PENDING = u'pending'
+RUNNING = u'running'
+DONE = u'done'
+FAILED = u'failed'
+
+# The number of log records kept for each job
+MAX_RECORDS = 10000
+
+
+class RequestError(Exception): pass
+
+
+class LogSink(object):
+
+    """Deliver the log messages of a guest's Converter to its current job.
+
+    The operations of an AsyncConverter run one at a time, in the order they
+    were started, so the job running is the first which hasn't completed. A
+    message logged when every job has completed goes to the last one. Jobs
+    are added before their operation is started, so no message is missed.
+
+    """
+
+    def __init__(self):
+        self._jobs = []
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._jobs.append(job)
+
+    def log(self, level, message):
+        """Log a message formatted by JSONFormatter."""
+        with self._lock:
+            # Forget jobs which have completed, except the last
+            while len(self._jobs) > 1 and self._jobs[0].done():
+                self._jobs.pop(0)
+            job = self._jobs[0] if len(self._jobs) > 0 else None
+        if job is not None:
+            job.log(level, message)
+
+
+class Job(object):
+
+    """An operation on a guest, and the log records it produced.
+
+    :converter: The AsyncConverter of the guest.
+    :sink: The LogSink of the guest's Converter.
+
+    """
+
+    def __init__(self, converter, sink):
+        self.id = uuid.uuid4().hex
+        self.converter = converter
+        self.sink = sink
+        self.future = None
+        self._records = collections.deque(maxlen=MAX_RECORDS)
+        # The number of records discarded to keep MAX_RECORDS
+        self._dropped = 0
+        self._cond = threading.Condition()
+        sink.add(self)
+
+    def log(self, level, message):
+        """Record a log message formatted by JSONFormatter."""
+        with self._cond:
+            if len(self._records) == MAX_RECORDS:
+                self._dropped += 1
+            self._records.append(json.loads(message))
+            self._cond.notify_all()
+
+    def start(self, future):
+        self.future = future
+        future.add_done_callback(self._done)
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def _done(self, future):
+        # Wake clients following the log
+        with self._cond:
+            self._cond.notify_all()
+
+    def records(self, follow):
+        """Iterate over the job's log records.
+
+        If follow is True, wait for new records until the job completes.
+
+        """
+        # The number of records logged which have been sent
+        i = 0
+        while True:
+            with self._cond:
+                logged = self._dropped + len(self._records)
+                while follow and i == logged and not self.future.done():
+                    self._cond.wait(1)
+                    logged = self._dropped + len(self._records)
+                # Records which were discarded before they were sent are
+                # skipped
+                new = list(self._records)[max(i - self._dropped, 0):]
+                i = logged
+                finished = self.future.done()
+            for record in new:
+                yield record
+            if not follow or (finished and len(new) == 0):
+                return
+
+    def status(self):
+        status = {u'job': self.id}
+        if self.future.running():
+            status[u'state'] = RUNNING
+        elif not self.future.done():
+            status[u'state'] = PENDING
+        elif self.future.cancelled():
+            status[u'state'] = FAILED
+            status[u'error'] = _(u'Job was cancelled')
+        elif self.future.exception() is not None:
+            status[u'state'] = FAILED
+            status[u'error'] = unicode(self.future.exception())
+        else:
+            status[u'state'] = DONE
+            status[u'result'] = self.future.result()
+        return status
+
+
+class Daemon(object):
+
+    """Run inspection and conversion jobs requested over a Unix socket.
+
+    :socket_path: The path of the Unix socket to listen on.
+    :db_paths: A list of paths to conversion database XML documents.
+    :limiter: An optional Limiter or Scheduler for all jobs. Defaults to a
+              Scheduler.
+    :converter_class: The class of the Converter created for each guest.
+                      Defaults to guestconv.Converter.
+    :converter_args: Additional keyword arguments for each Converter.
+
+    """
+
+    def __init__(self, socket_path, db_paths, limiter=None,
+                 converter_class=Converter, **converter_args):
+        self._socket_path = socket_path
+        self._db = guestconv.db.DB(db_paths)
+        self._limiter = Scheduler() if limiter is None else limiter
+        self._converter_class = converter_class
+        self._converter_args = converter_args
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                daemon._handle(self.rfile, self.wfile)
+
+        class Server(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        try:
+            os.unlink(socket_path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        self._server = Server(socket_path, Handler)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        """Stop accepting requests, and cancel all jobs."""
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            jobs = self._jobs.values()
+            self._jobs = {}
+        for job in jobs:
+            job.converter.close()
+        os.unlink(self._socket_path)
+
+    def _job(self, request):
+        try:
+            job_id = request[u'job']
+        except KeyError:
+            raise RequestError(u'Request has no job')
+        with self._lock:
+            try:
+                return self._jobs[job_id]
+            except KeyError:
+                raise RequestError(_(u'Unknown job: {job}').
+                                   format(job=job_id))
+
+    def _add(self, job, future):
+        job.start(future)
+        with self._lock:
+            self._jobs[job.id] = job
+        return {u'job': job.id}
+
+    def _inspect(self, request, write):
+        try:
+            guest = request[u'guest']
+        except KeyError:
+            raise RequestError(u'inspect request has no guest')
+
+        # The job receives the messages logged while creating the Converter
+        sink = LogSink()
+        job = Job(None, sink)
+        logger = guestconv.log.get_logger_object(sink.log, jsonFormat=True)
+        converter = self._converter_class(
+            guest, self._db, logger, readonly=bool(request.get(u'readonly')),
+            **self._converter_args)
+        job.converter = AsyncConverter(converter, self._limiter)
+        structured = bool(request.get(u'structured'))
+        write(self._add(job, job.converter.inspect(structured=structured)))
+
+    def _convert(self, request, write):
+        try:
+            desc = request[u'desc']
+        except KeyError:
+            raise RequestError(u'convert request has no desc')
+
+        inspection = self._job(request)
+        job = Job(inspection.converter, inspection.sink)
+        write(self._add(job, job.converter.convert(desc)))
+
+    def _status(self, request, write):
+        write(self._job(request).status())
+
+    def _logs(self, request, write):
+        job = self._job(request)
+        for record in job.records(request.get(u'follow', False)):
+            write({u'log': record})
+        write(job.status())
+
+    def _cancel(self, request, write):
+        job = self._job(request)
+        if not job.future.cancel():
+            job.converter.cancel()
+        write(job.status())
+
+    def _release(self, request, write):
+        job = self._job(request)
+        with self._lock:
+            for other in self._jobs.values():
+                if other.converter is job.converter:
+                    del self._jobs[other.id]
+        job.converter.close()
+        write({})
+
+    _ops = {
+        u'inspect': _inspect,
+        u'convert': _convert,
+        u'status': _status,
+        u'logs': _logs,
+        u'cancel': _cancel,
+        u'release': _release
+    }
+
+    def _handle(self, rfile, wfile):
+        def write(response):
+            wfile.write(json.dumps(response) + '\n')
+            wfile.flush()
+
+        for line in iter(rfile.readline, ''):
+            if line.strip() == '':
+                continue
+
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise RequestError(u'Request is not a JSON object')
+                try:
+                    op = self._ops[request.get(u'op')]
+                except KeyError:
+                    raise RequestError(u'Unknown op: {}'.
+                                       format(request.get(u'op')))
+                op(self, request, write)
+            except Exception as ex:
+                # Errors in one request mustn't affect others
+                write({u'error': unicode(ex)})
+
+
+class Client(object):
+
+    """A client of a guestconv daemon.
+
+    :socket_path: The path of the daemon's Unix socket.
+
+    """
+
+    def __init__(self, socket_path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._file = self._sock.makefile(u'rw')
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def _read(self):
+        response = json.loads(self._file.readline())
+        if u'error' in response:
+            raise RequestError(response[u'error'])
+        return response
+
+    def request(self, op, **args):
+        """Send a request, and return the response."""
+        args[u'op'] = op
+        self._file.write(json.dumps(args) + '\n')
+        self._file.flush()
+        return self._read()
+
+    def logs(self, job, follow=False):
+        """Iterate over the log records of job, then its status."""
+        response = self.request(u'logs', job=job, follow=follow)
+        while u'log' in response:
+            yield response
+            response = self._read()
+        yield response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=u'Run guestconv jobs requested over a Unix socket')
+    parser.add_argument(u'--socket', required=True,
+                        help=u'path of the Unix socket to listen on')
+    parser.add_argument(u'--db', action=u'append', required=True,
+                        help=u'conversion database; may be repeated')
+    parser.add_argument(u'--cache-dir',
+                        help=u'directory for the on-host cache')
+    parser.add_argument(u'--max-jobs', type=int,
+                        help=u'run at most this many jobs at once, instead '
+                             u'of scheduling according to host resources')
+    parser.add_argument(u'--snapshot', action=u'store_true',
+                        help=u'snapshot guest configuration for inspection')
+    args = parser.parse_args(argv)
+
+    limiter = None
+    if args.max_jobs is not None:
+        limiter = Limiter(args.max_jobs)
+
+    daemon = Daemon(args.socket, args.db, limiter,
+                    cache_dir=args.cache_dir, snapshot=args.snapshot)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+
+
+if __name__ == u'__main__':
+    main()
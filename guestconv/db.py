@@ -17,6 +17,7 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import hashlib
 import os.path
 import lxml.etree as ET
 from itertools import product
@@ -41,16 +42,22 @@ class DB(object):
 
     :db_paths: A list containing the paths to DB XML documents.
 
+    The digest attribute identifies the contents of the documents.
+
     """
 
     def __init__(self, db_paths):
         self._trees = []
+        digest = hashlib.sha256()
         for path in db_paths:
             try:
-                self._trees.append(ET.parse(path))
+                tree = ET.parse(path)
             except ET.ParseError as e:
                 raise DBParseError(_(u'Parse error in %(path)s: %(error)s') % \
                                    {u'path': path, u'error': e.message})
+            self._trees.append(tree)
+            digest.update(ET.tostring(tree, method=u'c14n'))
+        self.digest = digest.hexdigest()
 
     def _match_element(self, type_, name, arch, h, root):
         def queries():
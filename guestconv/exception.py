@@ -22,3 +22,5 @@ class GuestConvException(Exception): pass
 class UnsupportedConversion(GuestConvException): pass
 class InvalidConversion(GuestConvException): pass
 class ConversionError(GuestConvException): pass
+class ConversionCancelled(GuestConvException): pass
+class ConversionTimeout(ConversionCancelled): pass
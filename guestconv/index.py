@@ -0,0 +1,285 @@
+# coding: utf-8
+# guestconv
+#
+# Copyright (C) 2013 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""A queryable index of the inspections of many guests"""
+
+import sqlite3
+import threading
+import time
+
+_SCHEMA = u'''
+CREATE TABLE IF NOT EXISTS guests (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    inspected REAL NOT NULL,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS roots (
+    id INTEGER PRIMARY KEY,
+    guest INTEGER NOT NULL REFERENCES guests(id) ON DELETE CASCADE,
+    root TEXT NOT NULL,
+    hostname TEXT,
+    os TEXT,
+    distribution TEXT,
+    arch TEXT,
+    major INTEGER,
+    minor INTEGER
+);
+CREATE INDEX IF NOT EXISTS roots_guest ON roots(guest);
+CREATE INDEX IF NOT EXISTS roots_distribution
+    ON roots(distribution, major, minor);
+CREATE INDEX IF NOT EXISTS roots_arch ON roots(arch);
+CREATE TABLE IF NOT EXISTS options (
+    root INTEGER NOT NULL REFERENCES roots(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    description TEXT
+);
+CREATE INDEX IF NOT EXISTS options_value ON options(name, value);
+CREATE TABLE IF NOT EXISTS hypervisors (
+    root INTEGER NOT NULL REFERENCES roots(id) ON DELETE CASCADE,
+    hypervisor TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hypervisors_status
+    ON hypervisors(hypervisor, status);
+CREATE TABLE IF NOT EXISTS missing (
+    root INTEGER NOT NULL REFERENCES roots(id) ON DELETE CASCADE,
+    capability TEXT NOT NULL,
+    package TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS missing_capability ON missing(capability);
+CREATE TABLE IF NOT EXISTS bootloaders (
+    guest INTEGER NOT NULL REFERENCES guests(id) ON DELETE CASCADE,
+    disk TEXT NOT NULL,
+    type TEXT,
+    name TEXT,
+    replacement TEXT
+);
+CREATE TABLE IF NOT EXISTS timings (
+    guest INTEGER NOT NULL REFERENCES guests(id) ON DELETE CASCADE,
+    phase TEXT NOT NULL,
+    root TEXT,
+    duration REAL NOT NULL
+);
+'''
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class InspectionIndex(object):
+
+    """Store the inspections of many guests in a SQLite database.
+
+    Each guest is stored with the info, options, hypervisor tools and missing
+    dependencies of its roots, its bootloaders, and how long its inspection
+    took. A guest is identified by its name: adding a guest replaces any
+    guest already stored with the same name.
+
+    An index may be used from any thread.
+
+    :path: The path of the database file, or ':memory:'.
+
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(u'PRAGMA foreign_keys = ON')
+            self._db.executescript(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def add(self, name, inspection, duration=None, timings=()):
+        """Store the inspection of a guest.
+
+        :param name: The name of the guest.
+        :param inspection: The result of Converter.inspect(structured=True).
+        :param duration: optional duration of the inspection, in seconds
+        :param timings: optional list of (phase, root, duration) tuples
+        :returns: The id of the guest in the index
+
+        """
+        with self._lock, self._db:
+            db = self._db
+            if name is not None:
+                db.execute(u'DELETE FROM guests WHERE name = ?', (name,))
+
+            guest = db.execute(u'INSERT INTO guests (name, inspected, '
+                               u'duration) VALUES (?, ?, ?)',
+                               (name, time.time(), duration)).lastrowid
+
+            for root in inspection[u'roots']:
+                info = root[u'info']
+                version = info.get(u'version', {})
+                root_id = db.execute(
+                    u'INSERT INTO roots (guest, root, hostname, os, '
+                    u'distribution, arch, major, minor) '
+                    u'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (guest, root[u'name'], info.get(u'hostname'),
+                     info.get(u'os'), info.get(u'distribution'),
+                     info.get(u'arch'), _int(version.get(u'major')),
+                     _int(version.get(u'minor')))).lastrowid
+
+                db.executemany(
+                    u'INSERT INTO options (root, name, value, description) '
+                    u'VALUES (?, ?, ?, ?)',
+                    [(root_id, option[u'name'], value[u'name'],
+                      value[u'description'])
+                     for option in root[u'options']
+                     for value in option[u'values']])
+                db.executemany(
+                    u'INSERT INTO hypervisors (root, hypervisor, status) '
+                    u'VALUES (?, ?, ?)',
+                    [(root_id, hypervisor, status) for hypervisor, status
+                     in root.get(u'hypervisors', {}).iteritems()])
+                db.executemany(
+                    u'INSERT INTO missing (root, capability, package) '
+                    u'VALUES (?, ?, ?)',
+                    [(root_id, capability, package) for capability, packages
+                     in root.get(u'missing', {}).iteritems()
+                     for package in packages])
+
+            loaders = []
+            for loader in inspection[u'boot']:
+                replacement = loader.get(u'replacement')
+                if replacement is not None:
+                    replacement = replacement[u'name']
+                loaders.append((guest, loader[u'disk'], loader[u'type'],
+                                loader[u'name'], replacement))
+            db.executemany(u'INSERT INTO bootloaders (guest, disk, type, '
+                           u'name, replacement) VALUES (?, ?, ?, ?, ?)',
+                           loaders)
+
+            db.executemany(u'INSERT INTO timings (guest, phase, root, '
+                           u'duration) VALUES (?, ?, ?, ?)',
+                           [(guest,) + tuple(i) for i in timings])
+
+        return guest
+
+    def inspect(self, converter):
+        """Inspect a guest, and store the result.
+
+        The phases of the inspection are timed with the converter's progress
+        callback. Events are passed on to any callback the converter already
+        had, which is restored afterwards.
+
+        :param converter: A guestconv.Converter.
+        :returns: The result of converter.inspect(structured=True)
+
+        """
+        starts = {}
+        timings = []
+        previous = converter._progress
+
+        def progress(event):
+            key = (event[u'phase'], event.get(u'root'))
+            if event[u'event'] == u'start':
+                starts[key] = event[u'time']
+            elif event[u'event'] in (u'end', u'error') and key in starts:
+                timings.append(key + (event[u'time'] - starts.pop(key),))
+            if previous is not None:
+                previous(event)
+
+        converter.set_progress_callback(progress)
+        try:
+            start = time.time()
+            inspection = converter.inspect(structured=True)
+            duration = time.time() - start
+        finally:
+            converter.set_progress_callback(previous)
+
+        self.add(converter._id, inspection, duration, timings)
+        return inspection
+
+    def query(self, distribution=None, major=None, minor=None, arch=None,
+              option=None, hypervisor=None, missing=None, limit=None):
+        """Return the roots matching all of the given criteria.
+
+        Roots are returned cheapest to convert first: those with the fewest
+        missing packages, then the fastest to inspect.
+
+        :param distribution: optional distribution, e.g. rhel
+        :param major: optional major version
+        :param minor: optional minor version
+        :param arch: optional architecture, e.g. x86_64
+        :param option: optional (name, value) tuple: the root offers value
+                       for option name, e.g. (u'block', u'virtio-blk')
+        :param hypervisor: optional hypervisor whose guest tools are
+                           installed, e.g. vmware
+        :param missing: optional capability which the root lacks the
+                        dependencies of, e.g. virtio
+        :param limit: optional maximum number of roots to return
+        :returns: A list of dicts with the keys guest, root, distribution,
+                  major, minor, arch, duration and missing, the number of
+                  missing packages.
+
+        """
+        where = []
+        args = []
+        for column, value in ((u'r.distribution', distribution),
+                              (u'r.major', major), (u'r.minor', minor),
+                              (u'r.arch', arch)):
+            if value is not None:
+                where.append(column + u' = ?')
+                args.append(value)
+
+        if option is not None:
+            where.append(u'r.id IN (SELECT root FROM options '
+                         u'WHERE name = ? AND value = ?)')
+            args.extend(option)
+        if hypervisor is not None:
+            where.append(u'r.id IN (SELECT root FROM hypervisors '
+                         u"WHERE hypervisor = ? AND status = 'installed')")
+            args.append(hypervisor)
+        if missing is not None:
+            where.append(u'r.id IN (SELECT root FROM missing '
+                         u'WHERE capability = ?)')
+            args.append(missing)
+
+        sql = (u'SELECT g.name AS guest, r.root AS root, r.distribution AS '
+               u'distribution, r.major AS major, r.minor AS minor, r.arch AS '
+               u'arch, g.duration AS duration, (SELECT count(*) FROM missing '
+               u'm WHERE m.root = r.id) AS missing FROM roots r JOIN guests g '
+               u'ON r.guest = g.id')
+        if len(where) > 0:
+            sql += u' WHERE ' + u' AND '.join(where)
+        sql += u' ORDER BY missing, g.duration'
+        if limit is not None:
+            sql += u' LIMIT ?'
+            args.append(limit)
+
+        with self._lock:
+            return [dict(row) for row in self._db.execute(sql, args)]
+
+    def timings(self, name):
+        """Return the (phase, root, duration) timings of a guest's
+        inspection."""
+        with self._lock:
+            return [tuple(row) for row in self._db.execute(
+                u'SELECT t.phase, t.root, t.duration FROM timings t '
+                u'JOIN guests g ON t.guest = g.id WHERE g.name = ?', (name,))]
@@ -17,8 +17,45 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import Queue
+import json
 import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Fields of the spans enclosing the current point of execution in each thread
+_context = threading.local()
+
+class BraceMessage(object):
+
+    """A log message which is formatted with str.format() only when it is
+    written.
+
+    Building a message eagerly costs the same whether or not it is logged.
+    Passing a BraceMessage instead means the cost is only paid if the record
+    passes the logger's threshold and reaches a handler:
+
+        logger.debug(BraceMessage(u'Kernel {} has no modules.dep', kernel))
+
+    """
+
+    __slots__ = (u'fmt', u'args', u'kwargs')
+
+    def __init__(self, fmt, *args, **kwargs):
+        self.fmt = fmt
+        self.args = args
+        self.kwargs = kwargs
+
+    def __unicode__(self):
+        return self.fmt.format(*self.args, **self.kwargs)
+
+    # LogRecord.getMessage() calls str() on messages which aren't strings. If
+    # the message doesn't encode as ASCII it falls back to the message object
+    # itself, which is formatted by __unicode__ above.
+    __str__ = __unicode__
+
 
 class FunctionWrappingHandler(logging.Handler):
 
@@ -32,11 +69,192 @@ class FunctionWrappingHandler(logging.Handler):
         msgStr = self.format(record)
         self._logFunc(record.levelno,msgStr)
 
-def get_logger_object( loggerOrFunc):
+
+class QueueingFunctionWrappingHandler(FunctionWrappingHandler):
+
+    """A FunctionWrappingHandler which delivers messages from a background
+    thread.
+
+    Records are formatted by the thread doing the logging, so their arguments
+    are read before they can change. The messages are placed on a queue of at
+    most maxSize messages, and passed to the wrapped function by a separate
+    thread, so a slow function doesn't hold up the thread doing the logging.
+    When the queue is full, overflow determines whether the logging thread
+    blocks until there is space (BLOCK), or the record is discarded (DROP).
+    The number of discarded records is available in the dropped attribute.
+
+    """
+
+    BLOCK = u'block'
+    DROP = u'drop'
+
+    def __init__(self, logFunc, maxSize=1000, overflow=BLOCK):
+        if overflow not in (self.BLOCK, self.DROP):
+            raise ValueError(u'Invalid overflow policy: {}'.format(overflow))
+
+        FunctionWrappingHandler.__init__(self, logFunc)
+        self._queue = Queue.Queue(maxSize)
+        self._overflow = overflow
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._deliver,
+                                        name=u'guestconv-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def emit(self, record):
+        try:
+            item = (record, self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+
+        if self._overflow == self.DROP:
+            try:
+                self._queue.put_nowait(item)
+            except Queue.Full:
+                self.dropped += 1
+        else:
+            self._queue.put(item)
+
+    def _deliver(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                (record, msgStr) = item
+                try:
+                    self._logFunc(record.levelno, msgStr)
+                except Exception:
+                    self.handleError(record)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Wait until all queued records have been delivered."""
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        """Deliver all queued records, then stop the delivery thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        FunctionWrappingHandler.close(self)
+
+
+class ContextFilter(logging.Filter):
+
+    """A Filter which adds the fields of all enclosing spans to each record.
+
+    This runs in the thread which does the logging, so the fields are still
+    present if the record is formatted by another thread.
+
+    """
+
+    def filter(self, record):
+        for key, value in getattr(_context, u'fields', {}).iteritems():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+
+    """A Formatter which writes each record as a single line of JSON.
+
+    As well as the time, level, source location and message, the following
+    fields are written if they are present in the record, either from a span
+    or from the extra argument of the logging call:
+
+    * guest, root, phase: where in the conversion the record was logged
+    * event, start, end, duration: for span start and end records
+    * fields: a dict of typed data relating to the message
+
+    """
+
+    _KEYS = (u'guest', u'root', u'phase',
+             u'event', u'start', u'end', u'duration', u'fields')
+
+    def format(self, record):
+        event = {
+            u'time': record.created,
+            u'level': record.levelname,
+            u'file': record.filename,
+            u'function': record.funcName,
+            u'message': record.getMessage()
+        }
+        for key in self._KEYS:
+            value = getattr(record, key, None)
+            if value is not None:
+                event[key] = value
+        if record.exc_info:
+            event[u'exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(event, default=unicode)
+
+
+@contextmanager
+def span(logger, phase, **fields):
+    """Execute a block of code as a named phase of work.
+
+    Debug records are logged when the phase starts and ends, including its
+    duration. Records logged within the block by a logger created by
+    get_logger_object() carry phase and fields, as do those of nested spans.
+
+    The block is given a dict. Fields it adds to the dict are included in the
+    record logged when the phase ends.
+
+    :param logger: A logging.Logger.
+    :param phase: The name of the phase.
+    :param fields: Additional context, e.g. guest or root.
+
+    """
+    outer = getattr(_context, u'fields', {})
+    context = dict(outer)
+    context.update(fields)
+    context[u'phase'] = phase
+    _context.fields = context
+
+    start = time.time()
+    extra = dict(context)
+    extra.update({u'event': u'start', u'start': start})
+    logger.debug(BraceMessage(u'Starting {}', phase), extra=extra)
+
+    result = {}
+    try:
+        yield result
+    except:
+        end = time.time()
+        extra = dict(context)
+        extra.update(result)
+        extra.update({u'event': u'error', u'start': start, u'end': end,
+                      u'duration': end - start})
+        logger.debug(BraceMessage(u'Failed {} after {:.3f}s',
+                                  phase, end - start), extra=extra)
+        raise
+    else:
+        end = time.time()
+        extra = dict(context)
+        extra.update(result)
+        extra.update({u'event': u'end', u'start': start, u'end': end,
+                      u'duration': end - start})
+        logger.debug(BraceMessage(u'Finished {} in {:.3f}s',
+                                  phase, end - start), extra=extra)
+    finally:
+        _context.fields = outer
+
+
+def get_logger_object(loggerOrFunc, queueSize=None,
+                      overflow=QueueingFunctionWrappingHandler.BLOCK,
+                      jsonFormat=False, level=None):
     """Get a logging.Logger object that guestconv classes can cache locally.
 
     Three cases:
-    * loggerOrFunc is a logging.Logger.  Then just return the logger.
+    * loggerOrFunc is a logging.Logger.  Then return the logger, with a
+      ContextFilter added so its records carry the fields of spans.  The
+      other arguments are ignored.
     * loggerOrFunc is None.  Then return a new Logger that writes to
       stderr.  The threshold for messages is WARNING unless the
       environment variable GUESTCONV_LOG_LEVEL is defined.
@@ -45,9 +263,23 @@ def get_logger_object( loggerOrFunc):
       (the logging level e.g. logging.WARNING) and the log message
       string.
 
+    If loggerOrFunc is a function and queueSize is given, the function is
+    called from a background thread, with at most queueSize messages waiting
+    to be delivered. overflow determines what happens when the queue is full
+    (see QueueingFunctionWrappingHandler).
+
+    If jsonFormat is True, messages are formatted by JSONFormatter instead of
+    as plain text.
+
+    If loggerOrFunc is a function, level sets the threshold below which
+    messages are discarded before they are created, rather than being passed
+    to the function. By default the function receives all messages.
+
     """
 
     if isinstance(loggerOrFunc,logging.Logger):
+        if not any(isinstance(i, ContextFilter) for i in loggerOrFunc.filters):
+            loggerOrFunc.addFilter(ContextFilter())
         return loggerOrFunc
 
     # Intentionally not instantiating a logger object through
@@ -61,15 +293,24 @@ def get_logger_object( loggerOrFunc):
         logLevel = logging.WARNING
         if u'GUESTCONV_LOG_LEVEL' in os.environ:
             logLevel = os.environ[u'GUESTCONV_LOG_LEVEL'].upper()
+    elif queueSize is not None:
+        handler = QueueingFunctionWrappingHandler(loggerOrFunc, queueSize,
+                                                  overflow)
+        logLevel = logging.NOTSET if level is None else level
     else:
         handler = FunctionWrappingHandler(loggerOrFunc)
         # always send it all logging messages along to the logging
-        # callback function.  It's up to it whether to filter or not.
-        logLevel = logging.NOTSET
+        # callback function, unless it asked for a threshold.  It's up to
+        # it whether to filter or not.
+        logLevel = logging.NOTSET if level is None else level
 
-    formatter = logging.Formatter(u'%(asctime)s - %(filename)s '+
-                          u'%(funcName)s() - %(levelname)s - %(message)s')
+    if jsonFormat:
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter(u'%(asctime)s - %(filename)s '+
+                              u'%(funcName)s() - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
+    logger.addFilter(ContextFilter())
     logger.setLevel(logLevel)
     return logger
@@ -0,0 +1,185 @@
+# coding: utf-8
+# guestconv
+#
+# Copyright (C) 2013 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Admit concurrent conversions according to host resources"""
+
+import multiprocessing
+import threading
+from contextlib import contextmanager
+
+from guestconv.exception import ConversionCancelled
+from guestconv.lang import _
+
+# Appliance memory sizes, in MiB
+
+# The libguestfs default
+BASE_MEMSIZE = 500
+# Page cache and filesystem metadata for each guest disk
+DISK_MEMSIZE = 32
+# rpm and yum transactions, and initrd rebuilds, in RedHat.convert
+PACKAGES_MEMSIZE = 512
+# Memory used by qemu in addition to the appliance's memory
+QEMU_OVERHEAD = 128
+
+# Memory, in MiB, which is never given to appliances
+DEFAULT_RESERVE = 512
+
+
+def estimate_appliance(guest, convert=True):
+    """Estimate the appliance size required to convert a guest.
+
+    :param guest: The guest description parsed by Converter.
+    :param convert: False if the guest will only be inspected.
+    :returns: A tuple of (memsize, smp). memsize is in MiB.
+
+    """
+    disks = sum([len(c[u'disks']) for c in guest[u'controllers']])
+    memsize = BASE_MEMSIZE + DISK_MEMSIZE * disks
+    smp = 1
+    if convert:
+        # Package operations run rpm in the appliance, and rebuilding an
+        # initrd compresses it. Both benefit from a second vCPU.
+        memsize += PACKAGES_MEMSIZE
+        smp = 2
+    return (memsize, smp)
+
+
+def read_meminfo(path=u'/proc/meminfo'):
+    """Return the contents of /proc/meminfo as a dict of values in KiB."""
+    meminfo = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            try:
+                meminfo[fields[0].rstrip(u':')] = int(fields[1])
+            except ValueError:
+                continue
+    return meminfo
+
+
+def available_memory(meminfo):
+    """Return the memory available for new processes, in MiB.
+
+    :param meminfo: The output of read_meminfo().
+
+    """
+    if u'MemAvailable' in meminfo:
+        kib = meminfo[u'MemAvailable']
+    else:
+        # Kernels before 3.14 don't estimate available memory
+        kib = sum([meminfo.get(i, 0)
+                   for i in (u'MemFree', u'Buffers', u'Cached')])
+    return kib / 1024
+
+
+def _appliance_rss(pid):
+    # Return the resident memory of an appliance, in MiB, or 0
+    if pid is None:
+        return 0
+    try:
+        with open(u'/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith(u'VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except (IOError, ValueError):
+        pass
+    return 0
+
+
+class Scheduler(object):
+
+    """Admit conversions when the host has resources to run them.
+
+    Each conversion is sized with estimate_appliance(). It is admitted when
+    the host has enough available memory for its appliance, and its vCPUs fit
+    within the host's CPUs alongside those of the appliances already running.
+    Appliances which have been admitted but haven't yet used all their memory
+    are expected to use the rest, so it is not counted as available. A
+    conversion is always admitted if nothing else is running.
+
+    A Scheduler can be used as the limiter of any number of AsyncConverters.
+    An AsyncConverter holds its admission for the lifetime of its appliance,
+    until it is closed.
+
+    :reserve: Memory, in MiB, to leave for the rest of the host.
+    :cpus: The number of CPUs to allocate. Defaults to the host's CPU count.
+    :meminfo: A function returning the output of read_meminfo().
+
+    """
+
+    def __init__(self, reserve=DEFAULT_RESERVE, cpus=None,
+                 meminfo=read_meminfo):
+        if cpus is None:
+            cpus = multiprocessing.cpu_count()
+        self._reserve = reserve
+        self._cpus = cpus
+        self._meminfo = meminfo
+        self._running = {}
+        self._cond = threading.Condition()
+
+    def _admissible(self, memsize, smp):
+        if len(self._running) == 0:
+            return True
+
+        if sum([i[1] for i in self._running.itervalues()]) + smp > self._cpus:
+            return False
+
+        # Memory which admitted appliances are still expected to use
+        pending = 0
+        for converter, (footprint, vcpus) in self._running.iteritems():
+            pending += max(0, footprint -
+                              _appliance_rss(converter.appliance_pid()))
+
+        available = available_memory(self._meminfo()) - pending
+        return memsize + QEMU_OVERHEAD + self._reserve <= available
+
+    @contextmanager
+    def slot(self, converter, cancelled=lambda: False):
+        """Execute a block of code when the host can run converter.
+
+        The appliance of converter is sized before waiting. It must not have
+        been launched. Its resources are counted until the block completes,
+        so the block should last as long as the appliance.
+
+        :param converter: A guestconv.Converter.
+        :param cancelled: A function which returns True if the caller no
+                          longer wants to wait, in which case
+                          ConversionCancelled is raised.
+
+        """
+        (memsize, smp) = converter.size_appliance(cpus=self._cpus)
+
+        with self._cond:
+            while not self._admissible(memsize, smp):
+                if cancelled():
+                    raise ConversionCancelled(
+                        _(u'Conversion was cancelled while waiting to run'))
+                # Host memory may be freed by something other than another
+                # conversion completing, so check it periodically
+                self._cond.wait(1)
+            self._running[converter] = (memsize + QEMU_OVERHEAD, smp)
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                del self._running[converter]
+                self._cond.notify_all()
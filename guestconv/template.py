@@ -0,0 +1,158 @@
+# coding: utf-8
+# guestconv
+#
+# Copyright (C) 2013 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Recognise guests cloned from the same template image.
+
+Guests created as overlays of the same template, and not changed since in
+ways which affect inspection, have the same fingerprint. The fingerprint
+covers:
+
+* every image in the backing chain of each disk, except the guest's own
+* the guest's bootloader configuration and fstab
+* the size and modification time of the guest's package database
+
+"""
+
+import hashlib
+import json
+import os.path
+import subprocess
+
+from guestconv.converters.exception import GuestFSException
+
+# Increment when inspection changes, so results cached by an earlier version
+# are not reused
+FINGERPRINT_VERSION = 1
+
+# Configuration whose contents determine the result of inspection
+_CONFIG_FILES = [u'/etc/fstab', u'/boot/grub/grub.conf',
+                 u'/boot/grub/menu.lst', u'/boot/grub2/grub.cfg',
+                 u'/etc/default/grub', u'/etc/sysconfig/grub']
+_CONFIG_GLOBS = [u'/boot/efi/EFI/*/grub.*']
+
+# Package databases. A package database is too large to checksum cheaply,
+# but it is rewritten by every package transaction.
+_PACKAGE_DBS = [u'/var/lib/rpm/Packages', u'/var/lib/rpm/rpmdb.sqlite',
+                u'/var/lib/dpkg/status']
+
+
+def backing_chain(path):
+    """Return the backing images of a disk image.
+
+    :param path: The path of a disk image on the host.
+    :returns: A list of (filename, size, mtime) tuples, one for each image
+              in the backing chain of path, not including path itself. None
+              if the backing chain can't be read.
+
+    """
+    try:
+        qemu_img = subprocess.Popen([u'qemu-img', u'info', u'--backing-chain',
+                                     u'--output=json', path],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    output = qemu_img.communicate()[0]
+    if qemu_img.returncode != 0:
+        return None
+
+    try:
+        images = json.loads(output)
+    except ValueError:
+        return None
+
+    chain = []
+    directory = os.path.dirname(os.path.abspath(path))
+    for image in images[1:]:
+        filename = image.get(u'filename')
+        if filename is None:
+            return None
+
+        if u'://' in filename:
+            # A remote image can't be checked for changes
+            chain.append((filename, image.get(u'virtual-size'), None))
+            continue
+
+        filename = os.path.realpath(os.path.join(directory, filename))
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        chain.append((filename, st.st_size, st.st_mtime))
+        directory = os.path.dirname(filename)
+    return chain
+
+
+def guest_backing_chains(guest):
+    """Return the backing chains of all a guest's disks.
+
+    :param guest: The guest description parsed by Converter.
+    :returns: A list of the backing chains of each disk, or None if any disk
+              is not backed by a template.
+
+    """
+    chains = []
+    for controller in guest[u'controllers']:
+        for disk in controller[u'disks']:
+            if disk[u'protocol'] != u'file' or disk[u'path'] is None:
+                return None
+            chain = backing_chain(disk[u'path'])
+            if not chain:
+                return None
+            chains.append(chain)
+    if len(chains) == 0:
+        return None
+    return chains
+
+
+def fingerprint(h, chains, *extra):
+    """Return the fingerprint of a guest root.
+
+    :param h: The libguestfs handle, with the root mounted.
+    :param chains: The output of guest_backing_chains().
+    :param extra: Strings which must also match, for example the digest of
+                  the conversion database.
+    :returns: A hex string
+
+    """
+    digest = hashlib.sha256()
+
+    def _add(*values):
+        digest.update(json.dumps(values) + '\n')
+
+    _add(FINGERPRINT_VERSION, chains, extra)
+
+    paths = list(_CONFIG_FILES)
+    for pattern in _CONFIG_GLOBS:
+        paths.extend(sorted(h.glob_expand(pattern)))
+    for path in paths:
+        if h.is_file(path):
+            _add(path, h.checksum(u'sha256', path))
+        else:
+            _add(path, None)
+
+    for path in _PACKAGE_DBS:
+        try:
+            st = h.stat(path)
+        except GuestFSException:
+            _add(path, None)
+            continue
+        _add(path, st[u'size'], st[u'mtime'])
+
+    return digest.hexdigest()
@@ -0,0 +1,262 @@
+# coding: utf-8
+# guestconv
+#
+# Copyright (C) 2013 Red Hat Inc.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Run conversions in the background"""
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from guestconv.exception import ConversionCancelled, ConversionTimeout
+from guestconv.lang import _
+
+
+class Limiter(object):
+
+    """Limit the number of conversions running at the same time.
+
+    A single Limiter may be shared by any number of AsyncConverters. A
+    conversion is running from the start of its AsyncConverter's first
+    operation until the AsyncConverter is closed.
+
+    :limit: The maximum number of concurrent operations.
+
+    """
+
+    def __init__(self, limit):
+        if limit < 1:
+            raise ValueError(u'Invalid limit: {}'.format(limit))
+
+        self._limit = limit
+        self._running = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, converter, cancelled=lambda: False):
+        """Execute a block of code when fewer than limit others are running.
+
+        :param converter: The guestconv.Converter which will run.
+        :param cancelled: A function which returns True if the caller no
+                          longer wants to wait, in which case
+                          ConversionCancelled is raised.
+
+        """
+        with self._cond:
+            while self._running >= self._limit:
+                if cancelled():
+                    raise ConversionCancelled(
+                        _(u'Conversion was cancelled while waiting to run'))
+                # Wake periodically to check for cancellation
+                self._cond.wait(1)
+            self._running += 1
+
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify()
+
+
+class ConversionFuture(Future):
+
+    """A Future for an operation of an AsyncConverter.
+
+    Unlike a plain Future, cancelling a ConversionFuture which is already
+    running kills the conversion. The future then completes with
+    ConversionCancelled. Killing the conversion kills the Converter's
+    appliance, so this cancels the AsyncConverter as if by its cancel():
+    all its later operations also fail with ConversionCancelled.
+
+    Cancelling a ConversionFuture which hasn't started only cancels that
+    operation.
+
+    """
+
+    def __init__(self, converter):
+        Future.__init__(self)
+        self._converter = converter
+
+    def cancel(self):
+        if Future.cancel(self):
+            return True
+
+        if self.running():
+            self._converter.cancel()
+        return False
+
+
+class AsyncConverter(object):
+
+    """Run the operations of a Converter in a background thread.
+
+    inspect() and convert() return immediately with a ConversionFuture, which
+    is a concurrent.futures.Future. An asyncio event loop can wait for it with
+    asyncio.wrap_future(). Operations run one at a time, in the order they
+    were requested.
+
+    If a limiter is given, the first operation waits until the limiter admits
+    the conversion before starting. The limiter may be a Limiter, which
+    limits the number of concurrent conversions, or a
+    guestconv.scheduler.Scheduler, which admits conversions according to host
+    resources. The appliance runs from the first operation until the
+    AsyncConverter is closed or cancelled, and the conversion holds its
+    admission for as long, so an AsyncConverter must be closed when it is no
+    longer needed.
+
+    If an operation is given a timeout, it is cancelled if it has not
+    completed that many seconds after it started, and fails with
+    ConversionTimeout. Time spent waiting for the limiter does not count
+    towards the timeout.
+
+    Cancelling a running operation, either with cancel() or by cancelling its
+    future, kills the libguestfs appliance. The Converter can't be used
+    afterwards.
+
+    :converter: A guestconv.Converter.
+    :limiter: An optional Limiter or Scheduler shared with other
+              AsyncConverters.
+
+    """
+
+    def __init__(self, converter, limiter=None):
+        self._converter = converter
+        self._limiter = limiter
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._slot = None
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._cancelled = False
+        self._timed_out = False
+
+    def inspect(self, timeout=None, structured=False):
+        """Inspect the guest in the background.
+
+        :param timeout: optional timeout in seconds
+        :param structured: optional boolean, as for Converter.inspect()
+        :returns: A ConversionFuture whose result is the value of
+                  Converter.inspect()
+
+        """
+        return self._submit(timeout, self._converter.inspect, structured)
+
+    def convert(self, desc, timeout=None):
+        """Convert the guest in the background.
+
+        :param desc: XML document string or dict, as for
+                     Converter.convert()
+        :param timeout: optional timeout in seconds
+        :returns: A ConversionFuture whose result is the value of
+                  Converter.convert()
+
+        """
+        return self._submit(timeout, self._converter.convert, desc)
+
+    def cancel(self):
+        """Cancel all pending and running operations.
+
+        May be called from any thread.
+
+        """
+        self._cancelled = True
+        self._converter.kill()
+
+    def close(self):
+        """Cancel all operations, and release the worker thread and the
+        conversion's admission by the limiter. Closing an AsyncConverter
+        which is already closed has no effect."""
+        self.cancel()
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._executor.submit(self._release)
+            self._executor.shutdown(wait=False)
+
+    def _acquire(self):
+        # Wait for the limiter to admit the conversion. Called by the worker
+        # thread.
+        if self._limiter is None or self._slot is not None:
+            return
+
+        slot = self._limiter.slot(self._converter, lambda: self._cancelled)
+        slot.__enter__()
+        self._slot = slot
+
+    def _release(self):
+        # Called by the worker thread once the appliance has been killed
+        if self._slot is not None:
+            (slot, self._slot) = (self._slot, None)
+            slot.__exit__(None, None, None)
+
+    def _timeout(self):
+        self._timed_out = True
+        self.cancel()
+
+    def _submit(self, timeout, func, *args):
+        future = ConversionFuture(self)
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+
+            try:
+                if self._cancelled:
+                    raise ConversionCancelled(
+                        _(u'Conversion was cancelled before it started'))
+
+                self._acquire()
+                result = self._run(timeout, func, *args)
+            except BaseException as ex:
+                if self._cancelled:
+                    # The appliance has been killed
+                    self._release()
+                future.set_exception(self._cancellation_error(ex))
+            else:
+                future.set_result(result)
+
+        self._executor.submit(run)
+        return future
+
+    def _run(self, timeout, func, *args):
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, self._timeout)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            result = func(*args)
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        # The appliance may have been killed after the last guestfs call
+        if self._cancelled:
+            raise ConversionCancelled(_(u'Conversion was cancelled'))
+        return result
+
+    def _cancellation_error(self, ex):
+        # When the appliance is killed, the operation in progress fails with
+        # whatever error libguestfs reports. Report the reason instead.
+        if self._timed_out and not isinstance(ex, ConversionTimeout):
+            return ConversionTimeout(_(u'Conversion timed out'))
+        if self._cancelled and not isinstance(ex, ConversionCancelled):
+            return ConversionCancelled(_(u'Conversion was cancelled'))
+        return ex
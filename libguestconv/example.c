@@ -8,6 +8,19 @@ logger(int level, char *msg)
     fprintf(stderr, "EXAMPLE LOG: LVL %d - %s\n", level, msg);
 }
 
+static void
+progress(const GuestConvProgress *p)
+{
+    /* phase is NULL outside any phase of work */
+    const char *phase = p->phase ? p->phase : "-";
+
+    if (p->total > 0)
+        fprintf(stderr, "EXAMPLE PROGRESS: %s %llu/%llu\n",
+                phase, p->position, p->total);
+    else
+        fprintf(stderr, "EXAMPLE PROGRESS: %s %s\n", phase, p->event);
+}
+
 int main(int argc, char *argv[])
 {
     GuestConv *gc;
@@ -29,6 +42,8 @@ int main(int argc, char *argv[])
         return 1;
     }
 
+    guestconv_set_progress_cb(gc, progress);
+
     guestconv_add_drive(gc, drive);
     if (guestconv_err(gc)) {
         fprintf(stderr, "error adding drive: %s\n", gc->error);
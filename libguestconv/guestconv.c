@@ -1,18 +1,51 @@
 #include "guestconv.h"
+#include <pthread.h>
 #include <stdio.h>
 #include <string.h>
 
-static GuestConvLoggerFunc guestconv_logger_func = NULL;
+struct _GuestConvJob {
+    GuestConv *gc;
+    PyObject *future;
+    GuestConvJobFunc callback;
+    void *opaque;
+    GuestConvJobState state;
+    char *result;
+    char *error;
+    char *error_type;
+    /* Set while guestconv_job_start is running, and if the job completed
+       during that time. Both require the GIL. */
+    int starting;
+    int completed;
+};
+
+/* The main thread doesn't hold the GIL between calls into guestconv. Any
+   thread may call into guestconv. */
+static pthread_once_t guestconv_python_once = PTHREAD_ONCE_INIT;
+
+#define GUESTCONV_ENTER \
+    PyGILState_STATE gil_state = PyGILState_Ensure()
+#define GUESTCONV_LEAVE \
+    PyGILState_Release(gil_state)
+
+/* Python callbacks into C are bound to a capsule containing the GuestConv
+   or GuestConvJob they belong to */
+static void *
+libconv_self(PyObject *self)
+{
+    return PyCapsule_GetPointer(self, NULL);
+}
 
 /* First step is to set up a logging callback so we can get info
    back to the user. */
 static PyObject *
 libconv_log(PyObject *self, PyObject *args)
 {
+    GuestConv *gc = libconv_self(self);
     int loglvl;
     char *logstr;
 
-    if (guestconv_logger_func == NULL) {
+    if (gc == NULL || gc->logger_func == NULL) {
+        PyErr_Clear();
         return Py_BuildValue("i", 0);
     }
 
@@ -21,32 +54,187 @@ libconv_log(PyObject *self, PyObject *args)
         return Py_BuildValue("i", 0);
     }
 
-    guestconv_logger_func(loglvl, logstr);
+    gc->logger_func(loglvl, logstr);
 
     return Py_BuildValue("i", 0);
 }
 
-static PyMethodDef LibconvLogMethods[] = {
-    {"libconv_log",  libconv_log, METH_VARARGS, "Log a message."},
-    {NULL, NULL, 0, NULL}
-};
+/* Return the value of key in dict as a utf-8 string, or NULL. The string
+   is owned by dict. */
+static const char *
+libconv_dict_string(PyObject *dict, const char *key)
+{
+    PyObject *value;
+
+    value = PyDict_GetItemString(dict, key);
+    if (value == NULL)
+        return NULL;
+
+    if (PyUnicode_Check(value)) {
+        PyObject *encoded;
+        int err;
+
+        encoded = PyUnicode_AsUTF8String(value);
+        if (encoded == NULL) {
+            PyErr_Clear();
+            return NULL;
+        }
+        err = PyDict_SetItemString(dict, key, encoded);
+        Py_DECREF(encoded);
+        if (err != 0) {
+            PyErr_Clear();
+            return NULL;
+        }
+        value = encoded;
+    }
 
-/* initialize the module and return the logging function defined above */
+    if (!PyString_Check(value))
+        return NULL;
+
+    return PyString_AsString(value);
+}
+
+/* Return the integer value of key in dict, or 0 */
+static unsigned long long
+libconv_dict_ull(PyObject *dict, const char *key)
+{
+    PyObject *value;
+    unsigned long long ret;
+
+    value = PyDict_GetItemString(dict, key);
+    if (value == NULL || !(PyInt_Check(value) || PyLong_Check(value)))
+        return 0;
+
+    ret = PyLong_AsUnsignedLongLongMask(value);
+    if (PyErr_Occurred()) {
+        PyErr_Clear();
+        return 0;
+    }
+
+    return ret;
+}
+
+/* Deliver progress events from Converter.set_progress_callback */
 static PyObject *
-guestconv_get_local_log_func(void)
+libconv_progress(PyObject *self, PyObject *args)
 {
-    PyObject *log_module;
-    PyObject *log_func;
+    GuestConv *gc = libconv_self(self);
+    PyObject *event;
+    GuestConvProgress progress;
 
-    // Initialize the guestconv logging method which we will define
-    // in C so we can recieve messages from guestconv.
-    log_module = Py_InitModule("LibconvLog", LibconvLogMethods);
-    if (log_module == NULL) {
-        return NULL;
+    if (gc == NULL || gc->progress_func == NULL) {
+        PyErr_Clear();
+        return Py_BuildValue("i", 0);
     }
-    log_func = PyObject_GetAttrString(log_module, "libconv_log");
 
-    return log_func;
+    if (!PyArg_ParseTuple(args, "O!", &PyDict_Type, &event)) {
+        fprintf(stderr, "Unable to parse progress arguments.\n");
+        return Py_BuildValue("i", 0);
+    }
+
+    progress.event = libconv_dict_string(event, "event");
+    progress.phase = libconv_dict_string(event, "phase");
+    progress.guest = libconv_dict_string(event, "guest");
+    progress.root = libconv_dict_string(event, "root");
+    progress.message = libconv_dict_string(event, "message");
+    progress.position = libconv_dict_ull(event, "position");
+    progress.total = libconv_dict_ull(event, "total");
+
+    gc->progress_func(&progress);
+
+    return Py_BuildValue("i", 0);
+}
+
+static void guestconv_job_update(GuestConvJob *job);
+
+/* Record the outcome of a completed job, and call its callback. Requires
+   the GIL. */
+static void
+guestconv_job_deliver(GuestConvJob *job)
+{
+    GuestConvJobFunc callback;
+    void *opaque;
+
+    guestconv_job_update(job);
+
+    /* The callback may free the job */
+    callback = job->callback;
+    opaque = job->opaque;
+    if (callback != NULL) {
+        Py_BEGIN_ALLOW_THREADS
+        callback(job, opaque);
+        Py_END_ALLOW_THREADS
+    }
+}
+
+/* Deliver the completion of a job which completed while it was starting */
+static void *
+guestconv_job_deliver_thread(void *arg)
+{
+    GuestConvJob *job = arg;
+
+    GUESTCONV_ENTER;
+    guestconv_job_deliver(job);
+    GUESTCONV_LEAVE;
+
+    return NULL;
+}
+
+/* Called by the job's future when it completes, from the thread which ran
+   the job. If the future has already completed when the callback is added,
+   it is called by guestconv_job_start itself. */
+static PyObject *
+libconv_job_done(PyObject *self, PyObject *args)
+{
+    GuestConvJob *job = libconv_self(self);
+
+    if (job == NULL) {
+        PyErr_Clear();
+        return Py_BuildValue("i", 0);
+    }
+
+    /* The callback may free the job, which the caller of
+       guestconv_job_start hasn't received yet */
+    if (job->starting) {
+        job->completed = 1;
+        return Py_BuildValue("i", 0);
+    }
+
+    guestconv_job_deliver(job);
+
+    return Py_BuildValue("i", 0);
+}
+
+static PyMethodDef LibconvLogMethod =
+    {"libconv_log", libconv_log, METH_VARARGS, "Log a message."};
+static PyMethodDef LibconvProgressMethod =
+    {"libconv_progress", libconv_progress, METH_VARARGS, "Report progress."};
+static PyMethodDef LibconvJobDoneMethod =
+    {"libconv_job_done", libconv_job_done, METH_VARARGS, "Complete a job."};
+
+/* Return a python function which calls method with self. Returns a new
+   reference, or NULL on error. */
+static PyObject *
+guestconv_get_local_func(PyMethodDef *method, void *self)
+{
+    PyObject *capsule, *func;
+
+    capsule = PyCapsule_New(self, NULL, NULL);
+    if (capsule == NULL)
+        return NULL;
+
+    func = PyCFunction_New(method, capsule);
+    Py_DECREF(capsule);
+
+    return func;
+}
+
+/* Detach a function returned by guestconv_get_local_func from its self,
+   which is about to be freed. Later calls find no GuestConv or job. */
+static void
+guestconv_clear_local_func(PyObject *func)
+{
+    PyCapsule_SetName(PyCFunction_GET_SELF(func), "guestconv.freed");
 }
 
 
@@ -66,6 +254,10 @@ guestconv_new(void)
     guestconv->backtrace = NULL;
     guestconv->pyth_module = NULL;
     guestconv->gc_inst = NULL;
+    guestconv->async_inst = NULL;
+    guestconv->logger = NULL;
+    guestconv->logger_func = NULL;
+    guestconv->progress_func = NULL;
 
     return guestconv;
 }
@@ -124,10 +316,85 @@ guestconv_err(GuestConv *gc)
 }
 
 
+/* Wrap the local logging function in a python logger. If queue_size is
+   greater than 0, the logger delivers messages from a background thread.
+   Returns a new reference, or NULL on error. */
+static PyObject *
+guestconv_get_logger(PyObject *local_log_func, int queue_size,
+                     GuestConvLogOverflow overflow)
+{
+    PyObject *module_name, *log_module, *pyth_func, *kwargs, *args;
+    PyObject *logger = NULL;
+
+    module_name = PyString_FromString("guestconv.log");
+    log_module = PyImport_Import(module_name);
+    Py_DECREF(module_name);
+    if (log_module == NULL)
+        return NULL;
+
+    pyth_func = PyObject_GetAttrString(log_module, "get_logger_object");
+    Py_DECREF(log_module);
+    if (pyth_func == NULL)
+        return NULL;
+
+    args = Py_BuildValue("(O)", local_log_func);
+    if (queue_size > 0)
+        kwargs = Py_BuildValue("{s:i,s:s}", "queueSize", queue_size,
+                               "overflow", overflow == GUESTCONV_LOG_DROP ?
+                                           "drop" : "block");
+    else
+        kwargs = PyDict_New();
+    if (args != NULL && kwargs != NULL)
+        logger = PyObject_Call(pyth_func, args, kwargs);
+
+    Py_XDECREF(args);
+    Py_XDECREF(kwargs);
+    Py_DECREF(pyth_func);
+
+    return logger;
+}
+
+
+/* Initialize python the first time guestconv is used */
+static void
+guestconv_init_python_once(void)
+{
+    /* The application embeds python itself, and the calling thread holds
+       the interpreter. Callbacks from other threads need the GIL, which
+       python only creates once threads are used. The application keeps
+       the GIL, so they run whenever it releases it. */
+    if (Py_IsInitialized()) {
+        if (!PyEval_ThreadsInitialized())
+            PyEval_InitThreads();
+        return;
+    }
+
+    Py_Initialize();
+    /* Logging, progress and job completion call back into C from other
+       threads */
+    PyEval_InitThreads();
+    PyEval_SaveThread();
+}
+
+static void
+guestconv_init_python(void)
+{
+    pthread_once(&guestconv_python_once, guestconv_init_python_once);
+}
+
 /* Load the python guestconv module and call the init
    method all the while doing loads of error checking. */
 GuestConv *
 guestconv_init(char *target, char *database_location, GuestConvLoggerFunc logger_func)
+{
+    return guestconv_init_log_queue(target, database_location, logger_func,
+                                    0, GUESTCONV_LOG_BLOCK);
+}
+
+GuestConv *
+guestconv_init_log_queue(char *target, char *database_location,
+                         GuestConvLoggerFunc logger_func,
+                         int queue_size, GuestConvLogOverflow overflow)
 {
     PyObject *module_name, *pyth_module, *pyth_func;
     PyObject *pyth_val;
@@ -138,22 +405,42 @@ guestconv_init(char *target, char *database_location, GuestConvLoggerFunc logger
     if (gc == NULL)
         return gc;
 
-    guestconv_logger_func = logger_func;
+    gc->logger_func = logger_func;
+
+    guestconv_init_python();
+
+    GUESTCONV_ENTER;
 
-    Py_Initialize();
     module_name = PyString_FromString("guestconv");
 
     pyth_module = PyImport_Import(module_name);
     Py_DECREF(module_name);
 
     if (pyth_module == NULL) {
+        PyErr_Clear();
         gc->error = "Cannot load python module 'guestconv'";
-        return gc;
+        goto out;
     }
 
     gc->pyth_module = pyth_module;
 
-    local_log_func = guestconv_get_local_log_func();
+    local_log_func = guestconv_get_local_func(&LibconvLogMethod, gc);
+
+    if (local_log_func != NULL) {
+        PyObject *logger;
+
+        logger = guestconv_get_logger(local_log_func, queue_size, overflow);
+        Py_DECREF(local_log_func);
+        if (logger == NULL) {
+            guestconv_check_pyerr(gc);
+            goto out;
+        }
+        gc->logger = logger;
+        local_log_func = logger;
+    } else {
+        guestconv_check_pyerr(gc);
+        goto out;
+    }
 
     pyth_func = PyObject_GetAttrString(pyth_module, "Converter");
 
@@ -166,12 +453,14 @@ guestconv_init(char *target, char *database_location, GuestConvLoggerFunc logger
             Py_DECREF(pyth_func);
             Py_DECREF(pyth_module);
             guestconv_check_pyerr(gc);
-            return gc;
+            goto out;
         }
     } else {
         guestconv_check_pyerr(gc);
     }
 
+out:
+    GUESTCONV_LEAVE;
     return gc;
 }
 
@@ -183,8 +472,10 @@ guestconv_add_drive(GuestConv *gc, char *drive)
         return;
     }
 
+    GUESTCONV_ENTER;
     PyObject_CallMethod(gc->gc_inst, "add_drive", "s", drive);
     guestconv_check_pyerr(gc);
+    GUESTCONV_LEAVE;
 }
 
 char *
@@ -198,11 +489,13 @@ guestconv_inspect(GuestConv *gc)
         return NULL;
     }
 
+    GUESTCONV_ENTER;
     ret = PyObject_CallMethod(gc->gc_inst, "inspect", NULL);
     guestconv_check_pyerr(gc);
 
     if (!guestconv_err(gc))
         str = PyString_AsString(ret);
+    GUESTCONV_LEAVE;
 
     return str;
 }
@@ -215,7 +508,352 @@ guestconv_convert(GuestConv *gc, char *description)
         return;
     }
 
+    GUESTCONV_ENTER;
     PyObject_CallMethod(gc->gc_inst, "convert", "s", description);
     guestconv_check_pyerr(gc);
+    GUESTCONV_LEAVE;
 }
 
+long
+guestconv_log_dropped(GuestConv *gc)
+{
+    PyObject *handlers, *handler, *dropped;
+    long ret = 0;
+
+    if (gc->logger == NULL)
+        return 0;
+
+    GUESTCONV_ENTER;
+    handlers = PyObject_GetAttrString(gc->logger, "handlers");
+    if (handlers == NULL) {
+        guestconv_check_pyerr(gc);
+        GUESTCONV_LEAVE;
+        return 0;
+    }
+
+    if (PyList_Size(handlers) > 0) {
+        handler = PyList_GetItem(handlers, 0);
+        dropped = PyObject_GetAttrString(handler, "dropped");
+        if (dropped != NULL) {
+            ret = PyInt_AsLong(dropped);
+            Py_DECREF(dropped);
+        }
+    }
+    Py_DECREF(handlers);
+    guestconv_check_pyerr(gc);
+    GUESTCONV_LEAVE;
+
+    return ret;
+}
+
+void
+guestconv_set_log_level(GuestConv *gc, int level)
+{
+    if (gc->logger == NULL) {
+        gc->error = "guestconv logger was never initialized.";
+        return;
+    }
+
+    GUESTCONV_ENTER;
+    Py_XDECREF(PyObject_CallMethod(gc->logger, "setLevel", "i", level));
+    guestconv_check_pyerr(gc);
+    GUESTCONV_LEAVE;
+}
+
+void
+guestconv_set_progress_cb(GuestConv *gc, GuestConvProgressFunc progress_func)
+{
+    PyObject *func, *ret;
+
+    if (gc->gc_inst == NULL) {
+        gc->error = "guestconv instance was never initialized.";
+        return;
+    }
+
+    GUESTCONV_ENTER;
+
+    gc->progress_func = progress_func;
+
+    if (progress_func == NULL) {
+        ret = PyObject_CallMethod(gc->gc_inst, "set_progress_callback",
+                                  "O", Py_None);
+        Py_XDECREF(ret);
+        guestconv_check_pyerr(gc);
+        goto out;
+    }
+
+    func = guestconv_get_local_func(&LibconvProgressMethod, gc);
+    if (func == NULL) {
+        guestconv_check_pyerr(gc);
+        goto out;
+    }
+
+    ret = PyObject_CallMethod(gc->gc_inst, "set_progress_callback",
+                              "O", func);
+    Py_DECREF(func);
+    Py_XDECREF(ret);
+    guestconv_check_pyerr(gc);
+
+out:
+    GUESTCONV_LEAVE;
+}
+
+
+/* Return the AsyncConverter wrapping gc's Converter, creating it if
+   necessary. Returns a borrowed reference, or NULL on error. Requires the
+   GIL. */
+static PyObject *
+guestconv_get_async(GuestConv *gc)
+{
+    PyObject *module_name, *worker_module, *pyth_func;
+
+    if (gc->async_inst != NULL)
+        return gc->async_inst;
+
+    module_name = PyString_FromString("guestconv.worker");
+    worker_module = PyImport_Import(module_name);
+    Py_DECREF(module_name);
+    if (worker_module == NULL)
+        return NULL;
+
+    pyth_func = PyObject_GetAttrString(worker_module, "AsyncConverter");
+    Py_DECREF(worker_module);
+    if (pyth_func == NULL)
+        return NULL;
+
+    gc->async_inst = PyObject_CallFunctionObjArgs(pyth_func, gc->gc_inst,
+                                                  NULL);
+    Py_DECREF(pyth_func);
+
+    return gc->async_inst;
+}
+
+/* Record the outcome of job if its future has completed. Requires the
+   GIL. */
+static void
+guestconv_job_update(GuestConvJob *job)
+{
+    PyObject *ret, *ex;
+
+    if (job->state != GUESTCONV_JOB_RUNNING)
+        return;
+
+    ret = PyObject_CallMethod(job->future, "done", NULL);
+    if (ret == NULL) {
+        PyErr_Clear();
+        return;
+    }
+    if (ret != Py_True) {
+        Py_DECREF(ret);
+        return;
+    }
+    Py_DECREF(ret);
+
+    /* The future is done, so this doesn't block */
+    ex = PyObject_CallMethod(job->future, "exception", NULL);
+    if (ex == NULL) {
+        /* The future was cancelled */
+        PyErr_Clear();
+        job->error = strdup("Job was cancelled");
+        job->error_type = strdup("CancelledError");
+        job->state = GUESTCONV_JOB_FAILED;
+        return;
+    }
+
+    if (ex != Py_None) {
+        PyObject *pystr;
+
+        pystr = PyObject_Str(ex);
+        if (pystr != NULL) {
+            job->error = strdup(PyString_AsString(pystr));
+            Py_DECREF(pystr);
+        }
+        pystr = PyObject_GetAttrString((PyObject *)Py_TYPE(ex), "__name__");
+        if (pystr != NULL) {
+            job->error_type = strdup(PyString_AsString(pystr));
+            Py_DECREF(pystr);
+        }
+        PyErr_Clear();
+        Py_DECREF(ex);
+        job->state = GUESTCONV_JOB_FAILED;
+        return;
+    }
+    Py_DECREF(ex);
+
+    ret = PyObject_CallMethod(job->future, "result", NULL);
+    if (ret != NULL && PyString_Check(ret))
+        job->result = strdup(PyString_AsString(ret));
+    Py_XDECREF(ret);
+    PyErr_Clear();
+
+    job->state = GUESTCONV_JOB_DONE;
+}
+
+/* Start an operation of gc's AsyncConverter */
+static GuestConvJob *
+guestconv_job_start(GuestConv *gc, const char *method, const char *description,
+                    GuestConvJobFunc callback, void *opaque)
+{
+    PyObject *async_inst, *done_func, *ret;
+    GuestConvJob *job;
+
+    if (gc->gc_inst == NULL) {
+        gc->error = "guestconv instance was never initialized.";
+        return NULL;
+    }
+
+    job = calloc(1, sizeof(GuestConvJob));
+    if (job == NULL) {
+        gc->error = "Unable to allocate memory for guestconv job.";
+        return NULL;
+    }
+    job->gc = gc;
+    job->callback = callback;
+    job->opaque = opaque;
+    job->state = GUESTCONV_JOB_RUNNING;
+    job->starting = 1;
+
+    GUESTCONV_ENTER;
+
+    async_inst = guestconv_get_async(gc);
+    if (async_inst == NULL)
+        goto error;
+
+    if (description == NULL)
+        job->future = PyObject_CallMethod(async_inst, (char *)method, NULL);
+    else
+        job->future = PyObject_CallMethod(async_inst, (char *)method, "s",
+                                          description);
+    if (job->future == NULL)
+        goto error;
+
+    done_func = guestconv_get_local_func(&LibconvJobDoneMethod, job);
+    if (done_func == NULL)
+        goto error;
+
+    /* If the job has already completed, this calls done_func immediately,
+       which defers completion */
+    ret = PyObject_CallMethod(job->future, "add_done_callback", "O",
+                              done_func);
+    if (ret == NULL) {
+        /* done_func may still have been added, and be called when the job
+           completes, after the job has been freed */
+        guestconv_check_pyerr(gc);
+        Py_XDECREF(PyObject_CallMethod(job->future, "cancel", NULL));
+        PyErr_Clear();
+        guestconv_clear_local_func(done_func);
+        Py_DECREF(done_func);
+        goto error;
+    }
+    Py_DECREF(done_func);
+    Py_DECREF(ret);
+
+    job->starting = 0;
+    if (job->completed) {
+        pthread_t thread;
+
+        /* Call the callback from another thread, as it would have been if
+           the job had taken longer */
+        if (pthread_create(&thread, NULL, guestconv_job_deliver_thread,
+                           job) != 0) {
+            gc->error = "Unable to start a thread for guestconv job.";
+            goto error;
+        }
+        pthread_detach(thread);
+    }
+
+    GUESTCONV_LEAVE;
+    return job;
+
+error:
+    guestconv_check_pyerr(gc);
+    Py_XDECREF(job->future);
+    free(job);
+    GUESTCONV_LEAVE;
+    return NULL;
+}
+
+GuestConvJob *
+guestconv_inspect_start(GuestConv *gc, GuestConvJobFunc callback,
+                        void *opaque)
+{
+    return guestconv_job_start(gc, "inspect", NULL, callback, opaque);
+}
+
+GuestConvJob *
+guestconv_convert_start(GuestConv *gc, char *description,
+                        GuestConvJobFunc callback, void *opaque)
+{
+    return guestconv_job_start(gc, "convert", description, callback, opaque);
+}
+
+GuestConvJobState
+guestconv_job_poll(GuestConvJob *job)
+{
+    GuestConvJobState state;
+
+    GUESTCONV_ENTER;
+    guestconv_job_update(job);
+    state = job->state;
+    GUESTCONV_LEAVE;
+
+    return state;
+}
+
+GuestConvJobState
+guestconv_job_wait(GuestConvJob *job)
+{
+    GuestConvJobState state;
+
+    GUESTCONV_ENTER;
+    /* Waiting for the future releases the GIL */
+    Py_XDECREF(PyObject_CallMethod(job->future, "exception", NULL));
+    PyErr_Clear();
+    guestconv_job_update(job);
+    state = job->state;
+    GUESTCONV_LEAVE;
+
+    return state;
+}
+
+void
+guestconv_job_cancel(GuestConvJob *job)
+{
+    GUESTCONV_ENTER;
+    Py_XDECREF(PyObject_CallMethod(job->future, "cancel", NULL));
+    PyErr_Clear();
+    GUESTCONV_LEAVE;
+}
+
+const char *
+guestconv_job_result(GuestConvJob *job)
+{
+    return job->result;
+}
+
+const char *
+guestconv_job_error(GuestConvJob *job)
+{
+    return job->error;
+}
+
+const char *
+guestconv_job_error_type(GuestConvJob *job)
+{
+    return job->error_type;
+}
+
+void
+guestconv_job_free(GuestConvJob *job)
+{
+    guestconv_job_wait(job);
+
+    GUESTCONV_ENTER;
+    Py_DECREF(job->future);
+    GUESTCONV_LEAVE;
+
+    free(job->result);
+    free(job->error);
+    free(job->error_type);
+    free(job);
+}
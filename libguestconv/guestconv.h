@@ -5,19 +5,75 @@
 
 typedef void (*GuestConvLoggerFunc)(int level, char *message);
 
+/* A progress event. See Converter.set_progress_callback for the meaning of
+   each field. Strings are utf-8, and are NULL if not relevant to the event.
+   position and total are 0 except for progress events. The event is only
+   valid for the duration of the callback. */
+typedef struct {
+    const char *event;
+    const char *phase;
+    const char *guest;
+    const char *root;
+    const char *message;
+    unsigned long long position;
+    unsigned long long total;
+} GuestConvProgress;
+
+typedef void (*GuestConvProgressFunc)(const GuestConvProgress *progress);
+
+/* What to do with a log message when the log queue is full */
+typedef enum {
+    GUESTCONV_LOG_BLOCK,
+    GUESTCONV_LOG_DROP
+} GuestConvLogOverflow;
+
 typedef struct {
     PyObject *pyth_module;
     PyObject *gc_inst;
+    PyObject *async_inst;
+    PyObject *logger;
+    GuestConvLoggerFunc logger_func;
+    GuestConvProgressFunc progress_func;
     char *error;
     char *error_type;
     char *backtrace;
 } GuestConv;
 
+/* An inspection or conversion running in the background */
+typedef struct _GuestConvJob GuestConvJob;
+
+typedef enum {
+    GUESTCONV_JOB_RUNNING,
+    GUESTCONV_JOB_DONE,
+    GUESTCONV_JOB_FAILED
+} GuestConvJobState;
+
+/* Called from a guestconv thread when a job completes */
+typedef void (*GuestConvJobFunc)(GuestConvJob *job, void *opaque);
+
+/* Any thread may call guestconv functions, and any number of GuestConv
+   instances may be used concurrently. A single GuestConv instance must not
+   be used by more than one thread at a time, except for the guestconv_job_*
+   functions. Callbacks are called from guestconv threads.
+
+   An application which embeds python itself must initialize it before
+   calling guestconv, and must not hold the GIL between calls into guestconv,
+   or callbacks are only delivered while it runs python code. */
+
 
 /* logger_func here can be NULL if you don't wish to have any logging callbacks. */
 GuestConv *
 guestconv_init(char *target, char *database_location, GuestConvLoggerFunc logger_func);
 
+/* As guestconv_init, but logger_func is called from a background thread.
+   At most queue_size messages may be waiting for delivery. When the queue
+   is full, overflow determines whether logging blocks or the message is
+   dropped. A queue_size of 0 is equivalent to guestconv_init. */
+GuestConv *
+guestconv_init_log_queue(char *target, char *database_location,
+                         GuestConvLoggerFunc logger_func,
+                         int queue_size, GuestConvLogOverflow overflow);
+
 int
 guestconv_err(GuestConv *gc);
 
@@ -30,4 +86,62 @@ guestconv_inspect(GuestConv *gc);
 void
 guestconv_convert(GuestConv *gc, char *description);
 
+/* The number of log messages dropped because the log queue was full */
+long
+guestconv_log_dropped(GuestConv *gc);
+
+/* Don't create or deliver log messages below level, which is one of the
+   python logging levels (e.g. DEBUG=10, INFO=20). By default the logger
+   function receives all messages. */
+void
+guestconv_set_log_level(GuestConv *gc, int level);
+
+/* Call progress_func with progress and phase events during inspection and
+   conversion. progress_func may be NULL to stop receiving events. */
+void
+guestconv_set_progress_cb(GuestConv *gc, GuestConvProgressFunc progress_func);
+
+/* Start inspecting or converting in the background. Returns immediately
+   with a job, or NULL on error. If callback is not NULL, it is called with
+   the job and opaque when the job completes, from a guestconv thread, and
+   never by the start function itself. Jobs of the same GuestConv run one
+   at a time, in the order they were started. */
+GuestConvJob *
+guestconv_inspect_start(GuestConv *gc, GuestConvJobFunc callback,
+                        void *opaque);
+
+GuestConvJob *
+guestconv_convert_start(GuestConv *gc, char *description,
+                        GuestConvJobFunc callback, void *opaque);
+
+/* Return the state of a job without blocking */
+GuestConvJobState
+guestconv_job_poll(GuestConvJob *job);
+
+/* Wait for a job to complete, and return its final state */
+GuestConvJobState
+guestconv_job_wait(GuestConvJob *job);
+
+/* Cancel a job. A running job's appliance is killed. The job still
+   completes, with state GUESTCONV_JOB_FAILED. */
+void
+guestconv_job_cancel(GuestConvJob *job);
+
+/* The inspection XML of a successful inspect job, or NULL. The string is
+   owned by the job. */
+const char *
+guestconv_job_result(GuestConvJob *job);
+
+/* The error message and exception type of a failed job, or NULL */
+const char *
+guestconv_job_error(GuestConvJob *job);
+
+const char *
+guestconv_job_error_type(GuestConvJob *job);
+
+/* Wait for a job to complete, then free it. This may be called from the
+   job's completion callback. */
+void
+guestconv_job_free(GuestConvJob *job);
+
 #endif
@@ -18,7 +18,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import os
-from distutils.core import setup
+from setuptools import setup
 
 data_files = [("/etc", ["conf/guestconv.db"]),
               ('/usr/share/guestconv/',
@@ -30,4 +30,6 @@ setup(name='guestconv',
 	url='http://',
 	packages=['guestconv', 'guestconv.converters'],
 	data_files=data_files,
+	# concurrent.futures is only in the standard library since Python 3.2
+	install_requires=['futures'],
 	scripts=[])
@@ -0,0 +1,125 @@
+# test/async_converter.py unit test suite for
+# guestconv background conversions
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import time
+import unittest
+
+from guestconv.exception import ConversionCancelled, ConversionTimeout
+from guestconv.worker import AsyncConverter, Limiter
+
+class SlowConverter(object):
+    """Stands in for a Converter whose appliance takes time to respond"""
+
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def __init__(self, duration):
+        self._duration = duration
+        self._killed = threading.Event()
+
+    def inspect(self, structured=False):
+        cls = SlowConverter
+        with cls.lock:
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+        try:
+            if self._killed.wait(self._duration):
+                raise RuntimeError(u'appliance closed the connection')
+            return u'<guestconv/>'
+        finally:
+            with cls.lock:
+                cls.running -= 1
+
+    def convert(self, desc):
+        return self.inspect()
+
+    def kill(self):
+        self._killed.set()
+
+
+class AsyncConverterTest(unittest.TestCase):
+    def setUp(self):
+        SlowConverter.max_running = 0
+
+    def testResult(self):
+        c = AsyncConverter(SlowConverter(0))
+        self.assertEqual(c.inspect().result(5), u'<guestconv/>')
+        self.assertEqual(c.convert(u'<guestconv/>').result(5),
+                         u'<guestconv/>')
+
+    def testLimiter(self):
+        limiter = Limiter(2)
+        converters = [AsyncConverter(SlowConverter(0.2), limiter)
+                      for i in range(5)]
+        futures = [c.inspect() for c in converters]
+        for c, f in zip(converters, futures):
+            self.assertEqual(f.result(5), u'<guestconv/>')
+            c.close()
+        self.assertEqual(SlowConverter.max_running, 2)
+
+    def testAdmissionLifetime(self):
+        # A conversion is admitted until it is closed, as its appliance is
+        # still running between operations
+        limiter = Limiter(1)
+        first = AsyncConverter(SlowConverter(0), limiter)
+        self.assertEqual(first.inspect().result(5), u'<guestconv/>')
+
+        second = AsyncConverter(SlowConverter(0), limiter).inspect()
+        time.sleep(0.2)
+        self.assertFalse(second.done())
+
+        first.close()
+        self.assertEqual(second.result(5), u'<guestconv/>')
+
+        # Closing again has no effect
+        first.close()
+
+    def testTimeout(self):
+        c = AsyncConverter(SlowConverter(10))
+        start = time.time()
+        self.assertRaises(ConversionTimeout, c.inspect(timeout=0.1).result, 5)
+        self.assertLess(time.time() - start, 5)
+
+    def testCancel(self):
+        c = AsyncConverter(SlowConverter(10))
+        running = c.inspect()
+        pending = c.convert(u'<guestconv/>')
+        while not running.running():
+            time.sleep(0.01)
+
+        self.assertTrue(pending.cancel())
+        running.cancel()
+        self.assertRaises(ConversionCancelled, running.result, 5)
+
+        # The converter can't be used after cancellation
+        self.assertRaises(ConversionCancelled, c.inspect().result, 5)
+
+    def testCancelPending(self):
+        c = AsyncConverter(SlowConverter(0.2))
+        running = c.inspect()
+        pending = c.inspect()
+        self.assertTrue(pending.cancel())
+
+        # Only the pending operation is cancelled
+        self.assertEqual(running.result(5), u'<guestconv/>')
+        self.assertEqual(c.inspect().result(5), u'<guestconv/>')
+
+
+all_tests = unittest.makeSuite(AsyncConverterTest)
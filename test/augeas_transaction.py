@@ -0,0 +1,69 @@
+# test/augeas_transaction.py unit test suite for
+# guestconv batched augeas modifications
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import unittest
+
+from guestconv.converters.util import AugeasTransaction
+
+class AugeasTree(object):
+    """Stands in for a libguestfs handle with augeas initialised"""
+
+    def __init__(self, nodes):
+        self.saved = dict(nodes)
+        self.nodes = dict(nodes)
+        self.saves = 0
+
+    def aug_set(self, path, value):
+        self.nodes[path] = value
+
+    def aug_save(self):
+        self.saves += 1
+        self.saved = dict(self.nodes)
+
+    def aug_load(self):
+        self.nodes = dict(self.saved)
+
+
+class AugeasTransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.h = AugeasTree({u'/files/etc/hosts/1/ipaddr': u'127.0.0.1'})
+        self.aug = AugeasTransaction(self.h)
+
+    def testPhase(self):
+        with self.aug.phase():
+            self.aug.set(u'/files/etc/hosts/1/ipaddr', u'::1')
+            self.assertEqual(self.h.saves, 0)
+        self.assertEqual(self.h.saves, 1)
+        self.assertEqual(self.h.saved[u'/files/etc/hosts/1/ipaddr'], u'::1')
+
+    def testFailedPhase(self):
+        def fail():
+            with self.aug.phase():
+                self.aug.set(u'/files/etc/hosts/1/ipaddr', u'::1')
+                raise RuntimeError(u'failed')
+        self.assertRaises(RuntimeError, fail)
+
+        # The failed phase's modifications are not saved by the next one
+        self.assertEqual(self.h.nodes[u'/files/etc/hosts/1/ipaddr'],
+                         u'127.0.0.1')
+        with self.aug.phase():
+            pass
+        self.assertEqual(self.h.saves, 0)
+
+
+all_tests = unittest.makeSuite(AugeasTransactionTest)
@@ -0,0 +1,301 @@
+# test/change_journal.py unit test suite for
+# guestconv modified file tracking
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import unittest
+
+from guestconv.converters.util import ChangeJournal, UndoJournal, \
+                                      selinux_relabel
+
+SELINUX_CONFIG = [u'# comment', u'SELINUX=enforcing', u'SELINUXTYPE=targeted']
+FILE_CONTEXTS = u'/etc/selinux/targeted/contexts/files/file_contexts'
+
+# Packages available to yum, and the files they install
+REPOSITORY = {
+    u'kernel-2.6.32-431.el6.x86_64': [u'/boot/vmlinuz-2.6.32-431.el6.x86_64',
+                                      u'/lib/modules/2.6.32-431.el6.x86_64']
+}
+
+class GuestFiles(object):
+    """Stands in for a libguestfs handle with a guest mounted"""
+
+    def __init__(self, files):
+        self.files = dict(files)
+        self.modes = {}
+        self.relabelled = []
+        self.saved = []
+        self.augeas = {}
+        self.save_mode = u'overwrite'
+        self.gpt_types = {}
+        self.packages = {}
+        self.labels = {}
+
+    def write_file(self, path, content, size):
+        self.files[path] = content
+
+    def mv(self, src, dest):
+        self.files[dest] = self.files.pop(src)
+
+    def rm(self, path):
+        del self.files[path]
+
+    def rm_rf(self, path):
+        self.files.pop(path, None)
+
+    def touch(self, path):
+        self.files.setdefault(path, u'')
+
+    def command(self, argv):
+        if argv[0:2] == [u'rpm', u'-e']:
+            for package in argv[2:]:
+                for path in self.packages.pop(package, []):
+                    self.files.pop(path, None)
+        elif argv[0:3] == [u'yum', u'install', u'-y']:
+            for package in argv[3:]:
+                self.packages[package] = REPOSITORY[package]
+                for path in REPOSITORY[package]:
+                    self.files[path] = u''
+        return u''
+
+    def command_lines(self, argv):
+        if argv[0:2] == [u'rpm', u'-qa']:
+            return list(self.packages)
+        if argv[0:2] == [u'rpm', u'-ql']:
+            return [path for package in argv[2:]
+                    for path in self.packages[package]]
+        return []
+
+    def exists(self, path):
+        return path in self.files
+
+    is_file = exists
+
+    def is_symlink(self, path):
+        return False
+
+    def lstat(self, path):
+        return {u'mode': self.modes.get(path, 0100644), u'uid': 0,
+                u'gid': 0}
+
+    def chmod(self, mode, path):
+        self.modes[path] = 0100000 | mode
+
+    def chown(self, uid, gid, path):
+        pass
+
+    def download(self, path, filename):
+        with open(filename, u'w') as f:
+            f.write(self.files[path])
+
+    def upload(self, filename, path):
+        with open(filename) as f:
+            self.files[path] = f.read()
+        self.labels.pop(path, None)
+
+    def lgetxattr(self, path, name):
+        try:
+            return self.labels[path]
+        except KeyError:
+            raise RuntimeError(u'lgetxattr: No data available')
+
+    def lsetxattr(self, xattr, val, vallen, path):
+        self.labels[path] = val
+
+    def read_lines(self, path):
+        return self.files[path]
+
+    def aug_save(self):
+        if self.save_mode != u'noop':
+            self.files.update(self.augeas)
+
+    def aug_match(self, path):
+        return [u'/augeas/events/saved[{}]'.format(i + 1)
+                for i in range(len(self.saved))]
+
+    def aug_get(self, path):
+        if path == u'/augeas/save':
+            return self.save_mode
+        return self.saved[int(path[-2]) - 1]
+
+    def aug_set(self, path, value):
+        self.save_mode = value
+
+    def part_get_gpt_type(self, device, partnum):
+        return self.gpt_types[(device, partnum)]
+
+    def part_set_gpt_type(self, device, partnum, guid):
+        self.gpt_types[(device, partnum)] = guid
+
+    def feature_available(self, features):
+        return True
+
+    def selinux_relabel(self, specfile, path, force=False):
+        self.relabelled.append(path)
+
+
+class ChangeJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.guest = GuestFiles({u'/etc/selinux/config': SELINUX_CONFIG,
+                                 FILE_CONTEXTS: u'',
+                                 u'/etc/resolv.conf': u''})
+        self.h = ChangeJournal(self.guest)
+        self.logger = logging.getLogger(u'test')
+
+    def testRecord(self):
+        h = self.h
+        h.mv(u'/etc/resolv.conf', u'/etc/resolv.conf.bak')
+        h.write_file(u'/etc/resolv.conf', u'nameserver 169.254.2.3', 0)
+        h.rm(u'/etc/resolv.conf.bak')
+        self.guest.saved = [u'/files/etc/fstab']
+        h.aug_save()
+        h.command([u'rpm', u'-qa'])
+
+        self.assertEqual(h.paths, set([u'/etc/resolv.conf',
+                                       u'/etc/resolv.conf.bak',
+                                       u'/etc/fstab']))
+        self.assertTrue(h.complete)
+
+        h.command([u'rpm', u'-e', u'kmod-xenpv'])
+        self.assertFalse(h.complete)
+
+        h.clear()
+        self.assertEqual(h.paths, set())
+        self.assertTrue(h.complete)
+
+    def testRelabel(self):
+        self.h.write_file(u'/etc/resolv.conf', u'', 0)
+        self.h.write_file(u'/etc/removed', u'', 0)
+        self.h.rm(u'/etc/removed')
+        selinux_relabel(self.h, self.logger)
+
+        self.assertEqual(self.guest.relabelled, [u'/etc/resolv.conf'])
+        self.assertFalse(self.h.exists(u'/.autorelabel'))
+
+    def testIncompleteRelabel(self):
+        self.h.command([u'/usr/bin/vmware-uninstall-tools.pl'])
+        selinux_relabel(self.h, self.logger)
+
+        self.assertEqual(self.guest.relabelled, [])
+        self.assertTrue(self.h.exists(u'/.autorelabel'))
+
+    def testPackageRemoval(self):
+        self.guest.packages[u'kmod-xenpv-0.1-9.el5.x86_64'] = \
+            [u'/lib/modules/2.6.18-8.el5/extra/xenpv']
+        self.h.write_file(u'/etc/resolv.conf', u'', 0)
+        self.h.rpm_transaction([u'rpm', u'-e', u'kmod-xenpv-0.1-9.el5.x86_64'])
+        selinux_relabel(self.h, self.logger)
+
+        self.assertEqual(self.guest.relabelled, [u'/etc/resolv.conf'])
+        self.assertFalse(self.h.exists(u'/.autorelabel'))
+
+    def testPackageInstall(self):
+        self.h.rpm_transaction([u'yum', u'install', u'-y',
+                                u'kernel-2.6.32-431.el6.x86_64'])
+        selinux_relabel(self.h, self.logger)
+
+        self.assertEqual(self.guest.relabelled,
+                         [u'/boot/vmlinuz-2.6.32-431.el6.x86_64',
+                          u'/lib/modules/2.6.32-431.el6.x86_64'])
+        self.assertFalse(self.h.exists(u'/.autorelabel'))
+
+    def testRestoredRelabel(self):
+        self.h.write_file(u'/etc/resolv.conf', u'', 0)
+        self.h.command([u'/usr/bin/vmware-uninstall-tools.pl'])
+        selinux_relabel(self.h, self.logger, autorelabel=False)
+
+        self.assertEqual(self.guest.relabelled, [u'/etc/resolv.conf'])
+        self.assertFalse(self.h.exists(u'/.autorelabel'))
+
+    def testNoSELinux(self):
+        self.guest.files[u'/etc/selinux/config'] = [u'SELINUX=disabled']
+        self.h.write_file(u'/etc/resolv.conf', u'', 0)
+        selinux_relabel(self.h, self.logger)
+
+        self.assertEqual(self.guest.relabelled, [])
+        self.assertFalse(self.h.exists(u'/.autorelabel'))
+
+
+class UndoJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.guest = GuestFiles({u'/etc/resolv.conf': u'nameserver 10.0.0.1',
+                                 u'/etc/fstab': u'/dev/sda1 / ext4',
+                                 u'/etc/rc.local': u'modprobe xenpv'})
+        self.guest.modes[u'/etc/rc.local'] = 0100755
+        self.guest.gpt_types[(u'/dev/sda', 1)] = u'EFI'
+        self.guest.labels = {
+            u'/etc/resolv.conf': u'system_u:object_r:net_conf_t:s0',
+            u'/etc/fstab': u'system_u:object_r:etc_t:s0'
+        }
+        self.h = UndoJournal(self.guest)
+
+    def testUndo(self):
+        h = self.h
+        original = dict(self.guest.files)
+
+        h.mv(u'/etc/resolv.conf', u'/etc/resolv.conf.v2vtmp')
+        h.write_file(u'/etc/resolv.conf', u'nameserver 169.254.2.3', 0)
+        h.write_file(u'/etc/rc.local', u'', 0)
+        h.chmod(0644, u'/etc/rc.local')
+        h.rm(u'/etc/rc.local')
+        self.guest.saved = [u'/files/etc/fstab']
+        self.guest.augeas = {u'/etc/fstab': u''}
+        h.aug_save()
+        h.part_set_gpt_type(u'/dev/sda', 1, u'BIOS')
+        h.part_set_gpt_type(u'/dev/sda', 1, u'Linux')
+
+        self.assertEqual(self.guest.save_mode, u'overwrite')
+        self.assertEqual(self.guest.files[u'/etc/fstab'], u'')
+
+        labels = dict(self.guest.labels)
+        self.assertTrue(h.undo())
+        self.assertEqual(self.guest.files, original)
+        self.assertEqual(self.guest.modes[u'/etc/rc.local'], 0100755)
+        self.assertEqual(self.guest.gpt_types[(u'/dev/sda', 1)], u'EFI')
+
+        # Only the restored file without a label must be relabelled
+        self.assertEqual(self.guest.labels, labels)
+        self.assertEqual(h.paths, set([u'/etc/rc.local']))
+
+        # Everything saved was discarded
+        self.assertTrue(h.undo())
+        self.assertEqual(self.guest.files, original)
+
+    def testIncomplete(self):
+        self.h.write_file(u'/etc/fstab', u'', 0)
+        self.h.command([u'/usr/bin/vmware-uninstall-tools.pl'])
+
+        self.assertFalse(self.h.undo())
+        self.assertEqual(self.guest.files[u'/etc/fstab'], u'/dev/sda1 / ext4')
+
+    def testPackageTransaction(self):
+        self.h.write_file(u'/etc/fstab', u'', 0)
+        self.h.rpm_transaction([u'yum', u'install', u'-y',
+                                u'kernel-2.6.32-431.el6.x86_64'])
+
+        self.assertTrue(self.h.complete)
+        self.assertFalse(self.h.undo())
+        self.assertEqual(self.guest.files[u'/etc/fstab'], u'/dev/sda1 / ext4')
+
+        # Only the transaction since the last clear() is reported
+        self.assertTrue(self.h.undo())
+
+
+all_tests = unittest.TestSuite((
+    unittest.makeSuite(ChangeJournalTest),
+    unittest.makeSuite(UndoJournalTest)
+))
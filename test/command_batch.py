@@ -0,0 +1,78 @@
+# test/command_batch.py unit test suite for
+# guestconv batched guest commands
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import subprocess
+import unittest
+
+from guestconv.converters.util import FileCache
+
+class HostShell(object):
+    """Stands in for a libguestfs handle, running sh on the host"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def sh(self, script):
+        self.calls += 1
+        return subprocess.check_output([u'/bin/sh', u'-c', script])
+
+    def read_file(self, path):
+        with open(path) as f:
+            return f.read()
+
+
+class CommandBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.host = HostShell()
+        self.h = FileCache(self.host, logging.getLogger(u'test'))
+
+    def testBatch(self):
+        results = self.h.command_batch([
+            [u'sh', u'-c', u'printf "a\\nb"; echo error >&2; exit 3'],
+            [u'echo', u"it's $HOME"],
+            [u'true']
+        ])
+
+        self.assertEqual(self.host.calls, 1)
+        self.assertEqual(results, [(3, 'a\nb', 'error\n'),
+                                   (0, "it's $HOME\n", ''),
+                                   (0, '', '')])
+
+    def testMissingCommand(self):
+        [(status, stdout, stderr)] = \
+            self.h.command_batch([[u'/nonexistent/command']])
+        self.assertEqual(status, 127)
+        self.assertNotEqual(stderr, '')
+
+    def testEmpty(self):
+        self.assertEqual(self.h.command_batch([]), [])
+        self.assertEqual(self.host.calls, 0)
+
+    def testInvalidation(self):
+        self.h.read_file(__file__)
+        self.h.command_batch([[u'rpm', u'-qf', u'/etc']])
+        self.h.read_file(__file__)
+        self.assertEqual(self.h.hits, 1)
+
+        self.h.command_batch([[u'true']])
+        self.h.read_file(__file__)
+        self.assertEqual(self.h.misses, 2)
+
+
+all_tests = unittest.makeSuite(CommandBatchTest)
@@ -0,0 +1,245 @@
+# test/converter.py unit test suite for
+# guestconv Converter phases and modes
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from guestconv.converter import Converter, RootMounted
+from guestconv.exception import ConversionError, GuestConvException, \
+                                InvalidConversion
+
+# A guest without disks, so the appliance is never needed
+GUEST = u'<guestconv><name>test</name></guestconv>'
+
+
+class MountTable(object):
+    """Stands in for a libguestfs handle, recording mounts"""
+
+    def __init__(self, mountpoints):
+        self.mountpoints = mountpoints
+        self.mounts = []
+
+    def inspect_get_mountpoints(self, root):
+        return self.mountpoints
+
+    def mount_ro(self, device, mountpoint):
+        self.mounts.append((u'ro', device, mountpoint))
+
+    def mount_options(self, options, device, mountpoint):
+        self.mounts.append((options, device, mountpoint))
+
+    def aug_init(self, root, flags):
+        pass
+
+    def umount_all(self):
+        pass
+
+
+class PhaseTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = Converter(GUEST, [])
+        self.events = []
+        self.converter.set_progress_callback(self.events.append)
+
+    def testCacheStats(self):
+        files = self.converter._files
+        files.hits += 1
+        with self.converter._phase(u'inspect'):
+            files.hits += 3
+            files.misses += 1
+
+        end = self.events[-1]
+        self.assertEqual(end[u'event'], u'end')
+        self.assertEqual(end[u'cache_hits'], 3)
+        self.assertEqual(end[u'cache_misses'], 1)
+        self.assertEqual(end[u'cache_hit_ratio'], 0.75)
+
+    def testNoReads(self):
+        with self.converter._phase(u'launch'):
+            pass
+        self.assertEqual(self.events[-1][u'cache_hits'], 0)
+        self.assertNotIn(u'cache_hit_ratio', self.events[-1])
+
+
+class SizeApplianceTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = Converter(GUEST, [])
+
+    def testExplicit(self):
+        # An explicit size isn't limited, or replaced by later estimates
+        self.assertEqual(self.converter.size_appliance(1000, 4, cpus=2),
+                         (1000, 4))
+        self.assertEqual(self.converter.size_appliance(cpus=2), (1000, 4))
+
+    def testEstimate(self):
+        (memsize, smp) = self.converter.size_appliance()
+        self.assertEqual(smp, 2)
+        self.assertEqual(self.converter.size_appliance(cpus=1),
+                         (memsize, 1))
+
+
+class OverlayTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix=u'guestconv-test.')
+        self.converter = Converter(GUEST, [], overlay=True,
+                                   overlay_dir=self.dir)
+        self.overlay_dir = self.converter._overlay_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testDiscard(self):
+        self.assertTrue(os.path.isdir(self.overlay_dir))
+        self.converter.discard()
+        self.assertFalse(os.path.exists(self.overlay_dir))
+
+        # The overlays are gone
+        self.assertRaises(GuestConvException, self.converter.commit)
+
+    def testCommitFailure(self):
+        # Not a qcow2 image, so it can't be committed
+        overlay = os.path.join(self.overlay_dir, u'0.qcow2')
+        with open(overlay, u'w') as f:
+            f.write(u'not an image')
+        self.converter._overlays.append(overlay)
+
+        self.assertRaises(ConversionError, self.converter.commit)
+
+        # The overlays are kept, so commit can be retried
+        self.assertTrue(os.path.exists(overlay))
+        self.converter.discard()
+        self.assertFalse(os.path.exists(self.overlay_dir))
+
+
+class ReadOnlyTest(unittest.TestCase):
+    def testOverlay(self):
+        self.assertRaises(ValueError, Converter, GUEST, [], readonly=True,
+                          overlay=True)
+
+    def testConvert(self):
+        converter = Converter(GUEST, [], readonly=True)
+        self.assertRaises(InvalidConversion, converter.convert,
+                          {u'roots': [], u'boot': []})
+
+    def testMount(self):
+        h = MountTable({u'/': u'/dev/sda2', u'/boot': u'/dev/sda1'})
+        with RootMounted(h, u'/dev/sda2', readonly=True):
+            pass
+        self.assertEqual(h.mounts, [(u'ro', u'/dev/sda2', u'/'),
+                                    (u'ro', u'/dev/sda1', u'/boot')])
+
+        h = MountTable({u'/': u'/dev/sda2'})
+        with RootMounted(h, u'/dev/sda2'):
+            pass
+        self.assertEqual(h.mounts, [(u'', u'/dev/sda2', u'/')])
+
+
+class DataDiskTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix=u'guestconv-test.')
+        self.images = []
+        for name in (u'os.img', u'data.img'):
+            image = os.path.join(self.dir, name)
+            with open(image, u'w') as f:
+                f.truncate(1024 * 1024)
+            self.images.append(image)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def guest(self, roles):
+        disks = [u"<disk format='raw' role='{}'>file://{}</disk>".
+                 format(role, image)
+                 for role, image in zip(roles, self.images)]
+        return (u"<guestconv><name>test</name><controller type='scsi'>" +
+                u''.join(disks) + u'</controller></guestconv>')
+
+    def testWritable(self):
+        converter = Converter(self.guest([u'os', u'data']), [])
+        data = converter._drives[1]
+        self.assertTrue(data[2][u'readonly'])
+
+        (disk, path, opts) = converter._writable_drive(data)
+        self.assertEqual(path, self.images[1])
+        self.assertFalse(opts[u'readonly'])
+
+    def testOverlay(self):
+        converter = Converter(self.guest([u'os', u'data']), [],
+                              overlay=True, overlay_dir=self.dir)
+        (disk, path, opts) = converter._writable_drive(converter._drives[1])
+        self.assertEqual(converter._overlays[-1], path)
+        self.assertEqual(opts[u'format'], u'qcow2')
+        self.assertNotIn(u'readonly', opts)
+        converter.discard()
+
+    def testReadOnly(self):
+        converter = Converter(self.guest([u'os', u'data']), [],
+                              readonly=True)
+        data = converter._drives[1]
+        self.assertEqual(converter._writable_drive(data), data)
+
+    def testOnlyData(self):
+        # The operating system, if any, is on the data disk
+        converter = Converter(self.guest([u'data']), [])
+        self.assertFalse(converter._drives[0][2][u'readonly'])
+
+
+class CacheFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix=u'guestconv-test.')
+        image = os.path.join(self.dir, u'disk.img')
+        with open(image, u'w') as f:
+            f.truncate(1024 * 1024)
+        self.cache = os.path.join(self.dir, u'disk.qcow2')
+        self.guest = (u"<guestconv><name>test</name>"
+                      u"<controller type='scsi'><disk format='raw' "
+                      u"cache='{}'>file://{}</disk></controller>"
+                      u"</guestconv>").format(self.cache, image)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testReadOnly(self):
+        converter = Converter(self.guest, [], readonly=True)
+        [(disk, path, opts)] = converter._drives
+        self.assertEqual(path, self.cache)
+        self.assertTrue(opts[u'copyonread'])
+        self.assertTrue(opts[u'readonly'])
+
+    def testWritable(self):
+        self.assertRaises(ValueError, Converter, self.guest, [])
+
+    def testUncached(self):
+        # Reads of a remote disk without a cache file are unknown
+        guest = self.guest.replace(u'</controller>',
+                                   u"<disk format='raw'>nbd://example.com/"
+                                   u'disk</disk></controller>')
+        converter = Converter(guest, [], readonly=True)
+        self.assertEqual(converter.remote_reads(), {u'sdb': None})
+
+
+all_tests = unittest.TestSuite((
+    unittest.makeSuite(PhaseTest),
+    unittest.makeSuite(SizeApplianceTest),
+    unittest.makeSuite(OverlayTest),
+    unittest.makeSuite(ReadOnlyTest),
+    unittest.makeSuite(DataDiskTest),
+    unittest.makeSuite(CacheFileTest),
+))
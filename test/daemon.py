@@ -0,0 +1,119 @@
+# test/daemon.py unit test suite for
+# the guestconv conversion daemon
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from concurrent.futures import Future
+
+import guestconv.daemon
+from guestconv.daemon import Client, Daemon, Job, LogSink
+from guestconv.worker import Limiter
+
+class LoggingConverter(object):
+    """Stands in for a Converter, logging each operation"""
+
+    def __init__(self, guest, db, logger, readonly=False):
+        self._logger = logger
+        self._logger.info(u'created')
+
+    def inspect(self, structured=False):
+        self._logger.info(u'inspecting')
+        return u'<guestconv/>'
+
+    def convert(self, desc):
+        self._logger.info(u'converting')
+        return None
+
+    def kill(self):
+        pass
+
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix=u'guestconv-test.')
+        path = os.path.join(self.dir, u'sock')
+        self.daemon = Daemon(path, [], Limiter(1),
+                             converter_class=LoggingConverter)
+        self.server = threading.Thread(target=self.daemon.serve_forever)
+        self.server.start()
+        self.client = Client(path)
+
+    def tearDown(self):
+        self.client.close()
+        self.daemon.shutdown()
+        self.server.join(5)
+        shutil.rmtree(self.dir)
+
+    def _logs(self, job):
+        responses = list(self.client.logs(job, follow=True))
+        return ([i[u'log'][u'message'] for i in responses[:-1]],
+                responses[-1])
+
+    def testInspectConvert(self):
+        inspect = self.client.request(u'inspect',
+                                      guest=u'<guestconv/>')[u'job']
+        (messages, status) = self._logs(inspect)
+        self.assertEqual(messages, [u'created', u'inspecting'])
+        self.assertEqual(status[u'state'], u'done')
+        self.assertEqual(status[u'result'], u'<guestconv/>')
+
+        convert = self.client.request(u'convert', job=inspect,
+                                      desc=u'<guestconv/>')[u'job']
+        (messages, status) = self._logs(convert)
+        self.assertEqual(messages, [u'converting'])
+        self.assertEqual(status[u'state'], u'done')
+
+        # The conversion's records go only to the convert job
+        self.assertEqual(self._logs(inspect)[0], [u'created', u'inspecting'])
+        self.assertEqual(self.client.request(u'status', job=convert),
+                         status)
+
+    def testUnknownJob(self):
+        self.assertRaises(guestconv.daemon.RequestError, self.client.request,
+                          u'status', job=u'nonexistent')
+
+
+class JobTest(unittest.TestCase):
+    def setUp(self):
+        self.max_records = guestconv.daemon.MAX_RECORDS
+        guestconv.daemon.MAX_RECORDS = 3
+
+    def tearDown(self):
+        guestconv.daemon.MAX_RECORDS = self.max_records
+
+    def testMaxRecords(self):
+        job = Job(None, LogSink())
+        future = Future()
+        job.start(future)
+        for i in range(5):
+            job.sink.log(20, json.dumps({u'message': i}))
+        future.set_result(None)
+
+        self.assertEqual([i[u'message'] for i in job.records(True)],
+                         [2, 3, 4])
+
+
+all_tests = unittest.TestSuite((
+    unittest.makeSuite(DaemonTest),
+    unittest.makeSuite(JobTest)
+))
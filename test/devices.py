@@ -0,0 +1,128 @@
+# test/devices.py unit test suite for
+# guestconv block device remapping
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import fnmatch
+import logging
+import unittest
+
+from guestconv.converters.devices import *
+from guestconv.converters.util import AugeasTransaction
+
+GUEST = {
+    u'controllers': [
+        {u'type': u'ide', u'disks': [{u'hint': u'hda'}, {u'hint': u'hdb'}]},
+        {u'type': u'scsi', u'disks': [{u'hint': u'sda'}]},
+        {u'type': u'cciss', u'disks': [{u'hint': u'cciss/c0d0'}]}
+    ]
+}
+
+class AugeasTree(object):
+    """Stands in for a libguestfs handle with augeas initialised"""
+
+    def __init__(self, nodes):
+        self.nodes = dict(nodes)
+        self.saves = 0
+
+    def aug_match(self, path):
+        # Enough of augeas path expressions for REMAP_PATHS
+        path = path.split(u'[')[0]
+        return sorted([i for i in self.nodes
+                       if fnmatch.fnmatchcase(i, path) and
+                          u'#comment' not in i])
+
+    def aug_get(self, path):
+        return self.nodes[path]
+
+    def aug_set(self, path, value):
+        self.nodes[path] = value
+
+    def aug_save(self):
+        self.saves += 1
+
+
+class DevicesTest(unittest.TestCase):
+    def testTable(self):
+        self.assertEqual(device_table(GUEST, u'virtio-blk'), {
+            u'hda': u'vda', u'hdb': u'vdb', u'sda': u'vdc',
+            u'cciss/c0d0': u'vdd'
+        })
+        self.assertEqual(device_table(GUEST, u'ide-hd'), {
+            u'sda': u'hdc', u'cciss/c0d0': u'hdd'
+        })
+        self.assertEqual(device_table(GUEST, u'e1000'), {})
+
+    def testDiskName(self):
+        self.assertEqual(disk_name(1), u'a')
+        self.assertEqual(disk_name(26), u'z')
+        self.assertEqual(disk_name(27), u'aa')
+        self.assertEqual(disk_name(703), u'aaa')
+
+    def testRemapString(self):
+        table = device_table(GUEST, u'virtio-blk')
+        self.assertEqual(remap_string(table, u'ro root=/dev/hda2 '
+                                             u'resume=/dev/cciss/c0d0p1'),
+                         u'ro root=/dev/vda2 resume=/dev/vdd1')
+        self.assertEqual(remap_string(table, u'a|^/dev/sda[0-9]*$|'),
+                         u'a|^/dev/vdc[0-9]*$|')
+        self.assertEqual(remap_string(table, u'/dev/sdaa1 /dev/hdc'),
+                         u'/dev/sdaa1 /dev/hdc')
+
+    def testSinglePass(self):
+        # sda becomes hdc, which must not be renamed again
+        table = {u'sda': u'hdc', u'hdc': u'hda'}
+        self.assertEqual(remap_string(table, u'/dev/sda1 /dev/hdc1'),
+                         u'/dev/hdc1 /dev/hda1')
+
+    def testRemapDevices(self):
+        h = AugeasTree({
+            u'/files/etc/fstab/1/spec': u'/dev/hda1',
+            u'/files/etc/fstab/2/spec': u'LABEL=/',
+            u'/files/etc/fstab/3/spec': u'/dev/sda1',
+            u'/files/boot/grub/device.map/hd0': u'/dev/hda',
+            u'/files/boot/grub/device.map/#comment': u'/dev/hda',
+            u'/files/boot/grub/grub.conf/title/kernel/root':
+                u'/dev/VolGroup00/LogVol00',
+            u'/files/boot/grub/grub.conf/title/kernel/resume':
+                u'/dev/cciss/c0d0p2',
+            u'/files/boot/efi/EFI/redhat/device.map/hd0': u'/dev/sda',
+            u'/files/boot/efi/EFI/redhat/grub.conf/title/kernel/root':
+                u'/dev/sda3'
+        })
+        aug = AugeasTransaction(h)
+        remap_devices(h, aug, device_table(GUEST, u'virtio-blk'),
+                      logging.getLogger(u'test'))
+        aug.save()
+
+        self.assertEqual(h.saves, 1)
+        self.assertEqual(h.nodes, {
+            u'/files/etc/fstab/1/spec': u'/dev/vda1',
+            u'/files/etc/fstab/2/spec': u'LABEL=/',
+            u'/files/etc/fstab/3/spec': u'/dev/vdc1',
+            u'/files/boot/grub/device.map/hd0': u'/dev/vda',
+            u'/files/boot/grub/device.map/#comment': u'/dev/hda',
+            u'/files/boot/grub/grub.conf/title/kernel/root':
+                u'/dev/VolGroup00/LogVol00',
+            u'/files/boot/grub/grub.conf/title/kernel/resume':
+                u'/dev/vdd2',
+            u'/files/boot/efi/EFI/redhat/device.map/hd0': u'/dev/vdc',
+            u'/files/boot/efi/EFI/redhat/grub.conf/title/kernel/root':
+                u'/dev/vdc3'
+        })
+
+
+all_tests = unittest.makeSuite(DevicesTest)
@@ -0,0 +1,99 @@
+# test/disk_cache.py unit test suite for
+# guestconv on-host cache
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from guestconv.cache import DiskCache
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='guestconv-test.')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testGetPut(self):
+        cache = DiskCache(self.dir)
+        self.assertIsNone(cache.get('ns', 'foo'))
+
+        cache.put('ns', 'foo', {'virtio-blk': ['virtio', 'virtio_blk']})
+        self.assertEqual(cache.get('ns', 'foo'),
+                         {'virtio-blk': ['virtio', 'virtio_blk']})
+
+        # Namespaces are independent
+        self.assertIsNone(cache.get('other', 'foo'))
+
+        # Entries are shared with other instances using the same directory
+        self.assertEqual(DiskCache(self.dir).get('ns', 'foo'),
+                         {'virtio-blk': ['virtio', 'virtio_blk']})
+
+    def testCorruptEntry(self):
+        cache = DiskCache(self.dir)
+        cache.put('ns', 'foo', 1)
+        (entry,) = os.listdir(os.path.join(self.dir, 'ns'))
+        with open(os.path.join(self.dir, 'ns', entry), 'w') as f:
+            f.write('{')
+        self.assertIsNone(cache.get('ns', 'foo'))
+
+    def testEviction(self):
+        value = 'x' * 100
+        cache = DiskCache(self.dir, max_size=250)
+
+        cache.put('ns', 'a', value)
+        cache.put('ns', 'b', value)
+
+        # Make a the most recently used entry
+        entries = os.path.join(self.dir, 'ns')
+        for name in os.listdir(entries):
+            os.utime(os.path.join(entries, name), (0, 0))
+        cache.get('ns', 'a')
+
+        cache.put('ns', 'c', value)
+        self.assertEqual(cache.get('ns', 'a'), value)
+        self.assertIsNone(cache.get('ns', 'b'))
+        self.assertEqual(cache.get('ns', 'c'), value)
+
+    def testScans(self):
+        # The directory is only scanned by the first put, and once the limit
+        # is exceeded
+        scans = []
+        walk = os.walk
+
+        def counting_walk(path, *args):
+            # os.walk calls itself for each subdirectory
+            if path == self.dir:
+                scans.append(path)
+            return walk(path, *args)
+
+        cache = DiskCache(self.dir, max_size=250)
+        os.walk = counting_walk
+        try:
+            cache.put('ns', 'a', 'x' * 100)
+            cache.put('ns', 'b', 'x' * 100)
+            self.assertEqual(len(scans), 1)
+
+            cache.put('ns', 'c', 'x' * 100)
+            self.assertEqual(len(scans), 2)
+        finally:
+            os.walk = walk
+
+
+all_tests = unittest.makeSuite(DiskCacheTest)
@@ -0,0 +1,86 @@
+# test/disk_roles.py unit test suite for
+# guestconv deferred data disks
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import unittest
+
+from guestconv.converter import RootMounted, _attached_devices, \
+                                _needs_data_disks
+
+class Appliance(object):
+    """Stands in for a libguestfs handle with some of a guest's disks
+    attached"""
+
+    def __init__(self, mountpoints):
+        self.mountpoints = mountpoints
+        self.mounted = []
+
+    def list_devices(self):
+        return [u'/dev/sda']
+
+    def list_partitions(self):
+        return [u'/dev/sda1', u'/dev/sda2']
+
+    def lvs(self):
+        return [u'/dev/VolGroup00/LogVol00']
+
+    def list_md_devices(self):
+        return []
+
+    def inspect_get_mountpoints(self, root):
+        return self.mountpoints
+
+    def mount_options(self, options, device, mountpoint):
+        self.mounted.append(mountpoint)
+
+    def aug_init(self, root, flags):
+        pass
+
+    def umount_all(self):
+        pass
+
+
+class DiskRolesTest(unittest.TestCase):
+    def testNoRoots(self):
+        h = Appliance({})
+        self.assertTrue(_needs_data_disks(h, [], _attached_devices(h)))
+
+    def testDataMountpoint(self):
+        # A database on a data disk isn't needed by inspection
+        h = Appliance({u'/': u'/dev/VolGroup00/LogVol00',
+                       u'/boot': u'/dev/sda1',
+                       u'/var/lib/pgsql': u'/dev/sdb1'})
+        devices = _attached_devices(h)
+        self.assertFalse(_needs_data_disks(h, [u'/dev/VolGroup00/LogVol00'],
+                                           devices))
+
+        with RootMounted(h, u'/dev/VolGroup00/LogVol00', devices=devices):
+            pass
+        self.assertEqual(h.mounted, [u'/', u'/boot'])
+
+    def testSystemMountpoint(self):
+        h = Appliance({u'/': u'/dev/sda2', u'/usr': u'/dev/sdb1'})
+        self.assertTrue(_needs_data_disks(h, [u'/dev/sda2'],
+                                          _attached_devices(h)))
+
+    def testSubvolume(self):
+        h = Appliance({u'/': u'btrfsvol:/dev/sda2/root'})
+        self.assertFalse(_needs_data_disks(h, [u'btrfsvol:/dev/sda2/root'],
+                                           _attached_devices(h)))
+
+
+all_tests = unittest.makeSuite(DiskRolesTest)
@@ -0,0 +1,49 @@
+# test/disk_tuning.py unit test suite for
+# guestconv disk tuning attributes
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import lxml.etree as ET
+import unittest
+
+from guestconv.converter import _disk_tuning
+
+class DiskTuningTest(unittest.TestCase):
+    def testDefaults(self):
+        d = ET.fromstring(u'<disk>nbd://example.com/path</disk>')
+        self.assertEqual(_disk_tuning(d), {
+            u'cachemode': None, u'discard': None, u'cache': None,
+            u'readahead': None
+        })
+
+    def testTuning(self):
+        d = ET.fromstring(u"<disk cachemode='unsafe' discard='besteffort' "
+                          u"cache='/var/cache/disk.qcow2' readahead='1024'>"
+                          u"nbd://example.com/path</disk>")
+        self.assertEqual(_disk_tuning(d), {
+            u'cachemode': u'unsafe', u'discard': u'besteffort',
+            u'cache': u'/var/cache/disk.qcow2', u'readahead': 1024
+        })
+
+    def testInvalid(self):
+        for attribute in (u"cachemode='none'", u"discard='yes'",
+                          u"readahead='-1'", u"readahead='1M'"):
+            d = ET.fromstring(u'<disk {}>nbd://example.com/path</disk>'.
+                              format(attribute))
+            self.assertRaises(ValueError, _disk_tuning, d)
+
+
+all_tests = unittest.makeSuite(DiskTuningTest)
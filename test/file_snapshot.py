@@ -0,0 +1,145 @@
+# test/file_snapshot.py unit test suite for
+# guestconv configuration snapshots
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import fnmatch
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from guestconv.converters.util import FileCache
+
+TREES = [
+    (u'/etc', [u'fstab', u'grub.conf', u'large.conf', u'missing']),
+    (u'/boot/grub', [u'grub.conf'])
+]
+
+class HostTree(object):
+    """Stands in for a libguestfs handle, with a host directory as the
+    guest's root"""
+
+    def __init__(self, root):
+        self.root = root
+        self.reads = 0
+        self.transfers = 0
+
+    def _host(self, path):
+        return os.path.join(self.root, path.lstrip(u'/'))
+
+    def ls(self, directory):
+        try:
+            return sorted(os.listdir(self._host(directory)))
+        except OSError as ex:
+            raise RuntimeError(ex.strerror)
+
+    def tar_out(self, directory, filename, compress=None, excludes=[]):
+        self.transfers += 1
+        tar = tarfile.open(filename, u'w:gz')
+        try:
+            for name in self.ls(directory):
+                if not any(fnmatch.fnmatchcase(u'./' + name, i)
+                           for i in excludes):
+                    tar.add(os.path.join(self._host(directory), name),
+                            arcname=u'./' + name)
+        finally:
+            tar.close()
+
+    def read_file(self, path):
+        self.reads += 1
+        with open(self._host(path)) as f:
+            return f.read()
+
+    def is_file(self, path):
+        self.reads += 1
+        return os.path.isfile(self._host(path)) and \
+               not os.path.islink(self._host(path))
+
+    def is_file_opts(self, path, followsymlinks=False):
+        self.reads += 1
+        if followsymlinks:
+            return os.path.isfile(self._host(path))
+        return self.is_file(path)
+
+    def write_file(self, path, content, size):
+        with open(self._host(path), u'w') as f:
+            f.write(content)
+
+
+class FileSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix=u'guestconv-test.')
+        os.makedirs(os.path.join(self.dir, u'etc'))
+        os.makedirs(os.path.join(self.dir, u'boot/grub'))
+        for path, content in [(u'etc/fstab', u'/dev/sda1 / ext4\n'),
+                              (u'etc/hosts', u'127.0.0.1 localhost\n'),
+                              (u'etc/large.conf', u'#' * (1024 * 1024 + 1)),
+                              (u'boot/grub/grub.conf', u'default=0\n')]:
+            with open(os.path.join(self.dir, path), u'w') as f:
+                f.write(content)
+        os.symlink(u'../boot/grub/grub.conf',
+                   os.path.join(self.dir, u'etc/grub.conf'))
+
+        self.host = HostTree(self.dir)
+        self.h = FileCache(self.host, logging.getLogger(u'test'))
+        self.h.snapshot(TREES)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testSnapshot(self):
+        self.assertEqual(self.host.transfers, 2)
+        self.assertEqual(self.h.read_file(u'/etc/fstab'),
+                         u'/dev/sda1 / ext4\n')
+        self.assertEqual(self.h.read_lines(u'/etc/fstab'),
+                         [u'/dev/sda1 / ext4'])
+        self.assertFalse(self.h.is_file(u'/etc/missing'))
+        self.assertEqual(self.host.reads, 0)
+
+    def testExcluded(self):
+        # Only the declared paths are transferred
+        self.assertNotIn(u'/etc/hosts', self.h._snapshot)
+        self.assertEqual(self.h.read_file(u'/etc/hosts'),
+                         u'127.0.0.1 localhost\n')
+        self.assertEqual(self.host.reads, 1)
+
+    def testMaxFileSize(self):
+        self.assertTrue(self.h.is_file(u'/etc/large.conf'))
+        self.assertEqual(self.host.reads, 0)
+
+        # Its contents weren't stored
+        self.assertEqual(len(self.h.read_file(u'/etc/large.conf')),
+                         1024 * 1024 + 1)
+        self.assertEqual(self.host.reads, 1)
+
+    def testSymlink(self):
+        self.assertFalse(self.h.is_file(u'/etc/grub.conf'))
+        self.assertTrue(self.h.is_file_opts(u'/etc/grub.conf',
+                                            followsymlinks=True))
+        self.assertEqual(self.h.read_file(u'/etc/grub.conf'), u'default=0\n')
+        self.assertEqual(self.host.reads, 0)
+
+    def testInvalidate(self):
+        self.h.write_file(u'/etc/fstab', u'/dev/vda1 / ext4\n', 0)
+        self.assertEqual(self.h.read_file(u'/etc/fstab'),
+                         u'/dev/vda1 / ext4\n')
+        self.assertEqual(self.host.reads, 1)
+
+
+all_tests = unittest.makeSuite(FileSnapshotTest)
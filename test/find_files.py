@@ -0,0 +1,86 @@
+# test/find_files.py unit test suite for
+# guestconv bounded guest directory searches
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+from guestconv.converters.util import find_files
+
+class HostTree(object):
+    """Stands in for a libguestfs handle with a host directory mounted"""
+
+    def __init__(self, root):
+        self.root = root
+        self.patterns = []
+
+    def glob_expand(self, pattern):
+        self.patterns.append(pattern)
+        paths = []
+        for path in glob.glob(self.root + pattern):
+            if os.path.isdir(path) and not path.endswith(u'/'):
+                path += u'/'
+            paths.append(path[len(self.root):])
+        return sorted(paths)
+
+    def is_file(self, path):
+        return os.path.isfile(self.root + path)
+
+
+class FindFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix=u'guestconv-test.')
+        for path in (u'2.6.18-8.el5/extra/xenpv', u'2.6.18-8.el5/kernel',
+                     u'2.6.18-8.el5xen/weak-updates/xenpv',
+                     u'2.6.18-8.el5/kernel/drivers/a/b/xenpv'):
+            os.makedirs(os.path.join(self.root, u'lib/modules', path))
+        open(os.path.join(self.root, u'lib/modules/2.6.18-8.el5/kernel/xenpv'),
+             u'w').close()
+        self.h = HostTree(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def testDirectories(self):
+        found = list(find_files(self.h, u'/lib/modules/', u'xenpv',
+                                type=u'd'))
+        self.assertEqual(found,
+                         [u'/lib/modules/2.6.18-8.el5/extra/xenpv',
+                          u'/lib/modules/2.6.18-8.el5xen/weak-updates/xenpv'])
+        self.assertEqual(len(self.h.patterns), 4)
+
+    def testFiles(self):
+        found = list(find_files(self.h, u'/lib/modules', u'xen*', type=u'f'))
+        self.assertEqual(found, [u'/lib/modules/2.6.18-8.el5/kernel/xenpv'])
+
+    def testDepth(self):
+        found = list(find_files(self.h, u'/lib/modules', u'xenpv',
+                                mindepth=6, maxdepth=6))
+        self.assertEqual(found,
+                         [u'/lib/modules/2.6.18-8.el5/kernel/drivers/a/b/'
+                          u'xenpv'])
+
+    def testStream(self):
+        found = find_files(self.h, u'/lib/modules', u'*')
+        self.assertEqual(next(found), u'/lib/modules/2.6.18-8.el5')
+        self.assertEqual(len(self.h.patterns), 1)
+
+
+all_tests = unittest.makeSuite(FindFilesTest)
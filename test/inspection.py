@@ -0,0 +1,89 @@
+# test/inspection.py unit test suite for
+# guestconv inspection and conversion description formats
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import copy
+import json
+import unittest
+
+import lxml.etree as ET
+
+from guestconv.converter import _inspection_xml, _parse_desc_dict, \
+                                _parse_desc_xml
+from guestconv.exception import InvalidConversion
+
+INSPECTION = {
+    u'roots': [{
+        u'name': u'/dev/VolGroup00/LogVol00',
+        u'info': {
+            u'hostname': u'rhel52.example.com',
+            u'version': {u'major': 5, u'minor': 2}
+        },
+        u'options': [{
+            u'name': u'block',
+            u'description': u'Block device driver',
+            u'values': [
+                {u'name': u'virtio-blk', u'description': u'VirtIO'},
+                {u'name': u'ide-hd', u'description': u'IDE'}
+            ]
+        }]
+    }],
+    u'boot': [{
+        u'disk': u'sda',
+        u'type': u'EFI',
+        u'name': u'grub2-efi',
+        u'replacement': {u'type': u'BIOS', u'name': u'grub2-bios'}
+    }]
+}
+
+class InspectionTest(unittest.TestCase):
+    def testXML(self):
+        dom = ET.fromstring(_inspection_xml(INSPECTION))
+        self.assertEqual(dom.xpath(u'/guestconv/root/info/version/major')[0]
+                            .text, u'5')
+        self.assertEqual([i.text for i in dom.xpath(u'//option/value')],
+                         [u'virtio-blk', u'ide-hd'])
+        self.assertEqual(dom.xpath(u'/guestconv/boot/loader/replacement')[0]
+                            .get(u'name'), u'grub2-bios')
+
+    def testSameDescription(self):
+        # An unmodified inspection converts the same in either form
+        from_xml = _parse_desc_xml(_inspection_xml(INSPECTION))
+        from_dict = _parse_desc_dict(json.loads(json.dumps(INSPECTION)))
+        self.assertEqual(from_xml, from_dict)
+        self.assertEqual(from_dict,
+                         ({u'sda': None},
+                          [(u'/dev/VolGroup00/LogVol00',
+                            {u'block': u'virtio-blk'})]))
+
+    def testChoose(self):
+        desc = copy.deepcopy(INSPECTION)
+        desc[u'roots'][0][u'options'][0][u'value'] = u'ide-hd'
+        desc[u'boot'][0][u'replacement'] = u'grub2-bios'
+
+        (bootloaders, roots) = _parse_desc_dict(desc)
+        self.assertEqual(bootloaders, {u'sda': u'grub2-bios'})
+        self.assertEqual(roots[0][1], {u'block': u'ide-hd'})
+
+    def testInvalid(self):
+        desc = copy.deepcopy(INSPECTION)
+        desc[u'roots'][0][u'options'][0][u'values'] = []
+        self.assertRaises(InvalidConversion, _parse_desc_dict, desc)
+        self.assertRaises(ValueError, _parse_desc_dict, {u'roots': [{}]})
+
+
+all_tests = unittest.makeSuite(InspectionTest)
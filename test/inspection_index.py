@@ -0,0 +1,111 @@
+# test/inspection_index.py unit test suite for
+# guestconv fleet inspection index
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import unittest
+
+from guestconv.index import InspectionIndex
+
+def inspection(distro, major, hypervisors={}, missing={}):
+    return {
+        u'roots': [{
+            u'name': u'/dev/sda1',
+            u'info': {
+                u'distribution': distro,
+                u'arch': u'x86_64',
+                u'version': {u'major': major, u'minor': 0}
+            },
+            u'options': [{
+                u'name': u'block',
+                u'description': u'Block device driver',
+                u'values': [{u'name': u'ide-hd', u'description': u'IDE'}]
+            }],
+            u'hypervisors': hypervisors,
+            u'missing': missing
+        }],
+        u'boot': [{u'disk': u'sda', u'type': u'BIOS', u'name': u'grub'}]
+    }
+
+
+class SlowConverter(object):
+    """Stands in for a Converter, reporting a single phase"""
+
+    def __init__(self):
+        self._id = u'web'
+        self._progress = None
+
+    def set_progress_callback(self, func):
+        self._progress = func
+
+    def inspect(self, structured=False):
+        for event in (u'start', u'end'):
+            self._progress({u'event': event, u'phase': u'inspect',
+                            u'guest': self._id, u'root': u'/dev/sda1',
+                            u'time': 100.0 if event == u'start' else 102.5})
+        return inspection(u'fedora', 19)
+
+
+class InspectionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = InspectionIndex(u':memory:')
+        self.index.add(u'rhel5-a', inspection(u'rhel', 5, missing={
+            u'virtio': [u'kernel-2.6.18-128.el5', u'mkinitrd-5.1.19']}), 20)
+        self.index.add(u'rhel5-b', inspection(u'rhel', 5, missing={
+            u'virtio': [u'kernel-2.6.18-128.el5']}), 30)
+        self.index.add(u'rhel5-c', inspection(u'rhel', 5), 40)
+        self.index.add(u'rhel6', inspection(u'rhel', 6, hypervisors={
+            u'vmware': u'installed', u'kvm': u'available'}), 10)
+
+    def tearDown(self):
+        self.index.close()
+
+    def guests(self, **criteria):
+        return [i[u'guest'] for i in self.index.query(**criteria)]
+
+    def testQuery(self):
+        self.assertEqual(self.guests(distribution=u'rhel', major=5,
+                                     missing=u'virtio'),
+                         [u'rhel5-b', u'rhel5-a'])
+        self.assertEqual(self.guests(hypervisor=u'vmware'), [u'rhel6'])
+        self.assertEqual(self.guests(hypervisor=u'kvm'), [])
+        self.assertEqual(self.guests(option=(u'block', u'ide-hd'),
+                                     limit=2), [u'rhel6', u'rhel5-c'])
+
+    def testReplace(self):
+        self.index.add(u'rhel6', inspection(u'rhel', 6), 10)
+        self.assertEqual(self.guests(hypervisor=u'vmware'), [])
+        self.assertEqual(len(self.guests()), 4)
+
+    def testInspect(self):
+        self.index.inspect(SlowConverter())
+        [root] = self.index.query(distribution=u'fedora')
+        self.assertEqual(root[u'guest'], u'web')
+        self.assertEqual(root[u'major'], 19)
+        self.assertEqual(self.index.timings(u'web'),
+                         [(u'inspect', u'/dev/sda1', 2.5)])
+
+    def testPreviousCallback(self):
+        converter = SlowConverter()
+        events = []
+        converter.set_progress_callback(events.append)
+        self.index.inspect(converter)
+
+        self.assertEqual([i[u'event'] for i in events], [u'start', u'end'])
+        self.assertEqual(converter._progress, events.append)
+
+
+all_tests = unittest.makeSuite(InspectionIndexTest)
@@ -0,0 +1,116 @@
+# test/kernel_modules.py unit test suite for
+# guestconv kernel module index parsing
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import unittest
+
+import guestconv.converters.kernel
+from guestconv.converters.kernel import *
+
+MODULES_DEP = u'''
+kernel/drivers/virtio/virtio.ko:
+kernel/drivers/virtio/virtio_ring.ko: kernel/drivers/virtio/virtio.ko
+kernel/drivers/virtio/virtio_pci.ko: kernel/drivers/virtio/virtio_ring.ko kernel/drivers/virtio/virtio.ko
+kernel/drivers/block/virtio_blk.ko.xz: kernel/drivers/virtio/virtio_ring.ko kernel/drivers/virtio/virtio.ko
+kernel/drivers/net/e1000/e1000.ko:
+'''.splitlines()
+
+MODULES_BUILTIN = u'''
+kernel/drivers/net/virtio_net.ko
+'''.splitlines()
+
+
+class ModuleTrees(object):
+    """Stands in for a libguestfs handle with a guest root mounted, in which
+    every kernel has the same module tree"""
+
+    def __init__(self):
+        self.downloads = 0
+
+    def is_file(self, path):
+        return path.endswith(u'/modules.dep')
+
+    def checksum(self, csumtype, path):
+        return path
+
+    def download(self, path, filename):
+        self.downloads += 1
+        with open(filename, u'w') as f:
+            f.write(u'\n'.join(MODULES_DEP).encode(u'utf-8'))
+
+
+class KernelModulesTest(unittest.TestCase):
+    def setUp(self):
+        self.index = ModuleIndex(u'3.9.5-301.fc19.x86_64',
+                                 parse_modules_dep(MODULES_DEP),
+                                 parse_modules_builtin(MODULES_BUILTIN))
+
+    def testKernelVersion(self):
+        self.assertEqual(kernel_version(u'/boot/vmlinuz-2.6.18-92.el5'),
+                         u'2.6.18-92.el5')
+        self.assertIsNone(kernel_version(u'/boot/initrd-2.6.18-92.el5.img'))
+
+    def testHasModule(self):
+        self.assertTrue(self.index.has_module(u'virtio_blk'))
+        self.assertTrue(self.index.has_module(u'virtio-pci'))
+        self.assertTrue(self.index.has_module(u'virtio_net'))
+        self.assertFalse(self.index.has_module(u'virtio_console'))
+
+    def testSupports(self):
+        self.assertTrue(self.index.supports(u'virtio-blk'))
+        self.assertTrue(self.index.supports(u'virtio-net'))
+        self.assertFalse(self.index.supports(u'virtio-serial'))
+        self.assertFalse(self.index.supports(u'e1000'))
+
+
+class DriverCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.max_drivers = guestconv.converters.kernel.MAX_DRIVERS
+        guestconv.converters.kernel.MAX_DRIVERS = 2
+        guestconv.converters.kernel._drivers.clear()
+        self.h = ModuleTrees()
+        self.logger = logging.getLogger(u'test')
+
+    def tearDown(self):
+        guestconv.converters.kernel.MAX_DRIVERS = self.max_drivers
+        guestconv.converters.kernel._drivers.clear()
+
+    def drivers(self, version):
+        return get_drivers(self.h, u'/boot/vmlinuz-' + version, None,
+                           self.logger)
+
+    def testBounded(self):
+        self.assertEqual(self.drivers(u'2.6.18-8.el5'), [u'virtio-blk'])
+        self.drivers(u'2.6.32-71.el6')
+        self.assertEqual(self.h.downloads, 2)
+
+        # The least recently used kernel is forgotten
+        self.drivers(u'2.6.18-8.el5')
+        self.drivers(u'3.9.5-301.fc19')
+        self.assertEqual(self.h.downloads, 3)
+        self.drivers(u'2.6.18-8.el5')
+        self.assertEqual(self.h.downloads, 3)
+        self.drivers(u'2.6.32-71.el6')
+        self.assertEqual(self.h.downloads, 4)
+        self.assertEqual(len(guestconv.converters.kernel._drivers), 2)
+
+
+all_tests = unittest.TestSuite((
+    unittest.makeSuite(KernelModulesTest),
+    unittest.makeSuite(DriverCacheTest)
+))
@@ -0,0 +1,121 @@
+# test/log_benchmark.py microbenchmark of
+# guestconv logging overhead
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Measure the cost of the debug logging done during an inspection.
+
+The debug messages logged while inspecting a root are replayed against a
+logger wrapping a function which, like most callers of libguestconv, only
+wants INFO and above. This is run with messages built eagerly and lazily, and
+with and without telling get_logger_object() the function's threshold.
+
+Usage: python test/log_benchmark.py [iterations]
+
+"""
+
+import logging
+import os.path
+import sys
+import timeit
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
+
+from guestconv.log import BraceMessage, get_logger_object
+
+# Approximately the debug messages logged while inspecting a RHEL 6 root with
+# 2 kernels and a grub bootloader
+KERNELS = [u'/boot/vmlinuz-2.6.32-358.el6.x86_64',
+           u'/boot/vmlinuz-2.6.32-279.el6.x86_64']
+HYPERVISORS = [u'kvm', u'xenpv', u'xenfv', u'vbox', u'vmware', u'citrixfv',
+               u'citrixpv']
+DRIVERS = [u'virtio-net', u'virtio-blk', u'virtio-serial', u'qxl-vga',
+           u'cirrus-vga']
+
+
+def eager(logger):
+    for klass in (u'Debian', u'RedHat'):
+        logger.debug(u'Converter {} unsupported for root {}'.
+                     format(klass, u'/dev/VolGroup00/LogVol00'))
+    for hv in HYPERVISORS:
+        logger.debug(u'Hypervisor {} available: {}'.format(hv, False))
+    for driver in DRIVERS:
+        logger.debug(u'No {} capability found for this root'.format(driver))
+    for kernel in KERNELS:
+        logger.debug(u'Using cached driver support for kernel {}'.
+                     format(kernel))
+        for driver in DRIVERS:
+            logger.debug(u'Kernel {} does not support {}'.
+                         format(kernel, driver))
+    for device in (u'/dev/sda', u'/dev/sdb'):
+        logger.debug(u"Bootloader {} installed on {} can't convert {}".
+                     format(u'GrubBIOS', u'/dev/sda', device))
+    logger.debug(u'File cache: {} hits, {} misses, hit ratio {:.2f}'.
+                 format(97, 31, 0.76))
+
+
+def lazy(logger):
+    for klass in (u'Debian', u'RedHat'):
+        logger.debug(BraceMessage(u'Converter {} unsupported for root {}',
+                                  klass, u'/dev/VolGroup00/LogVol00'))
+    for hv in HYPERVISORS:
+        logger.debug(BraceMessage(u'Hypervisor {} available: {}', hv, False))
+    for driver in DRIVERS:
+        logger.debug(BraceMessage(u'No {} capability found for this root',
+                                  driver))
+    for kernel in KERNELS:
+        logger.debug(BraceMessage(u'Using cached driver support for '
+                                  u'kernel {}', kernel))
+        for driver in DRIVERS:
+            logger.debug(BraceMessage(u'Kernel {} does not support {}',
+                                      kernel, driver))
+    for device in (u'/dev/sda', u'/dev/sdb'):
+        logger.debug(BraceMessage(u"Bootloader {} installed on {} "
+                                  u"can't convert {}",
+                                  u'GrubBIOS', u'/dev/sda', device))
+    logger.debug(BraceMessage(u'File cache: {} hits, {} misses, '
+                              u'hit ratio {:.2f}', 97, 31, 0.76))
+
+
+def log_func(level, message):
+    # What a caller filtering at INFO does with each message it receives
+    if level < logging.INFO:
+        return
+
+
+def main():
+    iterations = 2000
+    if len(sys.argv) > 1:
+        iterations = int(sys.argv[1])
+
+    unfiltered = get_logger_object(log_func)
+    filtered = get_logger_object(log_func, level=logging.INFO)
+
+    baseline = None
+    for name, messages, logger in [
+            (u'eager, function filters', eager, unfiltered),
+            (u'lazy, function filters', lazy, unfiltered),
+            (u'eager, level=INFO', eager, filtered),
+            (u'lazy, level=INFO', lazy, filtered)]:
+        t = timeit.timeit(lambda: messages(logger), number=iterations)
+        per_run = t / iterations * 1e6
+        if baseline is None:
+            baseline = per_run
+        print(u'{:<28} {:>9.1f}us per inspection ({:>5.1f}%)'.
+              format(name, per_run, per_run / baseline * 100))
+
+
+if __name__ == u'__main__':
+    main()
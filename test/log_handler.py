@@ -0,0 +1,113 @@
+# test/log_handler.py unit test suite for
+# guestconv queued log delivery
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import threading
+import unittest
+
+from guestconv.log import QueueingFunctionWrappingHandler, get_logger_object
+
+class SlowConsumer(object):
+    """Stands in for a libguestconv log callback, which only returns once it
+    is released"""
+
+    def __init__(self):
+        self.messages = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def __call__(self, level, message):
+        self.started.set()
+        self.released.wait()
+        self.messages.append(message)
+
+
+class QueueingHandlerTest(unittest.TestCase):
+    def logger(self, maxSize, overflow):
+        self.consumer = SlowConsumer()
+        logger = get_logger_object(self.consumer, queueSize=maxSize,
+                                   overflow=overflow)
+        logger.handlers[0].setFormatter(logging.Formatter(u'%(message)s'))
+        self.handler = logger.handlers[0]
+        return logger
+
+    def tearDown(self):
+        self.consumer.released.set()
+        self.handler.close()
+
+    def testFormattedWhenLogged(self):
+        logger = self.logger(10, QueueingFunctionWrappingHandler.BLOCK)
+        packages = [u'kernel']
+        logger.info(u'Missing: %s', packages)
+        packages.append(u'lvm2')
+
+        self.consumer.released.set()
+        self.handler.flush()
+        self.assertEqual(self.consumer.messages, [u"Missing: [u'kernel']"])
+
+    def testDrop(self):
+        logger = self.logger(1, QueueingFunctionWrappingHandler.DROP)
+        logger.info(u'delivering')
+        self.consumer.started.wait()
+        for i in range(3):
+            logger.info(u'message {}'.format(i))
+        self.assertEqual(self.handler.dropped, 2)
+
+        self.consumer.released.set()
+        self.handler.close()
+        self.assertEqual(self.consumer.messages, [u'delivering',
+                                                  u'message 0'])
+
+    def testBlock(self):
+        logger = self.logger(1, QueueingFunctionWrappingHandler.BLOCK)
+        logger.info(u'delivering')
+        self.consumer.started.wait()
+        logger.info(u'queued')
+
+        # The queue is full, so the next message waits for space
+        thread = threading.Thread(target=logger.info, args=(u'blocked',))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        self.consumer.released.set()
+        thread.join()
+        self.handler.close()
+        self.assertEqual(self.consumer.messages,
+                         [u'delivering', u'queued', u'blocked'])
+        self.assertEqual(self.handler.dropped, 0)
+
+    def testClose(self):
+        logger = self.logger(100, QueueingFunctionWrappingHandler.BLOCK)
+        for i in range(50):
+            logger.info(u'message {}'.format(i))
+
+        # Closing delivers every queued message
+        self.consumer.released.set()
+        self.handler.close()
+        self.assertEqual(self.consumer.messages,
+                         [u'message {}'.format(i) for i in range(50)])
+
+    def testInvalidOverflow(self):
+        self.consumer = SlowConsumer()
+        self.handler = QueueingFunctionWrappingHandler(self.consumer)
+        self.assertRaises(ValueError, QueueingFunctionWrappingHandler,
+                          self.consumer, overflow=u'spill')
+
+
+all_tests = unittest.makeSuite(QueueingHandlerTest)
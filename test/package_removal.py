@@ -0,0 +1,102 @@
+# test/package_removal.py unit test suite for
+# guestconv removal of hypervisor packages
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import unittest
+
+from guestconv.converters.redhat import HVVMware, _remove_applications
+
+LIBRARY = {u'app2_name': u'vmware-tools-libraries-nox', u'app2_epoch': 0,
+           u'app2_version': u'8.6.5', u'app2_release': u'1',
+           u'app2_arch': u'x86_64'}
+
+class FailingTransactions(object):
+    """Stands in for a ChangeJournal whose package transactions fail"""
+
+    def __init__(self):
+        self.transactions = []
+        self.files = set()
+
+    def rpm_transaction(self, argv):
+        self.transactions.append(argv)
+        raise RuntimeError(u'rpm failed')
+
+    def command_lines(self, argv):
+        if argv[:3] == [u'rpm', u'-q', u'--provides']:
+            return [u'libvmtools.so.0()(64bit)\n']
+        if argv[:3] == [u'yum', u'-q', u'resolvedep']:
+            return [u'open-vm-tools-9.4.0-1.x86_64\n']
+        raise AssertionError(u'Unexpected command: {}'.format(argv))
+
+    def aug_match(self, path):
+        return []
+
+    def exists(self, path):
+        return path in self.files
+
+    def write_file(self, path, content, size):
+        self.files.add(path)
+
+    def rm(self, path):
+        self.files.remove(path)
+
+
+class Messages(logging.Handler):
+    """Stands in for a log destination, keeping every message"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class PackageRemovalTest(unittest.TestCase):
+    def setUp(self):
+        self.h = FailingTransactions()
+        self.log = Messages()
+        self.logger = logging.Logger(u'test')
+        self.logger.addHandler(self.log)
+
+    def testRemove(self):
+        packages = iter([u'kmod-xenpv-0.1-9.el5', u'xe-guest-utilities'])
+        self.assertFalse(_remove_applications(self.h, self.logger, packages))
+        self.assertEqual(self.h.transactions, [
+            [u'rpm', u'-e', u'kmod-xenpv-0.1-9.el5', u'xe-guest-utilities']
+        ])
+        self.assertEqual(self.log.messages, [
+            u'Failed to remove packages kmod-xenpv-0.1-9.el5, '
+            u'xe-guest-utilities: rpm failed'
+        ])
+
+    def testReplaceLibraries(self):
+        # The library isn't removed if its replacement can't be installed
+        vmware = HVVMware(self.h, u'/dev/sda2', self.logger, [LIBRARY])
+        self.assertEqual(vmware._remove_libs(), [])
+        self.assertEqual(self.h.transactions, [
+            [u'yum', u'install', u'-y', u'open-vm-tools-9.4.0-1.x86_64']
+        ])
+        self.assertEqual(len(self.log.messages), 1)
+        self.assertIn(u'rpm failed', self.log.messages[0])
+
+        # The temporary network configuration was removed
+        self.assertEqual(self.h.files, set())
+
+
+all_tests = unittest.makeSuite(PackageRemovalTest)
@@ -0,0 +1,211 @@
+# test/progress_events.py unit test suite for
+# guestconv progress events
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import unittest
+from contextlib import contextmanager
+
+import guestfs
+
+import guestconv.converters
+from guestconv.converter import Converter
+
+GUEST = u'<guestconv><name>test</name></guestconv>'
+ROOT = u'/dev/sda2'
+DESC = {u'roots': [{u'name': ROOT, u'options': []}], u'boot': []}
+
+class Appliance(object):
+    """Stands in for a libguestfs handle with a single root, which reports
+    progress while it is launched"""
+
+    def __init__(self):
+        self.callback = None
+
+    def set_event_callback(self, callback, events):
+        self.callback = callback
+        return 1
+
+    def delete_event_callback(self, event_handle):
+        self.callback = None
+
+    def launch(self):
+        if self.callback is not None:
+            self.callback(guestfs.EVENT_PROGRESS, 1, u'', (0, 0, 50, 100))
+            self.callback(guestfs.EVENT_APPLIANCE, 1, u'booting', ())
+
+    def get_pid(self):
+        return None
+
+    def inspect_os(self):
+        return [ROOT]
+
+    def inspect_get_mountpoints(self, root):
+        return {u'/': root}
+
+    def mount_options(self, options, device, mountpoint):
+        pass
+
+    def aug_init(self, root, flags):
+        pass
+
+    def umount_all(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def undo(self):
+        return True
+
+    def is_file(self, path):
+        # No SELinux configuration, so nothing is relabelled
+        return False
+
+
+class Messages(logging.Handler):
+    """Stands in for a log destination, keeping every message"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class Augeas(object):
+    """Stands in for a guestconv.converters.util.Augeas"""
+
+    @contextmanager
+    def phase(self):
+        yield
+
+
+class Guest(object):
+    """Stands in for a guest converter, reading files through the file cache
+    of the Converter which uses it"""
+
+    files = None
+    fail = False
+
+    def __init__(self, h, root, guest, db, logger, cache):
+        self._details = {u'missing': {}, u'hypervisors': {}}
+        self._aug = Augeas()
+
+    def inspect(self):
+        Guest.files.hits += 2
+        Guest.files.misses += 1
+        return ({}, {}, [])
+
+    def convert(self, bootloaders, options):
+        if Guest.fail:
+            raise RuntimeError(u'conversion failed')
+
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.converters = guestconv.converters.all
+        guestconv.converters.all = [Guest]
+        Guest.fail = False
+
+        self.log = Messages()
+        logger = logging.Logger(u'test')
+        logger.addHandler(self.log)
+        self.converter = Converter(GUEST, [], logger=logger)
+        self.converter._h = Appliance()
+        Guest.files = self.converter._files
+        self.events = []
+        self.converter.set_progress_callback(self.events.append)
+
+    def tearDown(self):
+        guestconv.converters.all = self.converters
+
+    def phases(self):
+        return [(i[u'event'], i[u'phase'], i.get(u'root'))
+                for i in self.events if i[u'event'] in (u'start', u'end',
+                                                        u'error')]
+
+    def testInspect(self):
+        self.converter.inspect()
+        self.assertEqual(self.phases(), [
+            (u'start', u'launch', None), (u'end', u'launch', None),
+            (u'start', u'inspect_os', None), (u'end', u'inspect_os', None),
+            (u'start', u'inspect', ROOT), (u'end', u'inspect', ROOT)
+        ])
+        for event in self.events:
+            self.assertEqual(event[u'guest'], u'test')
+            self.assertIsInstance(event[u'time'], float)
+
+        # The appliance reported progress while it was launched
+        (progress, appliance) = self.events[1:3]
+        self.assertEqual((progress[u'event'], progress[u'phase']),
+                         (u'progress', u'launch'))
+        self.assertEqual((progress[u'position'], progress[u'total']),
+                         (50, 100))
+        self.assertEqual(appliance[u'message'], u'booting')
+
+        end = self.events[-1]
+        self.assertEqual((end[u'cache_hits'], end[u'cache_misses']), (2, 1))
+        self.assertAlmostEqual(end[u'cache_hit_ratio'], 2.0 / 3)
+        self.assertNotIn(u'cache_hits', self.events[-2])
+
+    def testConvert(self):
+        self.converter.inspect()
+        del self.events[:]
+        self.converter.convert(DESC)
+        self.assertEqual(self.phases(), [
+            (u'start', u'convert', ROOT), (u'start', u'relabel', ROOT),
+            (u'end', u'relabel', ROOT), (u'end', u'convert', ROOT)
+        ])
+        self.assertEqual(self.events[-1][u'cache_hits'], 0)
+
+    def testError(self):
+        self.converter.inspect()
+        del self.events[:]
+        Guest.fail = True
+        self.assertRaises(RuntimeError, self.converter.convert, DESC)
+
+        # The failed conversion is rolled back before the phase ends
+        self.assertEqual(self.phases(), [
+            (u'start', u'convert', ROOT), (u'start', u'rollback', ROOT),
+            (u'end', u'rollback', ROOT), (u'error', u'convert', ROOT)
+        ])
+        self.assertIn(u'cache_misses', self.events[-1])
+
+    def testCallbackError(self):
+        # A failing callback doesn't interrupt the conversion
+        def fail(event):
+            self.events.append(event)
+            raise ValueError(u'callback failed')
+        self.converter.set_progress_callback(fail)
+
+        self.assertEqual(self.converter.inspect(structured=True)[u'roots'][0]
+                         [u'name'], ROOT)
+        self.assertEqual(len(self.phases()), 6)
+        self.assertEqual(self.converter._phases, [])
+        self.assertIn(u'Progress callback failed on start event: '
+                      u'callback failed', self.log.messages)
+
+    def testStop(self):
+        self.converter.set_progress_callback(None)
+        self.assertIsNone(self.converter._h.callback)
+        self.converter.inspect()
+        self.assertEqual(self.events, [])
+
+
+all_tests = unittest.makeSuite(ProgressTest)
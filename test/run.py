@@ -23,15 +23,59 @@ import os.path
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir))
 
+import async_converter
+import augeas_transaction
+import change_journal
+import command_batch
+import converter
+import daemon
 import db
+import devices
+import disk_cache
+import disk_roles
+import disk_tuning
+import file_snapshot
+import find_files
+import inspection
+import inspection_index
+import kernel_modules
+import log_handler
+import package_removal
+import progress_events
 import rpm_package
+import scheduler
+import structured_log
+import template
+import virtio_support
 
 import debian_converter_test
 import redhat_converter_test
 
 suite = unittest.TestSuite((
+    async_converter.all_tests,
+    augeas_transaction.all_tests,
+    change_journal.all_tests,
+    command_batch.all_tests,
+    converter.all_tests,
+    daemon.all_tests,
     db.all_tests,
+    devices.all_tests,
+    disk_cache.all_tests,
+    disk_roles.all_tests,
+    disk_tuning.all_tests,
+    file_snapshot.all_tests,
+    find_files.all_tests,
+    inspection.all_tests,
+    inspection_index.all_tests,
+    kernel_modules.all_tests,
+    log_handler.all_tests,
+    package_removal.all_tests,
+    progress_events.all_tests,
     rpm_package.all_tests,
+    scheduler.all_tests,
+    structured_log.all_tests,
+    template.all_tests,
+    virtio_support.all_tests,
     redhat_converter_test.all_tests,
     debian_converter_test.all_tests
 ))
@@ -0,0 +1,105 @@
+# test/scheduler.py unit test suite for
+# guestconv host-resource-aware scheduling
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import threading
+import unittest
+
+from guestconv.exception import ConversionCancelled
+from guestconv.scheduler import *
+
+GUEST = {
+    u'controllers': [
+        {u'type': u'ide', u'disks': [{}, {}]},
+        {u'type': u'scsi', u'disks': [{}]}
+    ]
+}
+
+class SizedConverter(object):
+    """Stands in for a Converter whose appliance hasn't been launched"""
+
+    def __init__(self, memsize, smp):
+        self._size = (memsize, smp)
+
+    def size_appliance(self, cpus=None):
+        return (self._size[0], min(self._size[1], cpus))
+
+    def appliance_pid(self):
+        return None
+
+
+class SchedulerTest(unittest.TestCase):
+    def testEstimate(self):
+        (memsize, smp) = estimate_appliance(GUEST, convert=False)
+        self.assertEqual(memsize, BASE_MEMSIZE + 3 * DISK_MEMSIZE)
+        self.assertEqual(smp, 1)
+
+        (memsize, smp) = estimate_appliance(GUEST)
+        self.assertEqual(memsize,
+                         BASE_MEMSIZE + 3 * DISK_MEMSIZE + PACKAGES_MEMSIZE)
+        self.assertEqual(smp, 2)
+
+    def testAvailableMemory(self):
+        self.assertEqual(available_memory({u'MemAvailable': 2048 * 1024,
+                                           u'MemFree': 1024}), 2048)
+        self.assertEqual(available_memory({u'MemFree': 1024 * 1024,
+                                           u'Buffers': 512 * 1024,
+                                           u'Cached': 512 * 1024}), 2048)
+
+    def testMemory(self):
+        # Room for one appliance, but not two
+        meminfo = lambda: {u'MemAvailable': (1000 + QEMU_OVERHEAD) * 2 * 1024}
+        scheduler = Scheduler(reserve=0, cpus=8, meminfo=meminfo)
+
+        with scheduler.slot(SizedConverter(1000, 1)):
+            self.assertFalse(scheduler._admissible(1500, 1))
+            self.assertTrue(scheduler._admissible(500, 1))
+
+    def testCpus(self):
+        meminfo = lambda: {u'MemAvailable': 64 * 1024 * 1024}
+        scheduler = Scheduler(reserve=0, cpus=2, meminfo=meminfo)
+
+        # The only conversion is always admitted
+        self.assertTrue(scheduler._admissible(10 ** 6, 4))
+
+        with scheduler.slot(SizedConverter(500, 2)):
+            self.assertFalse(scheduler._admissible(500, 1))
+
+    def testCancelWaiting(self):
+        meminfo = lambda: {u'MemAvailable': 0}
+        scheduler = Scheduler(meminfo=meminfo)
+        cancelled = threading.Event()
+        errors = []
+
+        def wait():
+            try:
+                with scheduler.slot(SizedConverter(500, 1),
+                                    cancelled.is_set):
+                    pass
+            except ConversionCancelled as ex:
+                errors.append(ex)
+
+        with scheduler.slot(SizedConverter(500, 1)):
+            waiter = threading.Thread(target=wait)
+            waiter.start()
+            cancelled.set()
+            waiter.join(5)
+
+        self.assertEqual(len(errors), 1)
+
+
+all_tests = unittest.makeSuite(SchedulerTest)
@@ -0,0 +1,141 @@
+# test/structured_log.py unit test suite for
+# guestconv structured logging
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import json
+import logging
+import unittest
+
+from guestconv.converter import Converter
+from guestconv.log import ContextFilter, JSONFormatter, get_logger_object, \
+                          span
+
+class RecordingHandler(logging.Handler):
+    """Stands in for a log destination, keeping every record"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class SpanTest(unittest.TestCase):
+    def setUp(self):
+        self.messages = []
+        self.logger = get_logger_object(
+            lambda level, message: self.messages.append(json.loads(message)),
+            jsonFormat=True)
+
+    def testSpan(self):
+        with span(self.logger, u'inspect', guest=u'web') as result:
+            self.logger.info(u'Inspecting', extra={u'fields': {u'roots': 1}})
+            result[u'cache_hits'] = 3
+
+        (start, info, end) = self.messages
+        self.assertEqual(start[u'event'], u'start')
+        self.assertEqual((info[u'guest'], info[u'phase']),
+                         (u'web', u'inspect'))
+        self.assertEqual(info[u'fields'], {u'roots': 1})
+        self.assertEqual(info[u'message'], u'Inspecting')
+        self.assertEqual(info[u'level'], u'INFO')
+        self.assertEqual(end[u'event'], u'end')
+        self.assertEqual(end[u'start'], start[u'start'])
+        self.assertAlmostEqual(end[u'duration'], end[u'end'] - end[u'start'])
+        self.assertNotIn(u'cache_hits', end)
+
+    def testNested(self):
+        with span(self.logger, u'convert', guest=u'web'):
+            with span(self.logger, u'relabel', root=u'/dev/sda2'):
+                self.logger.info(u'Relabelling')
+            self.logger.info(u'Converted')
+
+        relabelling = self.messages[2]
+        self.assertEqual((relabelling[u'guest'], relabelling[u'root'],
+                          relabelling[u'phase']),
+                         (u'web', u'/dev/sda2', u'relabel'))
+
+        # The inner span's fields don't outlive it
+        converted = self.messages[4]
+        self.assertEqual(converted[u'phase'], u'convert')
+        self.assertNotIn(u'root', converted)
+
+    def testError(self):
+        def fail():
+            with span(self.logger, u'launch') as result:
+                result[u'attempts'] = 2
+                raise RuntimeError(u'no appliance')
+
+        self.assertRaises(RuntimeError, fail)
+        error = self.messages[-1]
+        self.assertEqual(error[u'event'], u'error')
+        self.assertIn(u'duration', error)
+
+        # Outside any span, records have no phase
+        self.logger.info(u'Done')
+        self.assertNotIn(u'phase', self.messages[-1])
+
+
+class JSONFormatterTest(unittest.TestCase):
+    def testException(self):
+        logger = logging.Logger(u'test')
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        try:
+            raise ValueError(u'bad disk')
+        except ValueError:
+            logger.exception(u'Failed')
+
+        event = json.loads(JSONFormatter().format(handler.records[0]))
+        self.assertEqual(event[u'message'], u'Failed')
+        self.assertEqual(event[u'level'], u'ERROR')
+        self.assertIn(u'ValueError: bad disk', event[u'exception'])
+        for key in (u'guest', u'phase', u'event', u'fields'):
+            self.assertNotIn(key, event)
+
+
+class LoggerTest(unittest.TestCase):
+    def testCallerLogger(self):
+        # A caller's logger gets the fields of spans too, once
+        logger = logging.Logger(u'caller')
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        self.assertIs(get_logger_object(logger), logger)
+        get_logger_object(logger)
+        self.assertEqual(len([i for i in logger.filters
+                              if isinstance(i, ContextFilter)]), 1)
+
+        with span(logger, u'inspect', guest=u'web'):
+            logger.warning(u'No bootloader')
+        self.assertEqual(handler.records[1].guest, u'web')
+        self.assertEqual(handler.records[1].phase, u'inspect')
+
+    def testConverter(self):
+        messages = []
+        converter = Converter(u'<guestconv><name>web</name></guestconv>', [],
+                              lambda level, message: messages.append(message),
+                              log_json=True)
+        converter._logger.info(u'Hello')
+        self.assertEqual(json.loads(messages[-1])[u'message'], u'Hello')
+
+
+all_tests = unittest.TestSuite((
+    unittest.makeSuite(SpanTest),
+    unittest.makeSuite(JSONFormatterTest),
+    unittest.makeSuite(LoggerTest)
+))
@@ -0,0 +1,83 @@
+# test/template.py unit test suite for
+# guestconv template fingerprints
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import hashlib
+import unittest
+
+from guestconv.template import fingerprint, guest_backing_chains
+
+CHAINS = [[(u'/var/lib/templates/rhel6.qcow2', 1073741824, 1380000000.0)]]
+
+class TemplateGuest(object):
+    """Stands in for a libguestfs handle with a cloned guest mounted"""
+
+    def __init__(self):
+        self.files = {u'/etc/fstab': u'/dev/sda1 / ext4',
+                      u'/boot/grub/grub.conf': u'default=0'}
+        self.packages = {u'size': 40960, u'mtime': 1380000000}
+
+    def glob_expand(self, pattern):
+        return []
+
+    def is_file(self, path):
+        return path in self.files
+
+    def checksum(self, csumtype, path):
+        return hashlib.sha256(self.files[path]).hexdigest()
+
+    def stat(self, path):
+        if path != u'/var/lib/rpm/Packages':
+            raise RuntimeError(u'stat: No such file or directory')
+        return self.packages
+
+
+class TemplateTest(unittest.TestCase):
+    def testClone(self):
+        a = fingerprint(TemplateGuest(), CHAINS, u'RedHat')
+        self.assertEqual(a, fingerprint(TemplateGuest(), CHAINS, u'RedHat'))
+
+        # The hostname is read by libguestfs inspection, so may differ
+        clone = TemplateGuest()
+        clone.files[u'/etc/hostname'] = u'clone'
+        self.assertEqual(a, fingerprint(clone, CHAINS, u'RedHat'))
+
+    def testDifferent(self):
+        a = fingerprint(TemplateGuest(), CHAINS, u'RedHat')
+
+        changed = TemplateGuest()
+        changed.files[u'/etc/fstab'] += u'\n/dev/sdb1 /data ext4'
+        self.assertNotEqual(a, fingerprint(changed, CHAINS, u'RedHat'))
+
+        updated = TemplateGuest()
+        updated.packages = {u'size': 40960, u'mtime': 1390000000}
+        self.assertNotEqual(a, fingerprint(updated, CHAINS, u'RedHat'))
+
+        self.assertNotEqual(a, fingerprint(TemplateGuest(),
+                                           [[(u'/other.qcow2', 1, 1.0)]],
+                                           u'RedHat'))
+        self.assertNotEqual(a, fingerprint(TemplateGuest(), CHAINS,
+                                           u'Debian'))
+
+    def testNotCloned(self):
+        remote = {u'controllers': [{u'disks': [{u'protocol': u'nbd',
+                                                u'path': u'disk'}]}]}
+        self.assertIsNone(guest_backing_chains(remote))
+        self.assertIsNone(guest_backing_chains({u'controllers': []}))
+
+
+all_tests = unittest.makeSuite(TemplateTest)
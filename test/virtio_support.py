@@ -0,0 +1,120 @@
+# test/virtio_support.py unit test suite for
+# guestconv virtio detection from kernel module indexes
+#
+# (C) Copyright 2013 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License, Version 2,
+# as published by the Free Software Foundation
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import logging
+import unittest
+
+from guestconv.converters.redhat import RedHat
+
+# The RHEL 5 virtio capability
+VIRTIO = {
+    u'kernel': {u'minversion': u'2.6.18-128.el5', u'ifinstalled': False},
+    u'lvm2': {u'minversion': u'2.02.40-6.el5', u'ifinstalled': False}
+}
+
+ALL_DRIVERS = [u'virtio-blk', u'virtio-net', u'virtio-serial']
+
+class RHEL5(object):
+    """Stands in for a libguestfs handle with a RHEL 5 root inspected"""
+
+    def __init__(self, packages):
+        self.packages = packages
+
+    def inspect_get_type(self, root):
+        return u'linux'
+
+    def inspect_get_distro(self, root):
+        return u'rhel'
+
+    def inspect_get_arch(self, root):
+        return u'x86_64'
+
+    def command_batch(self, commands):
+        results = []
+        for argv in commands:
+            evr = self.packages.get(argv[-1])
+            if evr is None:
+                results.append((1, u'package {} is not installed\n'.
+                                   format(argv[-1]), u''))
+            else:
+                results.append((0, u'(none) {} x86_64\n'.
+                                   format(u' '.join(evr.split(u'-'))), u''))
+        return results
+
+
+class CapabilityDB(object):
+    """Stands in for a guestconv.db.DB with a single capability"""
+
+    def __init__(self, capabilities):
+        self.capabilities = capabilities
+
+    def match_capability(self, name, arch, h, root):
+        return self.capabilities.get(name)
+
+
+class VirtioSupportTest(unittest.TestCase):
+    def converter(self, kernels, packages={u'lvm2': u'2.02.88-10.el5',
+                                           u'kernel': u'2.6.18-8.el5'},
+                  capabilities={u'virtio': VIRTIO}):
+        converter = RedHat(RHEL5(packages), u'/dev/sda2', {},
+                           CapabilityDB(capabilities),
+                           logging.getLogger(u'test'))
+        converter._kernels = kernels
+        return converter
+
+    def testNoKernelSupport(self):
+        converter = self.converter([(u'/boot/vmlinuz-2.6.18-8.el5', [])])
+        (supported, missing) = converter._virtio_support()
+        self.assertEqual(supported, set())
+        self.assertEqual([str(i) for i in missing],
+                         [u'kernel-2.6.18-128.el5'])
+
+    def testOtherKernel(self):
+        # The default kernel lacks virtio, but another bootable kernel has it
+        converter = self.converter([
+            (u'/boot/vmlinuz-2.6.18-8.el5', []),
+            (u'/boot/vmlinuz-2.6.18-348.el5', ALL_DRIVERS)
+        ])
+        self.assertEqual(converter._virtio_support(), (set(ALL_DRIVERS), []))
+
+    def testPartialSupport(self):
+        converter = self.converter([(u'/boot/vmlinuz-2.6.18-128.el5',
+                                     [u'virtio-blk', u'virtio-net'])],
+                                   capabilities={})
+        (supported, missing) = converter._virtio_support()
+        self.assertEqual(supported, set([u'virtio-blk', u'virtio-net']))
+        self.assertEqual([str(i) for i in missing], [u'kernel'])
+
+    def testUserspace(self):
+        converter = self.converter([(u'/boot/vmlinuz-2.6.18-348.el5',
+                                     ALL_DRIVERS)],
+                                   packages={u'lvm2': u'2.02.32-4.el5'})
+        (supported, missing) = converter._virtio_support()
+        self.assertEqual(supported, set())
+        self.assertEqual([str(i) for i in missing], [u'lvm2-2.02.40-6.el5'])
+
+    def testNoIndex(self):
+        # Package versions are checked instead
+        converter = self.converter([(u'/boot/vmlinuz-2.6.18-8.el5', None)])
+        (supported, missing) = converter._virtio_support()
+        self.assertEqual(supported, set())
+        self.assertEqual([str(i) for i in missing],
+                         [u'kernel-2.6.18-128.el5'])
+
+
+all_tests = unittest.makeSuite(VirtioSupportTest)